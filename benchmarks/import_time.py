@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""import_time.py
+
+This script measures the import time of the CLI (`python -X importtime`) and
+checks it against a budget: the heavy dependencies (pandas, InquirerPy,
+pyfiglet, the go library, ...) must only be loaded by the commands using them.
+
+Usage (from the root of the repository):
+
+    python benchmarks/import_time.py [--budget 350] [--runs 5]
+
+The script exits with status 1 if the budget is exceeded or if a deferred
+module is imported when the CLI starts.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# import time budget of `import nakalator` (in milliseconds)
+IMPORT_TIME_BUDGET = 350
+
+# modules that must not be imported by `nakalator --help`
+DEFERRED_MODULES = (
+    "pandas",
+    "InquirerPy",
+    "pyfiglet",
+    "tqdm",
+    "aiohttp",
+    "requests",
+    "lib.Nakalator",
+    "lib.bridge.nkl_gotils",
+)
+
+
+def measure(module: str = "nakalator") -> dict:
+    """Import a module in a new interpreter with `-X importtime`.
+
+    :param module: the module to import
+    :type module: str, optional
+    :return: the cumulative import time (in microseconds) of each module imported
+    :rtype: dict
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             cwd=ROOT_DIR,
+                             capture_output=True,
+                             text=True,
+                             check=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Check the import time of the Nakalator CLI.")
+    parser.add_argument("--budget", type=float, default=IMPORT_TIME_BUDGET,
+                        help="import time budget (in milliseconds)")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="number of measures (the median is checked)")
+    parser.add_argument("--top", type=int, default=10,
+                        help="number of the slowest top-level imports displayed")
+    args = parser.parse_args()
+
+    runs = [measure() for _ in range(max(1, args.runs))]
+    total = statistics.median(times["nakalator"] for times in runs) / 1000
+    last = runs[-1]
+
+    print(f"import nakalator: {total:.1f} ms (median of {len(runs)} runs, budget {args.budget:.0f} ms)")
+    # the top-level imports are the ones not indented in the output of -X importtime
+    top_level = sorted(((cumulative, name) for name, cumulative in last.items()
+                        if "." not in name and name != "nakalator"), reverse=True)
+    for cumulative, name in top_level[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    status = 0
+    deferred = [name for name in DEFERRED_MODULES if name in last]
+    if deferred:
+        print(f"FAIL: imported when the CLI starts: {', '.join(deferred)}")
+        status = 1
+    if total > args.budget:
+        print(f"FAIL: import time over budget ({total:.1f} ms > {args.budget:.0f} ms)")
+        status = 1
+    if status == 0:
+        print("OK")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
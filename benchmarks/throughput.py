@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+
+"""throughput.py
+
+This script measures the throughput (files/s and MB/s) of the steps of a batch
+against a local stand-in of the Nakala API (lib/utils/mock_utils.py), on
+synthetic datasets generated in a temporary workspace:
+
+- upload: the upload engine alone (`/datas/uploads`)
+- create: the creation of the data (`/datas`), one after the other as in a run
+- verify: the verification of the data created (`/datas/{id}`)
+- report: the reports of each data and the merged report
+- pipeline: a whole batch, `Nakalator.run_data` (hash, upload, create, report, verify)
+
+Usage (from the root of the repository):
+
+    python benchmarks/throughput.py [--files 10 1000 100000] [--engine asyncio]
+                                    [--latency 0.02] [--error-rate 0.01] [--burst-interval 5]
+                                    [--save results.json] [--baseline results.json]
+
+The client-side rate limits of the API are lifted (the server is local), use
+--api-limits to keep them. The script exits with status 1 if a step is slower
+than in the baseline (files/s) by more than the tolerance.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+STAGES = ("upload", "create", "verify", "report", "pipeline")
+
+# tolerated slowdown (files/s) compared to the baseline
+TOLERANCE = 0.25
+
+# API key sent to the mock server (written in the credentials.yml of the workspace)
+BENCH_API_KEY = "benchmark"
+
+
+def generate_dataset(root: str, files: int, file_size: int, files_per_data: int) -> str:
+    """Generate a batch of files with distinct contents and its metadata files
+    (data/<batch>/<data>/ and metadatas/<batch>/<data>.yml).
+
+    :param root: the workspace
+    :type root: str
+    :param files: the number of files
+    :type files: int
+    :param file_size: the size of the files (in bytes)
+    :type file_size: int
+    :param files_per_data: the number of files of each data
+    :type files_per_data: int
+    :return: the name of the batch
+    :rtype: str
+    """
+    batch = f"bench_{files}"
+    filler = os.urandom(file_size)
+    metadatas_dir = os.path.join(root, "metadatas", batch)
+    os.makedirs(metadatas_dir, exist_ok=True)
+    for index in range(files):
+        data_index, file_index = divmod(index, files_per_data)
+        data_dir = os.path.join(root, "data", batch, f"data_{data_index:05d}")
+        if file_index == 0:
+            os.makedirs(data_dir, exist_ok=True)
+            with open(os.path.join(metadatas_dir, f"data_{data_index:05d}.yml"), "w", encoding="utf-8") as f:
+                f.write(f'name: "{batch}"\n'
+                        f'data:\n'
+                        f'  path: "{data_dir}/"\n'
+                        f'  type: "bin"\n'
+                        f'  status: "pending"\n'
+                        f'collectionIds: ""\n'
+                        f'metadata:\n'
+                        f'  http://nakala.fr/terms#title:\n'
+                        f'    value: "Benchmark {batch} {data_index}"\n'
+                        f'    lang: "fr"\n'
+                        f'    typeUri: "http://www.w3.org/2001/XMLSchema#string"\n')
+        header = f"{batch}:{index}\n".encode("utf-8")
+        with open(os.path.join(data_dir, f"file_{file_index:05d}.bin"), "wb") as f:
+            f.write(header + filler[len(header):])
+    return batch
+
+
+def list_dataset(root: str, batch: str) -> list:
+    """List the data of a batch as (metadata file, files)."""
+    datas = []
+    metadatas_dir = os.path.join(root, "metadatas", batch)
+    for metadata_file in sorted(os.listdir(metadatas_dir)):
+        data_dir = os.path.join(root, "data", batch, os.path.splitext(metadata_file)[0])
+        datas.append((os.path.join(metadatas_dir, metadata_file),
+                      [os.path.join(data_dir, name) for name in sorted(os.listdir(data_dir))]))
+    return datas
+
+
+def serve(config, port_queue) -> None:
+    """Run the mock server in its own process (the client is not slowed down by the server)."""
+    from lib.utils.mock_utils import MockNakalaServer
+    server = MockNakalaServer(config)
+    port_queue.put(server.url)
+    server.serve_forever()
+
+
+def measure(name: str, files: int, size: int, func, quiet: bool = True) -> dict:
+    """Run a step and compute its throughput.
+
+    :param name: the name of the step
+    :type name: str
+    :param files: the number of files processed by the step
+    :type files: int
+    :param size: the bytes processed by the step
+    :type size: int
+    :param func: the step
+    :type func: callable
+    :param quiet: if the output of the step is hidden
+    :type quiet: bool, optional
+    :return: the result of the step
+    :rtype: dict
+    """
+    sink = io.StringIO()
+    with contextlib.ExitStack() as stack:
+        if quiet:
+            stack.enter_context(contextlib.redirect_stdout(sink))
+            stack.enter_context(contextlib.redirect_stderr(sink))
+        start = time.perf_counter()
+        try:
+            details = func() or {}
+        except SystemExit as e:
+            # fatal errors of a run end with sys.exit(1)
+            details = {"error": f"exit code {e.code}"}
+        duration = time.perf_counter() - start
+    return {
+        "step": name,
+        "files": files,
+        "bytes": size,
+        "seconds": round(duration, 3),
+        "files_per_s": round(files / duration, 1) if duration > 0 else 0.0,
+        "mb_per_s": round(size / duration / 1e6, 2) if duration > 0 else 0.0,
+        **details,
+    }
+
+
+def run_benchmark(root: str, batch: str, args, api_url: str):
+    """Run the steps on a batch and yield the result of each step."""
+    from lib.NakalatorAPIRequest import (NakalaAPIError,
+                                         NakalaAPIRequestBuilder)
+    from lib.upload_engines import get_upload_engine
+    from lib.utils.io_utils import (NakalaItem,
+                                    load_yaml)
+    from lib.utils.pipeline_utils import DataJob
+    from lib.utils.report_utils import get_report_writer
+    from lib.utils.verification_utils import BatchVerifier
+
+    datas = list_dataset(root, batch)
+    paths = [path for _, files in datas for path in files]
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    uploaded = {}
+    jobs = []
+
+    def upload() -> dict:
+        failed = 0
+
+        def on_result(result: dict) -> None:
+            nonlocal failed
+            uploaded[result["path"]] = {"name": result["name"], "sha1": result["sha1"]}
+            failed += 0 if result["sha1"] else 1
+
+        engine = get_upload_engine(args.engine, max_workers=args.workers)
+        engine.stream(f"{api_url}/datas/uploads", BENCH_API_KEY, paths, on_result)
+        return {"failed": failed}
+
+    def create() -> dict:
+        sender = NakalaAPIRequestBuilder(env="test")
+        skipped = 0
+        for order, (metadata_path, files) in enumerate(datas):
+            if not all(uploaded.get(path, {}).get("sha1") for path in files):
+                # the data whose uploads failed are not created, as in a run
+                skipped += 1
+                continue
+            job = DataJob(order=order, metadata_path=metadata_path, metadata=load_yaml(metadata_path),
+                          files=files, sha1s=[uploaded[path] for path in files])
+            try:
+                job.data_doi = sender.initialize_nakala_data(job.sha1s, job.metadata)
+            except NakalaAPIError:
+                skipped += 1
+                continue
+            jobs.append(job)
+        return {"datas": len(jobs), "skipped": skipped}
+
+    def verify() -> dict:
+        sender = NakalaAPIRequestBuilder(env="test")
+        summary = BatchVerifier(sender.check_data_files_exist).verify(jobs)["summary"]
+        return {"datas": summary["total"], "verified": summary["verified"]}
+
+    def report() -> dict:
+        report_dir = os.path.join(root, "output", f"{batch}_reports")
+        shutil.rmtree(report_dir, ignore_errors=True)
+        os.makedirs(report_dir)
+        with get_report_writer(os.path.join(report_dir, "merge_mapping_ids_all"), args.report_format) as merged:
+            for job in jobs:
+                items = [NakalaItem(sha1=sha1["sha1"], original_name=sha1["name"],
+                                    data_doi=job.data_doi, collection_doi="") for sha1 in job.sha1s]
+                with get_report_writer(os.path.join(report_dir, f"data_{job.order}_mapping_ids"),
+                                       args.report_format) as writer:
+                    writer.write(items)
+                merged.write(items)
+        return {"rows": merged.rows}
+
+    def pipeline() -> dict:
+        from lib.Nakalator import Nakalator
+        summary = Nakalator(env="test",
+                            batch=True,
+                            metadata_loc=batch,
+                            upload_engine=args.engine,
+                            max_workers=args.workers,
+                            report_format=args.report_format,
+                            interactive=False).run_data()
+        return {"datas": len(summary["datas"]), "verified": summary["verification"].get("verified", 0)}
+
+    steps = {"upload": upload, "create": create, "verify": verify, "report": report, "pipeline": pipeline}
+    # create works on the files uploaded, verify and report on the data created
+    needed = set(args.stages)
+    if needed & {"verify", "report"}:
+        needed.add("create")
+    if "create" in needed:
+        needed.add("upload")
+    for name in STAGES:
+        if name in needed:
+            yield measure(name, len(paths), total_bytes, steps[name], not args.verbose)
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Compare the throughput of the steps with a baseline.
+
+    :param results: the results of the steps (step/files -> result)
+    :type results: dict
+    :param baseline: the results of the baseline
+    :type baseline: dict
+    :param tolerance: the tolerated slowdown (e.g. 0.25)
+    :type tolerance: float
+    :return: the regressions (step, baseline files/s, files/s)
+    :rtype: list
+    """
+    regressions = []
+    for key, result in results.items():
+        reference = baseline.get(key)
+        if reference is None or reference["files_per_s"] <= 0:
+            continue
+        if result["files_per_s"] < reference["files_per_s"] * (1 - tolerance):
+            regressions.append((key, reference["files_per_s"], result["files_per_s"]))
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Measure the throughput of Nakalator against a local mock of Nakala.")
+    parser.add_argument("--files", type=int, nargs="+", default=[10, 1000],
+                        help="number of files of each dataset (e.g. 10 1000 100000)")
+    parser.add_argument("--file-size", type=int, default=16 * 1024, help="size of the files (in bytes)")
+    parser.add_argument("--files-per-data", type=int, default=100, help="number of files of each data")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES), help="steps measured")
+    parser.add_argument("--engine", default="asyncio", choices=("asyncio", "go"), help="upload engine")
+    parser.add_argument("--workers", type=int, default=20, help="initial number of concurrent uploads")
+    parser.add_argument("--report-format", default="csv", choices=("csv", "jsonl", "parquet"),
+                        help="format of the reports")
+    parser.add_argument("--latency", type=float, default=0.0, help="latency of the server (in seconds)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random latency added (in seconds, up to)")
+    parser.add_argument("--bandwidth", type=float, default=0.0,
+                        help="bandwidth of each upload (in MB/s, 0: unlimited)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of a 502/503 response")
+    parser.add_argument("--burst-interval", type=float, default=0.0,
+                        help="time (in seconds) between two bursts of 429 (0: no burst)")
+    parser.add_argument("--burst-duration", type=float, default=1.0, help="duration (in seconds) of a burst of 429")
+    parser.add_argument("--index-delay", type=float, default=0.0,
+                        help="time (in seconds) before a data created can be read")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the random errors")
+    parser.add_argument("--api-limits", action="store_true", help="keep the client-side rate limits of the API")
+    parser.add_argument("--save", help="save the results as JSON")
+    parser.add_argument("--baseline", help="results (JSON) to compare with")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="tolerated slowdown compared to the baseline (e.g. 0.25)")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary workspace")
+    parser.add_argument("--verbose", action="store_true", help="display the output of the steps")
+    args = parser.parse_args()
+    save = os.path.abspath(args.save) if args.save else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    root = tempfile.mkdtemp(prefix="nakalator-bench-")
+    # the paths of the workspace (data/, metadatas/, output/) are read from the current directory
+    os.chdir(root)
+    with open(os.path.join(root, "credentials.yml"), "w", encoding="utf-8") as f:
+        f.write(f'API_NAKALA_KEY_TEST: "{BENCH_API_KEY}"\n')
+
+    from lib.constants import API_RATE_LIMITS
+    from lib.utils.mock_utils import (MockNakalaConfig,
+                                      use_mock_server)
+    if not args.api_limits:
+        # before the shared rate limiter is created: no token bucket, no pacing
+        API_RATE_LIMITS.clear()
+    config = MockNakalaConfig(latency=args.latency,
+                              jitter=args.jitter,
+                              bandwidth=args.bandwidth * 1e6,
+                              error_rate=args.error_rate,
+                              burst_interval=args.burst_interval,
+                              burst_duration=args.burst_duration,
+                              index_delay=args.index_delay,
+                              seed=args.seed)
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(config, port_queue), daemon=True)
+    server.start()
+    results = {}
+    try:
+        api_url = port_queue.get(timeout=10)
+        print(f"mock server: {api_url}, workspace: {root}, engine: {args.engine}")
+        print(f"{'step':<10} {'files':>8} {'seconds':>9} {'files/s':>10} {'MB/s':>8}")
+        with use_mock_server(api_url):
+            for files in args.files:
+                batch = generate_dataset(root, files, args.file_size, args.files_per_data)
+                for result in run_benchmark(root, batch, args, api_url):
+                    results[f"{result['step']}/{files}"] = result
+                    notes = [f"{result[key]} {label}" for key, label in (("failed", "failed"),
+                                                                         ("skipped", "data skipped"))
+                             if result.get(key)]
+                    if result.get("error"):
+                        notes.append(result["error"])
+                    print(f"{result['step']:<10} {result['files']:>8} {result['seconds']:>9.3f} "
+                          f"{result['files_per_s']:>10.1f} {result['mb_per_s']:>8.2f}"
+                          f"{'  (' + ', '.join(notes) + ')' if notes else ''}", flush=True)
+    finally:
+        server.terminate()
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if save:
+        with open(save, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+    if baseline_path:
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for key, reference, current in regressions:
+            print(f"FAIL: {key} slower than the baseline ({current:.1f} files/s < {reference:.1f} files/s)")
+        if regressions:
+            return 1
+        print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
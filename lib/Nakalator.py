@@ -6,31 +6,58 @@ import sys
 import os
 import time
 import datetime
+import threading
 
 
-from lib.NakalatorAPIRequest import NakalaAPIRequestBuilder
+from lib.NakalatorAPIRequest import (NakalaAPIError,
+                                     NakalaAPIRequestBuilder)
 from lib.utils.cli_utils import (
     prompt_confirm,
     cli_log,
+    format_size,
     msg
 )
 from lib.utils.io_utils import (
     custom_sort,
-    load_yaml,
     NakalaItem,
-    merge_df_reports,
     rewrite_metadata_config_with_collection_ids
 )
-from lib.utils.tests_utils import (
-    check_total_files,
-    check_order_files,
-    check_sha1_consistency
+from lib.utils.journal_utils import UploadJournal
+from lib.utils.hash_utils import compute_sha1s
+from lib.utils.dedup_utils import BlobDeduplicator
+from lib.utils.collection_utils import CollectionRegistry
+from lib.utils.discovery_utils import discover_files
+from lib.utils.metadata_utils import load_metadata_files
+from lib.utils.metrics_utils import get_metrics
+from lib.utils.pipeline_utils import (
+    DataJob,
+    Pipeline
 )
+from lib.utils.report_utils import (
+    check_report_format,
+    get_report_writer
+)
+from lib.utils.scheduler_utils import BatchScheduler
+from lib.utils.shard_utils import (
+    ShardStore,
+    shard_of
+)
+from lib.utils.tests_utils import log_verification
+from lib.utils.verification_utils import BatchVerifier
 from lib.constants import (
     metadatas_dir,
-    output_dir
+    output_dir,
+    UPLOAD_ENGINE_DEFAULT,
+    UPLOAD_MAX_WORKERS,
+    UPLOAD_WORKERS_LIMIT,
+    HTTP_POOL_SIZE,
+    JOURNAL_FILENAME,
+    METRICS_DIR,
+    PIPELINE_QUEUE_SIZE,
+    REPORT_FORMAT_DEFAULT,
+    SHARDS_DIR
 )
-from lib.bridge.nkl_gotils import process_nkl_files_with_go
+from lib.upload_engines import get_upload_engine
 
 
 class Nakalator:
@@ -46,13 +73,49 @@ class Nakalator:
     :type collection_confirm: bool, optional
     :param same_collection_batch: if the same collection must be used for all the batch (default: False)
     :type same_collection_batch: bool, optional
+    :param upload_engine: the upload engine to use, "go" or "asyncio" (default: "go")
+    :type upload_engine: str, optional
+    :param max_workers: the initial number of concurrent uploads (default: 20)
+    :type max_workers: int, optional
+    :param workers_limit: the upper bound of the adaptive number of concurrent uploads (default: 100)
+    :type workers_limit: int, optional
+    :param pool_size: the number of connections kept open with Nakala (default: 20)
+    :type pool_size: int, optional
+    :param resume: if the files and data already recorded in the upload journal must be skipped (default: True)
+    :type resume: bool, optional
+    :param precompute_sha1: if the SHA-1 of the files must be computed locally before upload (default: True)
+    :type precompute_sha1: bool, optional
+    :param report_format: the format of the reports, "csv", "jsonl" or "parquet" (default: "csv")
+    :type report_format: str, optional
+    :param uploader: an upload engine to reuse, e.g. kept warm between the batches of `nakalator watch` (optional)
+    :type uploader: UploadEngine, optional
+    :param interactive: if the user can be asked questions during the run (default: True)
+    :type interactive: bool, optional
+    :param shard: the shard uploaded by this worker (index, number of shards), see `run_shard` (optional)
+    :type shard: tuple, optional
+    :param reduce_shards: the number of shards of the batch to reduce, see `run_reduce` (optional)
+    :type reduce_shards: int, optional
+    :param shard_dir: the directory shared by the shards and the reducer (default: output/shards)
+    :type shard_dir: str, optional
     """
     def __init__(self,
                  env: str = "test",
                  batch: bool = False,
                  metadata_loc: str = None,
                  collection_confirm: bool = False,
-                 same_collection_batch: bool = False
+                 same_collection_batch: bool = False,
+                 upload_engine: str = UPLOAD_ENGINE_DEFAULT,
+                 max_workers: int = UPLOAD_MAX_WORKERS,
+                 workers_limit: int = UPLOAD_WORKERS_LIMIT,
+                 pool_size: int = HTTP_POOL_SIZE,
+                 resume: bool = True,
+                 precompute_sha1: bool = True,
+                 report_format: str = REPORT_FORMAT_DEFAULT,
+                 uploader=None,
+                 interactive: bool = True,
+                 shard: tuple = None,
+                 reduce_shards: int = None,
+                 shard_dir: str = None
                  ) -> None:
         """Initialize the Nakalator class.
         :attr _environment: the environment to use
@@ -65,43 +128,101 @@ class Nakalator:
         :type _collection_confirm: bool
         :attr _same_collection_batch: if the same collection must be used for all the batch
         :type _same_collection_batch: bool
+        :attr _resume: if the upload journal is used to skip files and data already sent
+        :type _resume: bool
+        :attr _precompute_sha1: if the SHA-1 of the files are computed locally before upload
+        :type _precompute_sha1: bool
+        :attr _report_format: the format of the reports
+        :type _report_format: str
+        :attr _interactive: if the user can be asked questions (otherwise the default answers are used)
+        :type _interactive: bool
+        :attr _shard: the shard uploaded by this worker (index, number of shards)
+        :type _shard: tuple
+        :attr _reduce_shards: the number of shards of the batch to reduce
+        :type _reduce_shards: int
+        :attr shard_store: the directory shared by the shards and the reducer
+        :type shard_store: ShardStore
         :attr nakala_sender: the NakalaAPIRequestBuilder instance
         :type nakala_sender: NakalaAPIRequestBuilder
+        :attr uploader: the upload engine instance (None for the reducer, which uploads nothing)
+        :type uploader: UploadEngine
+        :attr journal: the persistent journal of the uploads and data creations
+        :type journal: UploadJournal
+        :attr deduplicator: the registry of the contents uploaded during the run
+        :type deduplicator: BlobDeduplicator
         :attr metadata_files: the metadata files
         :type metadata_files: list
         :attr metadata_files_cache: the cached metadata files
         :type metadata_files_cache: list
         :attr collection_created: the created collections
         :type collection_created: list
+        :attr collections: the registry of the collections created or checked
+        :type collections: CollectionRegistry
         """
         self._environment = env
         self._batch = batch
         self._metadata_loc = metadata_loc
         self._collection_confirm = collection_confirm
         self._same_collection_batch = same_collection_batch
+        self._resume = resume
+        self._precompute_sha1 = precompute_sha1
+        self._report_format = report_format
+        self._interactive = interactive
+        self._shard = shard
+        self._reduce_shards = reduce_shards
+        self.shard_store = None
+        if shard is not None or reduce_shards is not None:
+            self.shard_store = ShardStore(os.path.join(shard_dir or os.path.join(output_dir, SHARDS_DIR),
+                                                       os.path.basename(os.path.normpath(metadata_loc))))
+        try:
+            check_report_format(self._report_format)
+        except (ValueError, ImportError) as e:
+            cli_log(str(e), "error")
+            sys.exit(1)
 
-        self.nakala_sender = NakalaAPIRequestBuilder(env=self._environment)
+        self.nakala_sender = NakalaAPIRequestBuilder(env=self._environment, pool_size=pool_size)
+        # the reducer only creates data: it does not need an upload engine (nor the go library)
+        self.uploader = uploader
+        if uploader is None and reduce_shards is None:
+            try:
+                self.uploader = get_upload_engine(upload_engine,
+                                                  max_workers=max_workers,
+                                                  workers_limit=workers_limit,
+                                                  pool_size=pool_size)
+            except (ValueError, RuntimeError) as e:
+                cli_log(str(e), "error")
+                sys.exit(1)
+        # each shard has its own journal: the workers share only the shard directory
+        journal_filename = JOURNAL_FILENAME if shard is None else \
+            "{0}.shard-{2}-of-{3}{1}".format(*os.path.splitext(JOURNAL_FILENAME), *shard)
+        self.journal = UploadJournal(os.path.join(output_dir, journal_filename), env=self._environment)
+        self.deduplicator = BlobDeduplicator()
 
         # assemble metadatas files
         self.metadata_files = self.assemble_metadata_files()
         # cache metadata
         self.metadata_files_cache = self.cache_metadata()
-        # create collections
-        if self._collection_confirm:
+        # create collections (by the reducer in shard mode)
+        if self._collection_confirm and self._shard is None:
             self.collection_created = self.create_collections()
         else:
             self.collection_created = []
 
     @staticmethod
-    def prepare_files(path_dir_files: str) -> list:
-        """Prepare files to be sent to Nakala.
+    def prepare_files(data_config: dict) -> list:
+        """Prepare files to be sent to Nakala: the files of the data directory
+        matching `type` and the optional `include`/`exclude` patterns
+        (hidden and system files are ignored).
 
-        :param path_dir_files: the path to the images
-        :type path_dir_files: str
-        :return: the sorted list of images
-        :rtype: list
+        :param data_config: the `data` section of the metadata file
+        :type data_config: dict
+        :return: the files sorted by name
+        :rtype: list of DataFile
         """
-        return sorted([os.path.join(path_dir_files, f) for f in os.listdir(path_dir_files)])
+        return discover_files(data_config["path"],
+                              data_type=data_config.get("type"),
+                              include=data_config.get("include"),
+                              exclude=data_config.get("exclude"))
 
     @staticmethod
     def format_id(doi: str) -> str:
@@ -116,20 +237,52 @@ class Nakalator:
 
     def create_collections(self) -> list:
         """Create collections on Nakala.
+        The collection ids are written back to the metadata files once, at the end of
+        the collection phase (or when it stops on an error, so that the collections
+        already created are not created again by the next run).
 
         :return: the created collections
         :rtype: list
         """
         collections_created = []
+        self.collections = CollectionRegistry(self._environment, journal=self.journal)
+        # metadata files to rewrite: path -> metadata
+        changed_metadata = {}
+        try:
+            self._create_collections(collections_created, changed_metadata)
+        finally:
+            self.write_back_metadata(changed_metadata)
+        return collections_created
+
+    def _create_collections(self, collections_created: list, changed_metadata: dict) -> None:
+        """Create or check the collection of each metadata file (see `create_collections`).
+
+        :param collections_created: the collections, filled as (title, id) for each metadata file
+        :type collections_created: list
+        :param changed_metadata: the metadata files to rewrite, filled as path -> metadata
+        :type changed_metadata: dict
+        :return: None
+        :rtype: None
+        """
         turn = 0
         total = len(self.metadata_files_cache)
-        already_checked = []
+        registry = self.collections
+        # the collections given in the metadata files are checked at once (cached or concurrently)
+        metadata_checked = self.metadata_files_cache[:1] if self._same_collection_batch else self.metadata_files_cache
+        collection_ids = [m["collectionIds"] for _, m in metadata_checked if m["collectionIds"] not in ["", None]]
+        if len(collection_ids) > 0:
+            with msg.loading(f"Checking {len(set(collection_ids))} collection(s) on Nakala..."):
+                errors = registry.check(collection_ids, self.nakala_sender.get_collection_title)
+            if len(errors) > 0:
+                for error in errors.values():
+                    cli_log(error, "error")
+                sys.exit(1)
         for f, m in self.metadata_files_cache:
             turn += 1
             if total > 1 and turn >= 2 and self._same_collection_batch:
                 # attach all data to the same collection
                 m["collectionIds"] = collections_created[0][1]
-                rewrite_metadata_config_with_collection_ids(m, f)
+                changed_metadata[f] = m
                 cli_log(f"Collection: {collections_created[0][0]} attached to {f}, continue...", "info")
                 collections_created.append((collections_created[0][0], collections_created[0][1]))
             else:
@@ -150,18 +303,18 @@ class Nakalator:
                             "collectionDescription": m["collectionDescription"],
                             "collectionStatus": m["collectionStatus"],
                         }
-                    if metadata_collection["collectionTitle"] in [c[0] for c in collections_created]:
+                    if registry.get_id(metadata_collection["collectionTitle"]) is not None:
                         # ask to user if he want to use the existing collection that detected
                         cli_log(
                             f"Collection: {metadata_collection['collectionTitle']} already exist, do you want to use it?", "info")
-                        use_existing_collection = prompt_confirm("Do you want to use the existing collection?")
+                        use_existing_collection = prompt_confirm("Do you want to use the existing collection?") \
+                            if self._interactive else True
                         if use_existing_collection:
-                            collection_id = \
-                                [c[1] for c in collections_created if c[0] == metadata_collection['collectionTitle']][0]
+                            collection_id = registry.get_id(metadata_collection['collectionTitle'])
                             cli_log(
                                 f"Collection: {metadata_collection['collectionTitle']} with id: {collection_id} OK.", "success")
                             m["collectionIds"] = collection_id
-                            rewrite_metadata_config_with_collection_ids(m, f)
+                            changed_metadata[f] = m
                             new_collection = False
                             collections_created.append((metadata_collection['collectionTitle'], collection_id))
 
@@ -174,36 +327,48 @@ class Nakalator:
                             cli_log(f"collectionStatus is empty, by default it will be 'private' for {f}, you can change this later in Nakala.", "info")
                             m["collectionStatus"] = "private"
                             metadata_collection["collectionStatus"] = "private"
-                            rewrite_metadata_config_with_collection_ids(m, f)
-                            # rewrite metadata file with collectionIds
+                            changed_metadata[f] = m
                         # create collection
                         collection_title, collection_id = self.nakala_sender.initialize_nakala_collection(m)
+                        registry.add_created(collection_title, collection_id)
                         collections_created.append((collection_title, collection_id))
                         # rewrite metadata file with collectionIds
                         m["collectionIds"] = collection_id
-                        rewrite_metadata_config_with_collection_ids(m, f)
+                        changed_metadata[f] = m
                         cli_log(f"Collection: {collection_title} created for {filename} with id : {collection_id} on Nakala.", "success")
                 else:
-                    if m["collectionIds"] in [c[1] for c in already_checked]:
+                    collection_title = registry.get_title(m["collectionIds"])
+                    if registry.is_registered(m["collectionIds"]):
                         cli_log(f"Collection: {m['collectionIds']} already checked and is OK for {os.path.basename(f)}.", "info")
-                        # find collection title from collection id
-                        collection_title = [c[0] for c in already_checked if c[1] == m["collectionIds"]][0]
-                        collections_created.append((collection_title, m["collectionIds"]))
                     else:
-                        cli_log(f"Collection: {m['collectionIds']} already exist for {f}, check it...", "info")
-                        collection_title = self.nakala_sender.check_nakala_collection_exists(m["collectionIds"])
-                        collections_created.append((collection_title, m["collectionIds"]))
                         cli_log(f"Check collection: '{collection_title}' with id: {m['collectionIds']} is OK.", "success")
-                        already_checked.append((collection_title, m["collectionIds"]))
-        return collections_created
+                        registry.add(collection_title, m["collectionIds"])
+                    collections_created.append((collection_title, m["collectionIds"]))
+
+    def write_back_metadata(self, changed_metadata: dict) -> None:
+        """Write the metadata files changed during the collection phase, each once and atomically.
+        The journal cache of the parsed metadata is updated so that the files are not parsed again.
+
+        :param changed_metadata: the metadata to write, path -> metadata
+        :type changed_metadata: dict
+        :return: None
+        :rtype: None
+        """
+        for metadata_path, metadata in changed_metadata.items():
+            rewrite_metadata_config_with_collection_ids(metadata, metadata_path)
+        if len(changed_metadata) > 0:
+            self.journal.record_metadatas(changed_metadata)
 
     def cache_metadata(self) -> list:
         """Cache metadata files.
+        The files are parsed once, then read from the upload journal until they are modified.
 
         :return: the cached metadata files
         :rtype: list
         """
-        return [(f, load_yaml(f)) for f in sorted(self.metadata_files, key=custom_sort)[::-1]]
+        metadata_files = sorted(self.metadata_files, key=custom_sort)[::-1]
+        metadatas = load_metadata_files(metadata_files, journal=self.journal)
+        return [(f, metadatas[f]) for f in metadata_files]
 
     def assemble_metadata_files(self) -> list:
         """Assemble and sorted metadata files to prepare data/collection creation.
@@ -224,91 +389,496 @@ class Nakalator:
                 self._metadata_loc
             )]
 
-    def run_data(self) -> None:
-        """Run the data creation process.
+    def hash_files(self, files_to_send: list) -> dict:
+        """Compute the SHA-1 of the files locally (cached in the upload journal).
 
-        :return: None
-        :rtype: None
+        :param files_to_send: the paths to the files to send
+        :type files_to_send: list
+        :return: the SHA-1 of each file, empty if the precomputation is disabled
+        :rtype: dict
+        """
+        if not self._precompute_sha1:
+            return {}
+        with msg.loading(f"Computing SHA-1 of {len(files_to_send)} files..."):
+            return compute_sha1s(files_to_send, journal=self.journal)
+
+    def plan_uploads(self, files_to_send: list, local_sha1s: dict) -> tuple:
+        """Split the files to send between the files already on Nakala and the files to upload.
+        Files already recorded in the upload journal (same file or same content)
+        are not sent again. When the SHA-1 are computed locally, each distinct
+        content is uploaded once per run.
+
+        :param files_to_send: the paths to the files to send
+        :type files_to_send: list
+        :param local_sha1s: the SHA-1 computed locally for each file
+        :type local_sha1s: dict
+        :return: the files already uploaded (path -> sha1), the files to upload, the files
+                 already uploaded during the run (path -> sha1) and the duplicates (path -> path uploaded)
+        :rtype: tuple
         """
-        reports = []
-        results_objects = []
+        already_uploaded = self.journal.get_uploads(files_to_send) if self._resume else {}
+        remaining = [path for path in files_to_send if path not in already_uploaded]
+        # content-addressed deduplication within the run
+        remaining, reused, duplicates = self.deduplicator.plan(remaining, local_sha1s)
+        if self._resume and len(local_sha1s) > 0:
+            # files with a content already sent during a previous run (e.g. renamed or touched files)
+            known_sha1s = self.journal.get_uploaded_sha1s([local_sha1s[path] for path in remaining
+                                                           if path in local_sha1s])
+            for path in remaining:
+                if local_sha1s.get(path) in known_sha1s:
+                    already_uploaded[path] = local_sha1s[path]
+            remaining = [path for path in remaining if path not in already_uploaded]
+        if len(already_uploaded) > 0:
+            cli_log(f"{len(already_uploaded)}/{len(files_to_send)} files already uploaded (upload journal), skipped.", "info")
+        if len(reused) + len(duplicates) > 0:
+            cli_log(f"{len(reused) + len(duplicates)}/{len(files_to_send)} files with a content already sent "
+                    f"during this run, uploaded once.", "info")
+        return already_uploaded, remaining, reused, duplicates
+
+    def prepare_jobs(self) -> list:
+        """Prepare the data of the batch that are not created on Nakala yet.
+
+        :return: the data to create
+        :rtype: list
+        """
+        jobs = []
         count = 0
-        start_all_process = time.time()
+        failures = self.journal.get_failures() if self._resume else {}
         for f, m in self.metadata_files_cache:
             count += 1
             cli_log(f"{count}/{len(self.metadata_files_cache)} Processing metadata file > nkl data: {os.path.basename(f)}", "info")
-            # prepare images
-            files_to_send = self.prepare_files(m["data"]["path"])
+            data_created = self.journal.get_data(f) if self._resume else None
+            if data_created is None and self.shard_store is not None:
+                data_created = self.shard_store.get_data(f)
+            if data_created is not None:
+                cli_log(f"Data: {data_created['data_doi']} already created for {os.path.basename(f)} (upload journal), skipped.", "info")
+                continue
+            if os.path.abspath(f) in failures:
+                cli_log(f"Data of {os.path.basename(f)} not created by a previous run "
+                        f"({failures[os.path.abspath(f)]}), retried.", "warning")
             # try if path data contains dir "data"
             if "data" not in m["data"]["path"]:
                 cli_log(f"Files to send must be in 'data' directory, please check in {os.path.basename(f)}", "error")
                 sys.exit(1)
-            # retrieve collection id and title
-            collection_id = m["collectionIds"]
+            # prepare images
+            files = self.prepare_files(m["data"])
+            if len(files) == 0:
+                cli_log(f"No file of type '{m['data'].get('type')}' to send in {m['data']['path']}, "
+                        f"please check 'type', 'include' and 'exclude' in {os.path.basename(f)}", "error")
+                sys.exit(1)
+            if self._shard is not None:
+                # the files of the data uploaded by this worker
+                files = [file for file in files if shard_of(file.name, self._shard[1]) == self._shard[0]]
+            self.journal.remember_files(files)
+            jobs.append(DataJob(order=count,
+                                metadata_path=f,
+                                metadata=m,
+                                files=files,
+                                files_to_send=[file.path for file in files],
+                                collection_doi=m["collectionIds"]))
+        return jobs
+
+    def _upload_stage(self):
+        """Pipeline source: upload the files of every data of the batch in a single
+        worker pool and release each data as soon as all of its files have landed.
+
+        :return: the data ready to be created on Nakala
+        :rtype: generator
+        """
+        jobs = self.prepare_jobs()
+        if len(jobs) == 0:
+            return
+        # a file shared by several data is hashed and uploaded once
+        all_files = list(dict.fromkeys(path for job in jobs for path in job.files_to_send))
+        local_sha1s = self.hash_files(all_files)
+        already_uploaded, remaining, reused, duplicates = self.plan_uploads(all_files, local_sha1s)
+
+        sizes = {file.path: file.size for job in jobs for file in job.files}
+        scheduler = BatchScheduler()
+        for job in jobs:
+            job.local_sha1s = {path: local_sha1s[path] for path in job.files_to_send if path in local_sha1s}
+            waiting = [duplicates.get(path, path) for path in job.files_to_send
+                       if path not in already_uploaded and path not in reused]
+            scheduler.add(job.order, job, [path for path in waiting if path not in already_uploaded])
+
+        uploaded = {}
+
+        def on_result(result: dict) -> None:
+            # called as soon as a file is uploaded, in the upload thread
+            path = result["path"]
+            if path in local_sha1s and result["sha1"] and result["sha1"] != local_sha1s[path]:
+                cli_log(f"SHA-1 returned by Nakala for {result['name']} differs from the local file, "
+                        f"the upload is considered as failed.", "error")
+                result["sha1"] = ""
+            if result["sha1"]:
+                self.journal.record_upload(path, result["name"], result["sha1"])
+                if path in local_sha1s:
+                    self.deduplicator.register(local_sha1s[path], result["sha1"])
+            uploaded[path] = result
+            scheduler.landed(path)
+
+        errors = []
+
+        def upload() -> None:
             start_process_files = time.time()
-            sha1s = process_nkl_files_with_go(
-                    url=f'{self.nakala_sender._api_url}/datas/uploads',
-                    api_key=self.nakala_sender._api_key,
-                    file_paths=files_to_send
-                )
-            cli_log("⏳\tTime elapsed to process files on Nakala: {:.2f} seconds".format(time.time() - start_process_files), "info")
-            results_objects = [NakalaItem(sha1=sha1['sha1'], original_name=sha1['name']) for sha1 in sha1s]
-            # create data repository
-            handle_data_id = self.nakala_sender.initialize_nakala_data(sha1s=sha1s, metadata_config=m)
-            # update objects with data_doi and collection_doi
-            for obj in results_objects:
-                obj.data_doi = handle_data_id
-                obj.collection_doi = collection_id
-
-            with msg.loading("Saving report..."):
-                # create an output dir if not exist based on m['name']
-                try:
-                    name_project = m["name"]
-                except:
-                    name_project = "project"
-                output_dir_project = os.path.join(output_dir, name_project)
-                if not os.path.exists(output_dir_project):
-                    os.makedirs(output_dir_project)
-                try:
-                    if collection_id in ["", None]:
-                        name_report_csv = f"data_{count}_{self.format_id(handle_data_id)}_mapping_ids_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-                    else:
-                        name_report_csv = f"data_{count}_{self.format_id(collection_id)}_{self.format_id(handle_data_id)}_mapping_ids_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-                    NakalaItem.to_csv(name_report_csv, results_objects, output_dir_project)
-                    reports.append(name_report_csv)
-                except Exception as e:
-                   cli_log(f"Error when saving report: {e}", "error")
-
-            # run tests
-            with msg.loading("Running tests..."):
-                files = self.nakala_sender.check_data_files_exist(
-                data_id=handle_data_id
-                )
-                if len(files) > 0:
-                    cli_log("🔍Results tests session: ")
-                    check_total_files(files, len(sorted(files_to_send)))
-                    check_order_files(files, sorted([os.path.basename(f) for f in files_to_send]))
-                    check_sha1_consistency(os.path.join(output_dir_project, name_report_csv), files)
-                    print("-" * 50)
-                else:
-                    cli_log("Cannot run tests for the moment, please check manually in Nakala", "warning")
+            try:
+                if len(remaining) > 0:
+                    self.uploader.stream(url=f'{self.nakala_sender._api_url}/datas/uploads',
+                                         api_key=self.nakala_sender._api_key,
+                                         file_paths=remaining,
+                                         on_result=on_result,
+                                         sizes=sizes)
+                    cli_log("⏳\tTime elapsed to process {} files on Nakala ({} engine): {:.2f} seconds".format(
+                        len(remaining), self.uploader.name, time.time() - start_process_files), "info")
+            except BaseException as exc:
+                errors.append(exc)
+            finally:
+                # end of the uploads
+                scheduler.ready.put(None)
+
+        def file_result(path: str) -> dict:
+            name = os.path.basename(path)
+            if path in already_uploaded:
+                return {"name": name, "sha1": already_uploaded[path]}
+            if path in reused:
+                return {"name": name, "sha1": reused[path]}
+            if path in duplicates:
+                uploaded_path = duplicates[path]
+                return self.deduplicator.resolve(path, uploaded.get(uploaded_path) or
+                                                 {"sha1": already_uploaded.get(uploaded_path, "")})
+            return {"name": uploaded[path]["name"], "sha1": uploaded[path]["sha1"]}
+
+        threading.Thread(target=upload, name="upload", daemon=True).start()
+        released = 0
+        while released < len(jobs):
+            job = scheduler.ready.get()
+            if job is None:
+                if len(errors) > 0:
+                    raise errors[0]
+                cli_log(f"{scheduler.waiting} data still waiting for files after the uploads.", "error")
+                sys.exit(1)
+            released += 1
+            job.sha1s = [file_result(path) for path in job.files_to_send]
+            cli_log(f"All files of {os.path.basename(job.metadata_path)} landed on Nakala "
+                    f"({released}/{len(jobs)} data ready).", "info")
+            yield job
+
+    def _create_stage(self, job: DataJob) -> DataJob:
+        """Pipeline stage: create the data on Nakala (paced by the rate limiter of the API).
+
+        :param job: the data with its uploaded files
+        :type job: DataJob
+        :return: the data with its DOI
+        :rtype: DataJob
+        """
+        failed = [result["name"] for result in job.sha1s if not result["sha1"]]
+        if len(failed) > 0:
+            # Nakala would refuse the data: it is created by a next run, once its files are uploaded
+            job.error = (f"{len(failed)} files not uploaded "
+                         f"({', '.join(failed[:5])}{'...' if len(failed) > 5 else ''})")
+            return job
+        start = time.monotonic()
+        try:
+            job.data_doi = self.nakala_sender.initialize_nakala_data(sha1s=job.sha1s, metadata_config=job.metadata)
+        except NakalaAPIError as e:
+            job.error = str(e)
+            return job
+        metrics = get_metrics()
+        metrics.observe("nakalator_data_creation_duration_seconds", time.monotonic() - start)
+        metrics.inc("nakalator_data_created_total")
+        self.journal.record_data(job.metadata_path, job.data_doi, job.collection_doi, job.files_to_send)
+        if self.shard_store is not None:
+            self.shard_store.record_data(job.metadata_path, job.data_doi, job.collection_doi)
+        return job
+
+    def _shard_stage(self, job: DataJob) -> None:
+        """Pipeline stage (shard mode): save the files of the data uploaded by this
+        worker in the shard directory, for the reducer.
+
+        :param job: the data with the files of this shard uploaded
+        :type job: DataJob
+        :return: None
+        :rtype: None
+        """
+        self.shard_store.save_results(job.metadata_path, self._shard, [
+            {"path": path, "name": result["name"], "sha1": result["sha1"], "local_sha1": job.local_sha1s.get(path)}
+            for path, result in zip(job.files_to_send, job.sha1s)])
+        self._sharded.append(job)
+        failed = sum(1 for result in job.sha1s if not result["sha1"])
+        cli_log(f"Shard {self._shard[0]}/{self._shard[1]} of {os.path.basename(job.metadata_path)}: "
+                f"{len(job.sha1s) - failed} files uploaded"
+                f"{f', {failed} failed (run the shard again)' if failed else ''}.",
+                "success" if failed == 0 else "error")
+
+    def _reduce_stage(self):
+        """Pipeline source (reducer): release the data whose shards are all uploaded,
+        with the files in the order of the data directory.
+
+        :return: the data ready to be created on Nakala
+        :rtype: generator
+        """
+        self._waiting_shards = []
+        count = 0
+        for f, m in self.metadata_files_cache:
+            count += 1
+            name = os.path.basename(f)
+            if (self.journal.get_data(f) if self._resume else None) is not None \
+                    or self.shard_store.get_data(f) is not None:
+                cli_log(f"Data of {name} already created, skipped.", "info")
+                continue
+            uploaded, missing = self.shard_store.load_results(f, self._reduce_shards)
+            if len(missing) > 0:
+                cli_log(f"Data of {name} waiting for the shards: "
+                        f"{', '.join(f'{index}/{self._reduce_shards}' for index in missing)}.", "info")
+                self._waiting_shards.append(f)
+                continue
+            files = self.prepare_files(m["data"])
+            failed = [file.name for file in files if not uploaded.get(file.path, {}).get("sha1")]
+            if len(failed) > 0:
+                cli_log(f"Data of {name}: {len(failed)} files not uploaded by the shards "
+                        f"({', '.join(failed[:5])}{'...' if len(failed) > 5 else ''}), run the shards again.", "error")
+                self._waiting_shards.append(f)
+                continue
+            if not self.shard_store.acquire(f):
+                cli_log(f"Data of {name} is being created by another reducer, skipped.", "info")
+                continue
+            self.journal.remember_files(files)
+            job = DataJob(order=count,
+                          metadata_path=f,
+                          metadata=m,
+                          files=files,
+                          files_to_send=[file.path for file in files],
+                          collection_doi=m["collectionIds"])
+            job.sha1s = [{"name": uploaded[path]["name"], "sha1": uploaded[path]["sha1"]} for path in job.files_to_send]
+            job.local_sha1s = {path: uploaded[path]["local_sha1"] for path in job.files_to_send
+                               if uploaded[path].get("local_sha1")}
+            cli_log(f"All the shards of {name} are uploaded ({len(files)} files), creating the data.", "info")
+            yield job
+
+    def _report_stage(self, job: DataJob) -> None:
+        """Pipeline stage: save the report of the data, and append its rows to the
+        merged report of the batch if all the data are attached to the same collection.
+
+        :param job: the data created on Nakala (or not, see `job.error`)
+        :type job: DataJob
+        :return: None
+        :rtype: None
+        """
+        if job.error is not None:
+            self._report_failed(job)
+            return
+        collection_id = job.collection_doi
+        handle_data_id = job.data_doi
+        results_objects = [NakalaItem(sha1=sha1['sha1'],
+                                      original_name=sha1['name'],
+                                      data_doi=handle_data_id,
+                                      collection_doi=collection_id) for sha1 in job.sha1s]
+        # create an output dir if not exist based on m['name']
+        try:
+            name_project = job.metadata["name"]
+        except:
+            name_project = "project"
+        output_dir_project = os.path.join(output_dir, name_project)
+        if not os.path.exists(output_dir_project):
+            os.makedirs(output_dir_project)
+        name_report = None
+        try:
+            if collection_id in ["", None]:
+                name_report = f"data_{job.order}_{self.format_id(handle_data_id)}_mapping_ids_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            else:
+                name_report = f"data_{job.order}_{self.format_id(collection_id)}_{self.format_id(handle_data_id)}_mapping_ids_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            with get_report_writer(os.path.join(output_dir_project, name_report), self._report_format) as report:
+                report.write(results_objects)
+            name_report = os.path.basename(report.path)
+            if self._batch and self._same_collection_batch and collection_id not in ["", None]:
+                if self._merged_report is None:
+                    self._merged_report = get_report_writer(
+                        os.path.join(output_dir_project, f"merge_{self.format_id(collection_id)}_mapping_ids_all"),
+                        self._report_format)
+                self._merged_report.write(results_objects)
+        except Exception as e:
+            cli_log(f"Error when saving report: {e}", "error")
+
+        # the data is verified at the end of the run (see verify_data)
+        self._created.append(job)
+
+        # save report
+        cli_log(f"Data: {handle_data_id} created with success on Nakala. check output report: {name_report}", "success")
+
+    def _report_failed(self, job: DataJob) -> None:
+        """Save the report of a data not created: its files with the SHA-1 of the uploaded ones.
+        The data is recorded as failed in the journal (not as created), a next run retries it.
+
+        :param job: the data not created
+        :type job: DataJob
+        :return: None
+        :rtype: None
+        """
+        self._failed.append(job)
+        self.journal.record_failure(job.metadata_path, job.error)
+        output_dir_project = os.path.join(output_dir, job.metadata.get("name") or "project")
+        os.makedirs(output_dir_project, exist_ok=True)
+        name_report = f"data_{job.order}_failed_mapping_ids_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        try:
+            with get_report_writer(os.path.join(output_dir_project, name_report), self._report_format) as report:
+                report.write([NakalaItem(sha1=sha1["sha1"],
+                                         original_name=sha1["name"],
+                                         collection_doi=job.collection_doi) for sha1 in job.sha1s])
+            name_report = os.path.basename(report.path)
+        except Exception as e:
+            cli_log(f"Error when saving report: {e}", "error")
+        cli_log(f"Data of {os.path.basename(job.metadata_path)} not created: {job.error}. "
+                f"Run the batch again to retry it. Check output report: {name_report}", "error")
+
+    def verify_data(self) -> dict:
+        """Verify every data created during the run: the data are polled concurrently
+        until Nakala lists the files sent (or a deadline passes), then the results
+        are displayed and saved in one consolidated report.
+
+        :return: the consolidated report
+        :rtype: dict
+        """
+        if len(self._created) == 0:
+            return {}
+        verifier = BatchVerifier(self.nakala_sender.check_data_files_exist)
+        with msg.loading(f"Verifying {len(self._created)} data on Nakala..."):
+            report = verifier.verify(self._created)
+        for job in self._created:
+            if job.verification is None:
+                cli_log(f"Cannot run tests for {job.data_doi}, please check manually in Nakala", "warning")
+                continue
+            cli_log(f"🔍Results tests session for {job.data_doi}: ")
+            log_verification(job.verification)
+            print("-" * 50)
+        summary = report["summary"]
+        cli_log(f"Verification: {summary['verified']}/{summary['total']} data verified, "
+                f"{summary['inconsistent']} inconsistent, {summary['unavailable']} unavailable "
+                f"({summary['duration']:.2f} seconds). Report: {BatchVerifier.save(report, output_dir)}",
+                "success" if summary["verified"] == summary["total"] else "warning")
+        return report
+
+    def save_metrics(self, since: dict, duration: float) -> str:
+        """Save the summary of the metrics recorded during the run in output/metrics/
+        (the metrics of the process: with batches processed at the same time by
+        `nakalator watch`, the summary includes the other batches).
+
+        :param since: the snapshot of the metrics taken when the run started
+        :type since: dict
+        :param duration: the duration of the run (in seconds)
+        :type duration: float
+        :return: the path to the summary
+        :rtype: str
+        """
+        batch = os.path.splitext(os.path.basename(os.path.normpath(self._metadata_loc)))[0]
+        name = batch if self._shard is None else f"{batch}_shard-{self._shard[0]}-of-{self._shard[1]}"
+        path = get_metrics().save_summary(os.path.join(output_dir, METRICS_DIR),
+                                          name=name,
+                                          since=since,
+                                          batch=batch,
+                                          duration=round(duration, 2))
+        cli_log(f"Metrics of the run: {os.path.relpath(path, output_dir)}", "info")
+        return path
+
+    def run_shard(self) -> dict:
+        """Upload the files of this shard for every data of the batch (shard mode).
+        The data are created by the reducer (see `run_reduce`).
+
+        :return: the summary of the shard (data and files uploaded, duration)
+        :rtype: dict
+        """
+        self._sharded = []
+        metrics = get_metrics().snapshot()
+        start = time.time()
+        pipeline = Pipeline(stages=[("shard", self._shard_stage)], queue_size=PIPELINE_QUEUE_SIZE)
+        pipeline.run(self._upload_stage())
+        duration = time.time() - start
+        metrics_path = self.save_metrics(metrics, duration)
+        files = sum(len(job.sha1s) for job in self._sharded)
+        failed = sum(1 for job in self._sharded for result in job.sha1s if not result["sha1"])
+        cli_log(f"Shard {self._shard[0]}/{self._shard[1]} done: {len(self._sharded)} data, {files} files "
+                f"({failed} failed) in {duration:.2f} seconds.", "success" if failed == 0 else "warning")
+        return {
+            "shard": list(self._shard),
+            "datas": len(self._sharded),
+            "files": files,
+            "failed": failed,
+            "duration": round(duration, 2),
+            "metrics": metrics_path,
+        }
+
+    def run_reduce(self) -> dict:
+        """Create the data whose shards are all uploaded (shard mode), then report and
+        verify them as `run_data` does. The data still waiting for shards are left for
+        a next call.
+
+        :return: the summary of the run, with the metadata files still waiting for shards
+        :rtype: dict
+        """
+        summary = self.run_data(source=self._reduce_stage())
+        summary["waiting"] = [os.path.basename(f) for f in self._waiting_shards]
+        return summary
+
+    def run_data(self, source=None) -> dict:
+        """Run the data creation process.
+        The steps are pipelined: the files of all the data are uploaded in a
+        single worker pool while the data whose files have landed are created
+        on Nakala and reported. The data created are verified at the end of the run.
+
+        :param source: the data ready to be created (default: the uploads of the batch)
+        :type source: generator, optional
+        :return: the summary of the run (data created, verification, duration)
+        :rtype: dict
+        """
+        self._created = []
+        self._failed = []
+        self._merged_report = None
+        metrics = get_metrics().snapshot()
+        start_all_process = time.time()
+        pipeline = Pipeline(stages=[("create", self._create_stage),
+                                    ("report", self._report_stage)],
+                            queue_size=PIPELINE_QUEUE_SIZE)
+        try:
+            pipeline.run(source if source is not None else self._upload_stage())
+        finally:
+            # the merged report is up to date after each data, closing it completes the Parquet files
+            if self._merged_report is not None:
+                self._merged_report.close()
 
+        if self._merged_report is not None:
+            cli_log(f"Reports merged in one file: {os.path.basename(self._merged_report.path)} "
+                    f"({self._merged_report.rows} files)", "success")
 
-            # save report
-            cli_log(f"Data: {handle_data_id} created with success on Nakala. check output report: {name_report_csv}", "success")
+        # verification of the data created, out of the critical path of the uploads
+        verification = self.verify_data()
 
-            # if not the last metadata file wait 2 secs before next
-            if f != self.metadata_files_cache[-1][0]:
-                time.sleep(2)
+        # adaptive concurrency of the uploads during the run
+        if self.uploader is not None:
+            concurrency = self.uploader.concurrency_report()
+            cli_log(f"Upload concurrency at the end of the run: {concurrency['current']} "
+                    f"(history: {' → '.join(str(c['limit']) for c in concurrency['history'])})", "info")
+            for change in concurrency["history"]:
+                if change["reason"] not in ("start", "healthy"):
+                    cli_log(f"Concurrency reduced to {change['limit']} at {change['time']}: {change['reason']}",
+                            "warning")
 
-        if len(reports) > 1 and self._same_collection_batch:
-            collection_doi = self.format_id(results_objects[0].collection_doi)
-            merge_df_reports(sorted_reports=sorted(reports)[::-1],
-                             collection_doi=collection_doi,
-                             output_dir=output_dir_project)
-            cli_log(f"Reports merged in one file: merge_{collection_doi}_mapping_ids_all.csv", "success")
+        if self.deduplicator.saved_files > 0:
+            cli_log(f"Deduplication: {self.deduplicator.saved_files} files with an identical content were not "
+                    f"uploaded again ({format_size(self.deduplicator.saved_bytes)} saved).", "info")
 
         # time elapsed for all process
-        cli_log("⏳\tTime elapsed for all process: {:.2f} seconds".format(time.time() - start_all_process), "info")
+        duration = time.time() - start_all_process
+        metrics_path = self.save_metrics(metrics, duration)
+        cli_log("⏳\tTime elapsed for all process: {:.2f} seconds".format(duration), "info")
+        if len(self._failed) > 0:
+            cli_log(f"{len(self._failed)} data not created, run the batch again to retry them.", "error")
         cli_log(f"All process done! See you soon.", "success")
-        sys.exit(0)
+        return {
+            "datas": [{"metadata_file": os.path.basename(job.metadata_path),
+                       "data_doi": job.data_doi,
+                       "collection_doi": job.collection_doi} for job in self._created],
+            "failed": [{"metadata_file": os.path.basename(job.metadata_path),
+                        "error": job.error} for job in self._failed],
+            "verification": verification.get("summary", {}),
+            "duration": round(duration, 2),
+            "metrics": metrics_path,
+        }
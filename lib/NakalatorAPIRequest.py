@@ -3,18 +3,94 @@
 
 import requests
 import sys
-import time
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 
 from lib.constants import (
     NAKALA_ROUTES,
-    API_NAKALA_KEY_PROD,
-    API_NAKALA_KEY_TEST,
-    METADATA_AUTO
+    get_api_key,
+    get_metadata_auto,
+    HTTP_POOL_SIZE,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP_IDEMPOTENT_METHODS
 )
 from lib.utils.cli_utils import (
     cli_log,
     msg
 )
+from lib.utils.metrics_utils import get_metrics
+from lib.utils.rate_utils import get_rate_limiter
+from lib.utils.retry_utils import (
+    RetryableStatus,
+    get_circuit_breaker,
+    is_retryable_status,
+    retry_policy
+)
+
+# transport errors worth retrying
+RETRYABLE_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+
+class NakalaAPIError(Exception):
+    """Raised when Nakala refuses to create a resource (e.g. a data with files not uploaded).
+
+    :param message: the description of the error
+    :type message: str
+    :param status: the status code of the response
+    :type status: int
+    """
+    def __init__(self, message: str, status: int) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+def is_safe_to_resend(method: str, failure: Exception) -> bool:
+    """Whether a failed request can be sent again without creating a resource twice.
+    Idempotent methods always can. A POST (e.g. a data or a collection creation) may
+    have been processed by Nakala when its body was sent: it is only sent again when
+    Nakala refused it (429, 503 with `Retry-After`) or when the connection was never opened.
+
+    :param method: the HTTP method
+    :type method: str
+    :param failure: the retryable status or the transport error
+    :type failure: Exception
+    :return: True if the request can be sent again
+    :rtype: bool
+    """
+    if method.upper() in HTTP_IDEMPOTENT_METHODS:
+        return True
+    if isinstance(failure, RetryableStatus):
+        return failure.status == 429 or \
+            (failure.status == 503 and "Retry-After" in failure.response.headers)
+    if isinstance(failure, requests.ConnectTimeout):
+        return True
+    # urllib3 wraps the connection failures (refused, DNS, ...) raised before anything was sent
+    reason = getattr(failure.args[0], "reason", None) if failure.args else None
+    return isinstance(failure, requests.ConnectionError) and isinstance(reason, NewConnectionError)
+
+# One pooled session per Nakala environment
+_SESSIONS = {}
+
+
+def get_session(env: str = "test", pool_size: int = HTTP_POOL_SIZE) -> requests.Session:
+    """Get the HTTP session shared by all the requests sent to a Nakala environment.
+    Connections are kept alive and reused between requests.
+
+    :param env: the environment to use (default: "test")
+    :type env: str, optional
+    :param pool_size: the number of connections kept open per host
+    :type pool_size: int, optional
+    :return: the session of the environment
+    :rtype: requests.Session
+    """
+    if env not in _SESSIONS:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _SESSIONS[env] = session
+    return _SESSIONS[env]
 
 
 class NakalaAPIRequestBuilder:
@@ -22,9 +98,12 @@ class NakalaAPIRequestBuilder:
 
     :param env: the environment to use (default: "test")
     :type env: str, optional
+    :param pool_size: the number of connections kept open with the API (default: 20)
+    :type pool_size: int, optional
     """
     def __init__(self,
-                 env: str = "test"):
+                 env: str = "test",
+                 pool_size: int = HTTP_POOL_SIZE):
         """Initialize the NakalaAPIRequestBuilder class.
         :attr _api_key: the API key to use
         :type _api_key: str
@@ -34,13 +113,22 @@ class NakalaAPIRequestBuilder:
         :type _base_url: str
         :attr _api_url: the API URL to use
         :type _api_url: str
+        :attr _session: the pooled HTTP session of the environment
+        :type _session: requests.Session
+        :attr _rate_limiter: the rate limiter shared by all the Nakala API calls
+        :type _rate_limiter: RateLimiter
+        :attr _circuit_breaker: the circuit breaker shared by all the Nakala API calls
+        :type _circuit_breaker: CircuitBreaker
         """
-        self._api_key = API_NAKALA_KEY_PROD if env == "production" else API_NAKALA_KEY_TEST
+        self._api_key = get_api_key(env)
         self._headers = {
             "X-API-KEY": self._api_key,
             "accept": "application/json"
         }
         self._base_url, self._api_url = NAKALA_ROUTES[env].values()
+        self._session = get_session(env, pool_size=pool_size)
+        self._rate_limiter = get_rate_limiter()
+        self._circuit_breaker = get_circuit_breaker()
 
 
     @staticmethod
@@ -94,13 +182,9 @@ class NakalaAPIRequestBuilder:
             }
 
 
-            property_uris = [dic["propertyUri"] for dic in METADATA_AUTO]
-
-            for k, v in metadata_config["metadata"].items():
-                if k in property_uris:
-                    for dic in METADATA_AUTO:
-                        if dic["propertyUri"] == k:
-                            METADATA_AUTO.remove(dic)
+            # the metadata set in the metadata file replace the auto-generated ones
+            metadata_auto = [dic for dic in get_metadata_auto()
+                             if dic["propertyUri"] not in metadata_config["metadata"]]
 
             if "http://nakala.fr/terms#creator" in metadata_config["metadata"].keys():
                 # TODO: test if the creator is an ORCID
@@ -116,7 +200,7 @@ class NakalaAPIRequestBuilder:
                 metadata["collectionsIds"] = [metadata_config["collectionIds"]]
 
             # Ajouter les métadonnées auto-générées
-            metadata["metas"].extend(METADATA_AUTO)
+            metadata["metas"].extend(metadata_auto)
 
             return metadata
         except Exception as e:
@@ -124,6 +208,60 @@ class NakalaAPIRequestBuilder:
             sys.exit(1)
 
 
+    def send(self, method: str, endpoint: str, **kwargs) -> requests.Response:
+        """Send a request to the Nakala API with the shared retry policy.
+        Each attempt waits for the circuit breaker and the rate limiter of the
+        endpoint class. Retryable statuses (429, 5xx, ...) and network errors are
+        retried with decorrelated jitter (at least the `Retry-After` asked by Nakala),
+        as long as the request is safe to send again (see `is_safe_to_resend`);
+        other statuses are returned at once.
+
+        :param method: the HTTP method
+        :type method: str
+        :param endpoint: the endpoint to use
+        :type endpoint: str
+        :return: the response from the API (the last one if all the attempts failed)
+        :rtype: requests.Response
+        """
+        def log_retry(details: dict) -> None:
+            failure = details["exception"]
+            reason = failure.status if isinstance(failure, RetryableStatus) else type(failure).__name__
+            cli_log(f"Request {method} {endpoint} failed ({reason}), "
+                    f"retry {details['tries']} in {details['wait']:.1f} seconds.", "warning")
+
+        kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+
+        @retry_policy(RETRYABLE_ERRORS,
+                      on_backoff=log_retry,
+                      giveup=lambda failure: not is_safe_to_resend(method, failure))
+        def attempt() -> requests.Response:
+            self._circuit_breaker.wait()
+            self._rate_limiter.acquire(endpoint)
+            try:
+                response = self._session.request(method,
+                                                 f"{self._api_url}/{endpoint}",
+                                                 headers=self._headers,
+                                                 **kwargs)
+            except RETRYABLE_ERRORS as error:
+                self._circuit_breaker.record(error=error)
+                get_metrics().inc("nakalator_http_responses_total",
+                                  endpoint=self._rate_limiter.endpoint_class(endpoint), status="error")
+                raise
+            self._circuit_breaker.record(status=response.status_code)
+            get_metrics().inc("nakalator_http_responses_total",
+                              endpoint=self._rate_limiter.endpoint_class(endpoint), status=response.status_code)
+            retry_after = self._rate_limiter.backoff(endpoint,
+                                                     response.status_code,
+                                                     response.headers.get("Retry-After"))
+            if is_retryable_status(response.status_code):
+                raise RetryableStatus(response, response.status_code, retry_after)
+            return response
+
+        try:
+            return attempt()
+        except RetryableStatus as failure:
+            return failure.response
+
     def post_builder(self, endpoint: str, data: dict, files: dict = None) -> requests.Response:
         """Build a POST request to the Nakala API.
         :param endpoint: the endpoint to use
@@ -135,12 +273,7 @@ class NakalaAPIRequestBuilder:
         :return: the response from the API
         :rtype: requests.Response
         """
-        return requests.post(
-            f"{self._api_url}/{endpoint}",
-            json=data,
-            files=files,
-            headers=self._headers
-        )
+        return self.send("POST", endpoint, json=data, files=files)
 
     def get_builder(self, endpoint: str) -> requests.Response:
         """Build a GET request to the Nakala API.
@@ -149,10 +282,7 @@ class NakalaAPIRequestBuilder:
         :return: the response from the API
         :rtype: requests.Response
         """
-        return requests.get(
-            f"{self._api_url}/{endpoint}",
-            headers=self._headers
-        )
+        return self.send("GET", endpoint)
 
     def initialize_nakala_data(self, sha1s: list, metadata_config: dict = None) -> str:
         """Initialize the data creation on Nakala.
@@ -162,6 +292,7 @@ class NakalaAPIRequestBuilder:
         :type metadata_config: dict
         :return: the DOI of the data
         :rtype: str
+        :raises NakalaAPIError: if the data is not created
         """
         if metadata_config is None:
             metadata_config = {}
@@ -172,10 +303,9 @@ class NakalaAPIRequestBuilder:
                                         files=None)
         if handle_data.status_code == 201:
             return handle_data.json()['payload']['id']
-        else:
-            cli_log(f"Error when creating data: {handle_data.status_code} - {handle_data.text}", "error")
-            cli_log("Goodbye! check and try again.", "info")
-            sys.exit(1)
+        # the caller decides: the other data of a batch are still created
+        raise NakalaAPIError(f"Error when creating data: {handle_data.status_code} - {handle_data.text}",
+                             handle_data.status_code)
 
     def initialize_nakala_collection(self, collection_meta_from_user: dict = None) -> tuple:
         """Initialize the collection creation on Nakala.
@@ -188,7 +318,6 @@ class NakalaAPIRequestBuilder:
         if collection_meta_from_user is None:
             collection_meta_from_user = {}
         with msg.loading(f"Creating collection: '{collection_meta_from_user['collectionTitle']}'..."):
-            time.sleep(1)
             payload = self.prepare_payload_collection(collection_meta_from_user)
             response = self.post_builder("collections", data=payload, files=None)
         if response.status_code == 201:
@@ -206,6 +335,21 @@ class NakalaAPIRequestBuilder:
         else:
             return []
 
+    def get_collection_title(self, collection_id: str) -> tuple:
+        """Get the title of a collection on Nakala (safe to call from several threads).
+
+        :param collection_id: the ID of the collection
+        :type collection_id: str
+        :return: (title, None) if the collection exists, (None, error message) otherwise
+        :rtype: tuple
+        """
+        response = self.get_builder(f"collections/{collection_id}")
+        if response.status_code == 200:
+            return response.json()['metas'][0]['value'], None
+        if response.status_code == 404:
+            return None, f"Error: Collection with id: '{collection_id}' not found on Nakala"
+        return None, f"Error: {response.status_code} - {response.text}"
+
     def check_nakala_collection_exists(self, collection_id: str) -> str:
         """Check if a collection exists on Nakala.
 
@@ -215,13 +359,8 @@ class NakalaAPIRequestBuilder:
         :rtype: str
         """
         with msg.loading(f"Checking on Nakala for {collection_id}..."):
-            time.sleep(1)
-            response = self.get_builder(f"collections/{collection_id}")
-        if response.status_code == 200:
-            return response.json()['metas'][0]['value']
-        else:
-            if response.status_code == 404:
-                cli_log(f"Error: Collection with id: '{collection_id}' not found on Nakala", "error")
-            else:
-                cli_log(f"Error: {response.status_code} - {response.text}", "error")
+            title, error = self.get_collection_title(collection_id)
+        if error is not None:
+            cli_log(error, "error")
             sys.exit(1)
+        return title
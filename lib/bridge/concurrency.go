@@ -0,0 +1,135 @@
+package main
+
+import (
+	"fmt"
+	"net/http"
+	"sync"
+	"time"
+)
+
+const (
+	latencyTolerance = 2.0  // a request is "slow" when its cost is above tolerance x baseline
+	baselineDrift    = 1.01 // the baseline slowly drifts up so that it can recover after a fast period
+)
+
+// concurrencyChange is one entry of the concurrency history reported at the end of a run.
+type concurrencyChange struct {
+	Time   string `json:"time"`
+	Limit  int    `json:"limit"`
+	Reason string `json:"reason"`
+}
+
+// aimdLimiter limits the number of concurrent uploads with an AIMD strategy
+// (additive increase, multiplicative decrease): the limit grows by one after a full
+// window of healthy requests and is halved on timeouts, 5xx or 429 responses
+// (at most once per request duration, so that a burst of failures counts once).
+type aimdLimiter struct {
+	mu        sync.Mutex
+	cond      *sync.Cond
+	limit     int
+	minLimit  int
+	maxLimit  int
+	inFlight  int
+	successes int
+	baseline  float64 // lowest observed cost (seconds per MiB)
+	decreased time.Time
+	history   []concurrencyChange
+}
+
+func newAIMDLimiter(initial, minLimit, maxLimit int) *aimdLimiter {
+	if minLimit < 1 {
+		minLimit = 1
+	}
+	if maxLimit < minLimit {
+		maxLimit = minLimit
+	}
+	if initial < minLimit {
+		initial = minLimit
+	} else if initial > maxLimit {
+		initial = maxLimit
+	}
+	l := &aimdLimiter{limit: initial, minLimit: minLimit, maxLimit: maxLimit}
+	l.cond = sync.NewCond(&l.mu)
+	l.record("start")
+	return l
+}
+
+func (l *aimdLimiter) record(reason string) {
+	l.history = append(l.history, concurrencyChange{
+		Time:   time.Now().Format(time.RFC3339),
+		Limit:  l.limit,
+		Reason: reason,
+	})
+}
+
+// acquire blocks until a new upload can start.
+func (l *aimdLimiter) acquire() {
+	l.mu.Lock()
+	for l.inFlight >= l.limit {
+		l.cond.Wait()
+	}
+	l.inFlight++
+	l.mu.Unlock()
+}
+
+// release ends an upload and adapts the limit from its outcome.
+// The latency is normalized by the size of the file (with a floor of 1 MiB)
+// so that big files are not mistaken for a slow server.
+func (l *aimdLimiter) release(latency time.Duration, size int64, status int, err error) {
+	l.mu.Lock()
+	defer l.mu.Unlock()
+	l.inFlight--
+	defer l.cond.Broadcast()
+
+	if err != nil || status == http.StatusTooManyRequests || status >= 500 {
+		l.successes = 0
+		if l.limit > l.minLimit && time.Since(l.decreased) > latency {
+			l.decreased = time.Now()
+			l.limit = l.limit / 2
+			if l.limit < l.minLimit {
+				l.limit = l.minLimit
+			}
+			l.record(backoffReason(status, err))
+		}
+		return
+	}
+
+	mib := float64(size) / (1 << 20)
+	if mib < 1 {
+		mib = 1
+	}
+	cost := latency.Seconds() / mib
+	if l.baseline == 0 || cost < l.baseline {
+		l.baseline = cost
+	} else {
+		l.baseline *= baselineDrift
+	}
+	if cost > l.baseline*latencyTolerance {
+		l.successes = 0
+		return
+	}
+	l.successes++
+	if l.successes >= l.limit && l.limit < l.maxLimit {
+		l.limit++
+		l.successes = 0
+		l.record("healthy")
+	}
+}
+
+// current returns the current limit and a copy of its history.
+func (l *aimdLimiter) current() (int, []concurrencyChange) {
+	l.mu.Lock()
+	defer l.mu.Unlock()
+	return l.limit, append([]concurrencyChange(nil), l.history...)
+}
+
+func backoffReason(status int, err error) string {
+	switch {
+	case err != nil:
+		return fmt.Sprintf("error: %v", err)
+	case status == http.StatusTooManyRequests:
+		return "429 too many requests"
+	default:
+		return fmt.Sprintf("server error %d", status)
+	}
+}
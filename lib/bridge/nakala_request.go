@@ -1,7 +1,11 @@
 package main
 
+/*
+#include <stdlib.h>
+*/
 import "C"
 import (
+	"bufio"
 	"bytes"
 	"encoding/json"
 	"fmt"
@@ -19,106 +23,262 @@ import (
 
 const (
 	maxRetries = 10   // Number of retries in case of failure
-	maxWorkers = 20  // Number of concurrent uploads (go routines)
+	maxWorkers = 20  // Initial number of concurrent uploads (go routines)
+	minWorkers = 1   // Lower bound of the adaptive number of concurrent uploads
+	maxWorkersLimit = 100 // Upper bound of the adaptive number of concurrent uploads
 )
 
-func createFileCur(imagePath string) (map[string]io.Reader, error) {
+// Adaptive limit of concurrent uploads, shared by all the UploadFiles calls of a run.
+var limiter = newAIMDLimiter(maxWorkers, minWorkers, maxWorkersLimit)
+
+// Pace of the uploads (uploads endpoint class of the Nakala API rate limits).
+var uploadsBucket = newTokenBucket(20, 20)
+
+// One transport (connection pool) shared by all the uploads, so that connections
+// to Nakala are kept alive and reused instead of doing a TCP+TLS handshake per file.
+var transport = newTransport(maxWorkers, 90)
+var client = &http.Client{Transport: transport}
+
+func newTransport(maxIdleConnsPerHost, keepAliveSeconds int) *http.Transport {
+	t := http.DefaultTransport.(*http.Transport).Clone()
+	t.MaxIdleConns = maxIdleConnsPerHost
+	t.MaxIdleConnsPerHost = maxIdleConnsPerHost
+	t.MaxConnsPerHost = 0
+	t.IdleConnTimeout = time.Duration(keepAliveSeconds) * time.Second
+	return t
+}
+
+// ConfigureTransport replaces the shared transport, it must be called before UploadFiles.
+//
+//export ConfigureTransport
+func ConfigureTransport(maxIdleConnsPerHost, keepAliveSeconds C.int) {
+	transport.CloseIdleConnections()
+	transport = newTransport(int(maxIdleConnsPerHost), int(keepAliveSeconds))
+	client = &http.Client{Transport: transport}
+}
+
+// ConfigureConcurrency resets the adaptive concurrency limiter, it must be called before UploadFiles.
+//
+//export ConfigureConcurrency
+func ConfigureConcurrency(initial, minimum, maximum C.int) {
+	limiter = newAIMDLimiter(int(initial), int(minimum), int(maximum))
+}
+
+// ConfigureRateLimit resets the token bucket pacing the uploads (rate <= 0: unlimited),
+// it must be called before UploadFiles.
+//
+//export ConfigureRateLimit
+func ConfigureRateLimit(rate C.double, burst C.int) {
+	uploadsBucket = newTokenBucket(float64(rate), int(burst))
+}
+
+// ConfigureRetryPolicy sets the retry policy of the uploads and resets the circuit breaker,
+// it must be called before UploadFiles.
+//
+//export ConfigureRetryPolicy
+func ConfigureRetryPolicy(maxTries C.int, baseDelay, maxDelay C.double, threshold C.int, cooldown C.double) {
+	retries = retryPolicy{
+		maxTries:  int(maxTries),
+		baseDelay: time.Duration(float64(baseDelay) * float64(time.Second)),
+		maxDelay:  time.Duration(float64(maxDelay) * float64(time.Second)),
+	}
+	breaker = newCircuitBreaker(int(threshold), time.Duration(float64(cooldown)*float64(time.Second)))
+}
+
+// ConcurrencyReport returns the current concurrency limit and its history as JSON.
+//
+//export ConcurrencyReport
+func ConcurrencyReport() *C.char {
+	current, history := limiter.current()
+	report, _ := json.Marshal(map[string]interface{}{
+		"current": current,
+		"history": history,
+	})
+	return C.CString(string(report))
+}
+
+// createFileCur opens the file to upload and returns it with its size
+// (-1 when the size cannot be known in advance). The caller must close the file.
+func createFileCur(imagePath string) (*os.File, int64, error) {
 	file, err := os.Open(imagePath)
 	if err != nil {
-		return nil, err
+		return nil, 0, err
 	}
-	return map[string]io.Reader{filepath.Base(imagePath): file}, nil
+	info, err := file.Stat()
+	if err != nil {
+		file.Close()
+		return nil, 0, err
+	}
+	if !info.Mode().IsRegular() {
+		return file, -1, nil
+	}
+	return file, info.Size(), nil
 }
 
-func post(endpoint, apiKey string, data map[string]string, files map[string]io.Reader) (string, error) {
-	body := &bytes.Buffer{}
-	writer := multipart.NewWriter(body)
-
-	for key, r := range files {
-		part, err := writer.CreateFormFile("file", key)
-		if err != nil {
-			return "", err
-		}
-		_, err = io.Copy(part, r)
-		if err != nil {
-			return "", err
-		}
+func post(endpoint, apiKey string, data map[string]string, filePath string) (string, int, http.Header, error) {
+	file, size, err := createFileCur(filePath)
+	if err != nil {
+		return "", 0, nil, err
 	}
+	defer file.Close()
 
+	// Only the multipart envelope (fields, part headers and closing boundary) is built
+	// in memory, the file content is streamed from disk between the two halves.
+	envelope := &bytes.Buffer{}
+	writer := multipart.NewWriter(envelope)
 	for key, val := range data {
 		_ = writer.WriteField(key, val)
 	}
-
-	err := writer.Close()
+	_, err = writer.CreateFormFile("file", filepath.Base(filePath))
+	if err != nil {
+		return "", 0, nil, err
+	}
+	headLen := envelope.Len()
+	err = writer.Close()
 	if err != nil {
-		return "", err
+		return "", 0, nil, err
 	}
+	head := envelope.Bytes()[:headLen]
+	tail := envelope.Bytes()[headLen:]
 
+	body := io.MultiReader(bytes.NewReader(head), file, bytes.NewReader(tail))
 	req, err := http.NewRequest("POST", endpoint, body)
 	if err != nil {
-		return "", err
+		return "", 0, nil, err
+	}
+	if size >= 0 {
+		req.ContentLength = int64(len(head)) + size + int64(len(tail))
+	} else {
+		req.ContentLength = -1 // chunked transfer encoding
 	}
 	req.Header.Set("Content-Type", writer.FormDataContentType())
 	req.Header.Set("X-API-KEY", apiKey)
 	req.Header.Set("accept", "application/json")
 
-	client := &http.Client{}
 	resp, err := client.Do(req)
 	if err != nil {
-		return "", err
+		return "", 0, nil, err
 	}
 	defer resp.Body.Close()
 
 	respBody, err := io.ReadAll(resp.Body)
 	if err != nil {
-		return "", err
+		return "", resp.StatusCode, resp.Header, err
 	}
 
-	return string(respBody), nil
+	return string(respBody), resp.StatusCode, resp.Header, nil
+}
+
+// uploadResult is the outcome of the upload of one file.
+type uploadResult struct {
+	Index    int     `json:"index"`
+	Path     string  `json:"path"`
+	Name     string  `json:"name"`
+	SHA1     string  `json:"sha1"`
+	Bytes    int64   `json:"bytes"`
+	Duration float64 `json:"duration"`
+	Attempts int     `json:"attempts"`
 }
 
-func addFile(url, apiKey, filePath string) map[string]string {
+func addFile(url, apiKey, filePath string) uploadResult {
 	var response string
 	var err error
+	begin := time.Now()
+	// the name is the one the file gets on Nakala, the path identifies the file on disk
+	result := uploadResult{Path: filePath, Name: filepath.Base(filePath)}
 
-	for attempt := 1; attempt <= maxRetries; attempt++ {
-		fileMap, err := createFileCur(filePath)
-		if err != nil {
-			return map[string]string{"name": filePath, "sha1": ""}
+	info, err := os.Stat(filePath)
+	if err != nil {
+		return result
+	}
+	result.Bytes = info.Size()
+	var status int
+	var delay time.Duration
+	for attempt := 1; attempt <= retries.maxTries; attempt++ {
+		var header http.Header
+		result.Attempts = attempt
+		breaker.wait()
+		uploadsBucket.acquire()
+		// the same limiter is released, even if the library is reconfigured meanwhile
+		l := limiter
+		l.acquire()
+		start := time.Now()
+		response, status, header, err = post(url, apiKey, map[string]string{}, filePath)
+		l.release(time.Since(start), info.Size(), status, err)
+		breaker.record(status, err)
+		pause, throttled := retryAfter(status, header)
+		if throttled {
+			// the bucket waits for the time asked by Nakala
+			uploadsBucket.pause(pause)
 		}
-		response, err = post(url, apiKey, map[string]string{}, fileMap)
-		if err == nil {
+		if err == nil && !isRetryableStatus(status) {
 			break
 		}
-		time.Sleep(time.Duration(attempt) * 2 * time.Second) // exponential backoff
+		if attempt < retries.maxTries {
+			delay = retries.next(delay, pause)
+			time.Sleep(delay)
+		}
 	}
+	result.Duration = time.Since(begin).Seconds()
 
-	if err != nil {
-		return map[string]string{"name": filePath, "sha1": ""}
+	// transport error, fatal status (e.g. 401, 413) or all the attempts failed
+	if err != nil || status < 200 || status >= 300 {
+		return result
 	}
-	var result map[string]string
-	json.Unmarshal([]byte(response), &result)
-	result["name"] = filepath.Base(filePath)
+	var payload map[string]string
+	if json.Unmarshal([]byte(response), &payload) != nil {
+		return result
+	}
+	result.SHA1 = payload["sha1"]
 	return result
 }
 
-//export UploadFiles
-func UploadFiles(url, apiKey *C.char, filePaths **C.char, length C.int) *C.char {
-	goURL := C.GoString(url)
-	goAPIKey := C.GoString(apiKey)
+func cFilePaths(filePaths **C.char, length C.int) []string {
 	goFilePaths := make([]string, length)
 	ptr := uintptr(unsafe.Pointer(filePaths))
 	for i := 0; i < int(length); i++ {
 		goFilePaths[i] = C.GoString(*(**C.char)(unsafe.Pointer(ptr)))
 		ptr += unsafe.Sizeof(ptr)
 	}
+	return goFilePaths
+}
 
+// uploadAll uploads the files concurrently and calls onResult as soon as each file is done.
+// Results are not kept: the caller decides what to retain.
+func uploadAll(url, apiKey string, filePaths []string, onResult func(uploadResult)) {
 	var wg sync.WaitGroup
+	// at most one goroutine per possible concurrent upload, so that memory does not grow
+	// with the number of files; the number of concurrent uploads is limited by the
+	// adaptive limiter in addFile
+	slots := make(chan struct{}, limiter.maxLimit)
+
+	for i, filePath := range filePaths {
+		wg.Add(1)
+		slots <- struct{}{}
+		go func(i int, filePath string) {
+			defer wg.Done()
+			defer func() { <-slots }()
+
+			result := addFile(url, apiKey, filePath)
+			result.Index = i
+			onResult(result)
+		}(i, filePath)
+	}
+	wg.Wait()
+}
+
+// FreeCString frees a string returned by the library (UploadFiles, ConcurrencyReport).
+//
+//export FreeCString
+func FreeCString(str *C.char) {
+	C.free(unsafe.Pointer(str))
+}
+
+//export UploadFiles
+func UploadFiles(url, apiKey *C.char, filePaths **C.char, length C.int) *C.char {
+	goFilePaths := cFilePaths(filePaths, length)
 	var processedCount int32
 	totalFiles := len(goFilePaths)
-	responses := make([]map[string]string, totalFiles)
-
-	sem := make(chan struct{}, maxWorkers) // semaphore to limit the number of concurrent uploads
 
 	bar := progressbar.NewOptions(totalFiles,
         progressbar.OptionSetDescription("Uploading files to Nakala..."),
@@ -128,25 +288,53 @@ func UploadFiles(url, apiKey *C.char, filePaths **C.char, length C.int) *C.char
         progressbar.OptionClearOnFinish(),
     )
 
-	for i, filePath := range goFilePaths {
-		wg.Add(1)
-		go func(i int, filePath string) {
-			defer wg.Done()
-			sem <- struct{}{} // get a token
-			defer func() { <-sem }() // release the token
-
-			responses[i] = addFile(goURL, goAPIKey, filePath)
-			atomic.AddInt32(&processedCount, 1)
+	responses := make([]map[string]string, totalFiles)
+	var mu sync.Mutex
+	uploadAll(C.GoString(url), C.GoString(apiKey), goFilePaths, func(result uploadResult) {
+		atomic.AddInt32(&processedCount, 1)
+		mu.Lock()
+		responses[result.Index] = map[string]string{"name": result.Name, "sha1": result.SHA1}
+		mu.Unlock()
 
-			// Mise à jour de la barre de progression
-			bar.Add(1)
-		}(i, filePath)
-	}
-	wg.Wait()
+		// Mise à jour de la barre de progression
+		bar.Add(1)
+	})
 	fmt.Println()
 
 	jsonResponses, _ := json.Marshal(responses)
+	// the caller must free the string with FreeCString
 	return C.CString(string(jsonResponses))
 }
 
+// UploadFilesNDJSON uploads the files like UploadFiles but, instead of returning all the
+// results at the end, it writes each result as one JSON line (NDJSON) to the file
+// descriptor fd (e.g. the write end of a pipe) as soon as the file is done. The descriptor
+// is closed at the end, which marks the end of the stream. Results are not kept in memory.
+// Nothing is written to stdout, progress is left to the caller.
+//
+//export UploadFilesNDJSON
+func UploadFilesNDJSON(url, apiKey *C.char, filePaths **C.char, length C.int, fd C.int) {
+	out := os.NewFile(uintptr(fd), "results")
+	defer out.Close()
+	writer := bufio.NewWriter(out)
+	var mu sync.Mutex
+	broken := false
+	uploadAll(C.GoString(url), C.GoString(apiKey), cFilePaths(filePaths, length), func(result uploadResult) {
+		line, _ := json.Marshal(result)
+		mu.Lock()
+		defer mu.Unlock()
+		if broken {
+			// the reader is gone, the remaining results are dropped
+			return
+		}
+		if _, err := writer.Write(append(line, '\n')); err != nil {
+			broken = true
+			return
+		}
+		if err := writer.Flush(); err != nil {
+			broken = true
+		}
+	})
+}
+
 func main() {}
@@ -19,6 +19,11 @@ typedef struct { const char *p; ptrdiff_t n; } _GoString_;
 /* Start of preamble from import "C" comments.  */
 
 
+#line 3 "nakala_request.go"
+
+#include <stdlib.h>
+
+#line 1 "cgo-generated-wrapper"
 
 
 /* End of preamble from import "C" comments.  */
@@ -74,8 +79,42 @@ typedef struct { void *data; GoInt len; GoInt cap; } GoSlice;
 extern "C" {
 #endif
 
+
+// ConfigureTransport replaces the shared transport, it must be called before UploadFiles.
+//
+extern void ConfigureTransport(int maxIdleConnsPerHost, int keepAliveSeconds);
+
+// ConfigureConcurrency resets the adaptive concurrency limiter, it must be called before UploadFiles.
+//
+extern void ConfigureConcurrency(int initial, int minimum, int maximum);
+
+// ConfigureRateLimit resets the token bucket pacing the uploads (rate <= 0: unlimited),
+// it must be called before UploadFiles.
+//
+extern void ConfigureRateLimit(double rate, int burst);
+
+// ConfigureRetryPolicy sets the retry policy of the uploads and resets the circuit breaker,
+// it must be called before UploadFiles.
+//
+extern void ConfigureRetryPolicy(int maxTries, double baseDelay, double maxDelay, int threshold, double cooldown);
+
+// ConcurrencyReport returns the current concurrency limit and its history as JSON.
+//
+extern char* ConcurrencyReport();
+
+// FreeCString frees a string returned by the library (UploadFiles, ConcurrencyReport).
+//
+extern void FreeCString(char* str);
 extern char* UploadFiles(char* url, char* apiKey, char** filePaths, int length);
 
+// UploadFilesNDJSON uploads the files like UploadFiles but, instead of returning all the
+// results at the end, it writes each result as one JSON line (NDJSON) to the file
+// descriptor fd (e.g. the write end of a pipe) as soon as the file is done. The descriptor
+// is closed at the end, which marks the end of the stream. Results are not kept in memory.
+// Nothing is written to stdout, progress is left to the caller.
+//
+extern void UploadFilesNDJSON(char* url, char* apiKey, char** filePaths, int length, int fd);
+
 #ifdef __cplusplus
 }
 #endif
@@ -2,11 +2,16 @@ import os
 import ctypes
 import json
 import platform
+import threading
+from functools import lru_cache
 
 
+@lru_cache(maxsize=None)
 def init_lib() -> dict:
     """Initialize the go library to be used in python
     and define the functions available in the library.
+    The library is loaded on the first call only (i.e. when the go engine uploads files),
+    so the CLI starts even if the library is not available on the machine.
 
     :return: the functions available in the library
     :rtype: dict
@@ -19,7 +24,7 @@ def init_lib() -> dict:
     elif system == "Darwin":  # macOS
         lib_ext = ".dylib"
     else:
-        raise f"Unsupported OS: {system}"
+        raise OSError(f"Unsupported OS: {system}")
 
     so_file = os.path.join(
         os.path.dirname(os.path.abspath(__file__)),
@@ -28,10 +33,33 @@ def init_lib() -> dict:
     lib = ctypes.CDLL(so_file)
     # Define the functions signature
     lib.UploadFiles.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_char_p), ctypes.c_int]
-    lib.UploadFiles.restype = ctypes.c_char_p
+    # strings returned by the library are freed with FreeCString (see take_go_string)
+    lib.UploadFiles.restype = ctypes.c_void_p
+    lib.UploadFilesNDJSON.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_char_p), ctypes.c_int,
+                                      ctypes.c_int]
+    lib.UploadFilesNDJSON.restype = None
+    lib.FreeCString.argtypes = [ctypes.c_void_p]
+    lib.FreeCString.restype = None
+    lib.ConfigureTransport.argtypes = [ctypes.c_int, ctypes.c_int]
+    lib.ConfigureTransport.restype = None
+    lib.ConfigureConcurrency.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int]
+    lib.ConfigureConcurrency.restype = None
+    lib.ConfigureRateLimit.argtypes = [ctypes.c_double, ctypes.c_int]
+    lib.ConfigureRateLimit.restype = None
+    lib.ConfigureRetryPolicy.argtypes = [ctypes.c_int, ctypes.c_double, ctypes.c_double, ctypes.c_int, ctypes.c_double]
+    lib.ConfigureRetryPolicy.restype = None
+    lib.ConcurrencyReport.argtypes = []
+    lib.ConcurrencyReport.restype = ctypes.c_void_p
     # Declare the functions available
     return {
         "UploadFiles": lib.UploadFiles,
+        "UploadFilesNDJSON": lib.UploadFilesNDJSON,
+        "FreeCString": lib.FreeCString,
+        "ConfigureTransport": lib.ConfigureTransport,
+        "ConfigureConcurrency": lib.ConfigureConcurrency,
+        "ConfigureRateLimit": lib.ConfigureRateLimit,
+        "ConfigureRetryPolicy": lib.ConfigureRetryPolicy,
+        "ConcurrencyReport": lib.ConcurrencyReport,
     }
 
 
@@ -56,10 +84,94 @@ def encode_ctypes_upload_files(url: str,
     )
 
 
-NAKALA_BATCH_GO_LIB = init_lib()
+# easy bridges to Python
+def take_go_string(pointer: int) -> str:
+    """Copy a string returned by the go library and free it.
+
+    :param pointer: the address of the string
+    :type pointer: int
+    :return: the string
+    :rtype: str
+    """
+    try:
+        return ctypes.string_at(pointer).decode('utf-8')
+    finally:
+        init_lib()["FreeCString"](pointer)
+
+
+def configure_go_transport(pool_size: int, keep_alive: int) -> None:
+    """Configure the connection pool shared by all the uploads of the go library.
+
+    :param pool_size: the number of idle connections kept open per host
+    :type pool_size: int
+    :param keep_alive: the idle time (in seconds) before closing a connection
+    :type keep_alive: int
+    :return: None
+    :rtype: None
+    """
+    init_lib()["ConfigureTransport"](pool_size, keep_alive)
+
+
+def configure_go_concurrency(initial: int, minimum: int, maximum: int) -> None:
+    """Configure the adaptive limit of concurrent uploads of the go library.
+
+    :param initial: the initial number of concurrent uploads
+    :type initial: int
+    :param minimum: the lower bound of the number of concurrent uploads
+    :type minimum: int
+    :param maximum: the upper bound of the number of concurrent uploads
+    :type maximum: int
+    :return: None
+    :rtype: None
+    """
+    init_lib()["ConfigureConcurrency"](initial, minimum, maximum)
+
+
+def configure_go_rate_limit(rate: float, burst: int) -> None:
+    """Configure the token bucket pacing the uploads of the go library.
+
+    :param rate: the number of uploads started per second (0: unlimited)
+    :type rate: float
+    :param burst: the maximum number of uploads started at once
+    :type burst: int
+    :return: None
+    :rtype: None
+    """
+    init_lib()["ConfigureRateLimit"](rate, burst)
+
+
+def configure_go_retry_policy(max_tries: int,
+                              base_delay: float,
+                              max_delay: float,
+                              threshold: int,
+                              cooldown: float) -> None:
+    """Configure the retry policy and the circuit breaker of the uploads of the go library.
+
+    :param max_tries: the maximum number of attempts per file
+    :type max_tries: int
+    :param base_delay: the minimum delay (in seconds) between two attempts
+    :type base_delay: float
+    :param max_delay: the maximum delay (in seconds) between two attempts
+    :type max_delay: float
+    :param threshold: the number of consecutive failures opening the circuit
+    :type threshold: int
+    :param cooldown: the pause (in seconds) of the uploads while the circuit is open
+    :type cooldown: float
+    :return: None
+    :rtype: None
+    """
+    init_lib()["ConfigureRetryPolicy"](max_tries, base_delay, max_delay, threshold, cooldown)
+
+
+def go_concurrency_report() -> dict:
+    """Get the current number of concurrent uploads of the go library and its history.
+
+    :return: the concurrency report
+    :rtype: dict
+    """
+    return json.loads(take_go_string(init_lib()["ConcurrencyReport"]()))
 
 
-# easy bridges to Python
 def process_nkl_files_with_go(url: str,
                               api_key: str,
                               file_paths: list[str]) -> dict:
@@ -75,8 +187,40 @@ def process_nkl_files_with_go(url: str,
     :rtype: dict
     """
     return json.loads(
-        NAKALA_BATCH_GO_LIB["UploadFiles"](
+        take_go_string(init_lib()["UploadFiles"](
             *encode_ctypes_upload_files(url, api_key, file_paths),
             len(file_paths)
-        ).decode('utf-8')
+        ))
     )
+
+
+def iter_nkl_files_with_go(url: str,
+                           api_key: str,
+                           file_paths: list[str]):
+    """Process the files with the go library and yield each result as soon as the
+    file is uploaded ({index, path, name, sha1, bytes, duration, attempts}, in completion order).
+    The go library writes the results as NDJSON to a pipe read line by line,
+    so memory does not grow with the number of files.
+
+    :param url: the url of the Nakala API
+    :type url: str
+    :param api_key: the api key to use the Nakala API
+    :type api_key: str
+    :param file_paths: the paths to the files to upload
+    :type file_paths: list[str]
+    :return: the results
+    :rtype: generator
+    """
+    read_fd, write_fd = os.pipe()
+    # the go library owns the write end and closes it at the end of the uploads
+    upload = threading.Thread(target=init_lib()["UploadFilesNDJSON"],
+                              args=(*encode_ctypes_upload_files(url, api_key, file_paths),
+                                    len(file_paths),
+                                    write_fd),
+                              name="go-upload",
+                              daemon=True)
+    upload.start()
+    with os.fdopen(read_fd, 'rb') as results:
+        for line in results:
+            yield json.loads(line)
+    upload.join()
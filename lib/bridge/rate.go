@@ -0,0 +1,104 @@
+package main
+
+import (
+	"net/http"
+	"strconv"
+	"sync"
+	"time"
+)
+
+const retryAfterMax = 300 * time.Second // upper bound of a pause asked by Nakala
+
+// tokenBucket paces the start of the uploads (rate per second, with bursts of up to burst
+// uploads). It mirrors the Python rate limiter (lib/utils/rate_utils.py) and is paused
+// when Nakala answers 429/503 with a Retry-After header.
+type tokenBucket struct {
+	mu          sync.Mutex
+	rate        float64
+	burst       float64
+	tokens      float64
+	updated     time.Time
+	pausedUntil time.Time
+}
+
+func newTokenBucket(rate float64, burst int) *tokenBucket {
+	if burst < 1 {
+		burst = 1
+	}
+	return &tokenBucket{rate: rate, burst: float64(burst), tokens: float64(burst), updated: time.Now()}
+}
+
+// take returns 0 when a token was taken, otherwise the delay to wait before retrying.
+func (b *tokenBucket) take() time.Duration {
+	b.mu.Lock()
+	defer b.mu.Unlock()
+	if b.rate <= 0 {
+		return 0 // unlimited
+	}
+	now := time.Now()
+	if now.Before(b.pausedUntil) {
+		return b.pausedUntil.Sub(now)
+	}
+	if now.After(b.updated) {
+		b.tokens += now.Sub(b.updated).Seconds() * b.rate
+		if b.tokens > b.burst {
+			b.tokens = b.burst
+		}
+		b.updated = now
+	}
+	if b.tokens >= 1 {
+		b.tokens--
+		return 0
+	}
+	return time.Duration((1 - b.tokens) / b.rate * float64(time.Second))
+}
+
+func (b *tokenBucket) acquire() {
+	for {
+		delay := b.take()
+		if delay <= 0 {
+			return
+		}
+		time.Sleep(delay)
+	}
+}
+
+func (b *tokenBucket) pause(delay time.Duration) {
+	b.mu.Lock()
+	defer b.mu.Unlock()
+	until := time.Now().Add(delay)
+	if until.After(b.pausedUntil) {
+		b.pausedUntil = until
+	}
+	// no burst when the pause ends
+	b.tokens = 0
+	if b.pausedUntil.After(b.updated) {
+		b.updated = b.pausedUntil
+	}
+}
+
+// retryAfter returns the pause asked by Nakala on 429/503 responses (Retry-After in seconds or HTTP date).
+func retryAfter(status int, header http.Header) (time.Duration, bool) {
+	if status != http.StatusTooManyRequests && status != http.StatusServiceUnavailable {
+		return 0, false
+	}
+	value := header.Get("Retry-After")
+	if value == "" {
+		return 0, false
+	}
+	var delay time.Duration
+	if seconds, err := strconv.ParseFloat(value, 64); err == nil {
+		delay = time.Duration(seconds * float64(time.Second))
+	} else if date, err := http.ParseTime(value); err == nil {
+		delay = time.Until(date)
+	} else {
+		return 0, false
+	}
+	if delay < 0 {
+		delay = 0
+	}
+	if delay > retryAfterMax {
+		delay = retryAfterMax
+	}
+	return delay, true
+}
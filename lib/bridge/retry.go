@@ -0,0 +1,94 @@
+package main
+
+import (
+	"math/rand"
+	"sync"
+	"time"
+)
+
+// retryPolicy mirrors the Python retry policy (lib/utils/retry_utils.py): retryable
+// statuses and transport errors are retried with decorrelated jitter.
+type retryPolicy struct {
+	maxTries  int
+	baseDelay time.Duration
+	maxDelay  time.Duration
+}
+
+var retries = retryPolicy{maxTries: maxRetries, baseDelay: time.Second, maxDelay: time.Minute}
+
+// Circuit breaker shared by all the uploads, it pauses them while Nakala is unavailable.
+var breaker = newCircuitBreaker(5, 30*time.Second)
+
+// isRetryableStatus reports whether a response status is worth retrying (overload or temporary failure).
+func isRetryableStatus(status int) bool {
+	switch status {
+	case 408, 425, 429, 500, 502, 503, 504:
+		return true
+	}
+	return false
+}
+
+// next returns the delay before the next attempt: drawn between the base delay and
+// 3 times the previous delay (bounded by the max delay), at least the pause asked by Nakala.
+func (p retryPolicy) next(previous, retryAfter time.Duration) time.Duration {
+	if previous < p.baseDelay {
+		previous = p.baseDelay
+	}
+	upper := 3 * previous
+	delay := p.baseDelay
+	if upper > p.baseDelay {
+		delay += time.Duration(rand.Int63n(int64(upper - p.baseDelay)))
+	}
+	if delay > p.maxDelay {
+		delay = p.maxDelay
+	}
+	if retryAfter > delay {
+		delay = retryAfter
+	}
+	return delay
+}
+
+// circuitBreaker opens after threshold consecutive outage failures (5xx or transport errors):
+// every upload then waits cooldown before a new attempt is let through.
+type circuitBreaker struct {
+	mu        sync.Mutex
+	threshold int
+	cooldown  time.Duration
+	failures  int
+	openUntil time.Time
+}
+
+func newCircuitBreaker(threshold int, cooldown time.Duration) *circuitBreaker {
+	if threshold < 1 {
+		threshold = 1
+	}
+	return &circuitBreaker{threshold: threshold, cooldown: cooldown}
+}
+
+func (b *circuitBreaker) wait() {
+	for {
+		b.mu.Lock()
+		delay := time.Until(b.openUntil)
+		b.mu.Unlock()
+		if delay <= 0 {
+			return
+		}
+		time.Sleep(delay)
+	}
+}
+
+func (b *circuitBreaker) record(status int, err error) {
+	b.mu.Lock()
+	defer b.mu.Unlock()
+	if err == nil && status < 500 {
+		b.failures = 0
+		return
+	}
+	b.failures++
+	now := time.Now()
+	if b.failures < b.threshold || now.Before(b.openUntil) {
+		return
+	}
+	b.openUntil = now.Add(b.cooldown)
+	b.failures = 0
+}
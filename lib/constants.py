@@ -7,6 +7,7 @@ This module contains the constants used in the Nakalator project.
 """
 import os
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 
 import yaml
@@ -25,19 +26,41 @@ output_dir = Path(os.getcwd()) / "output"
 
 credentials_path = Path(os.getcwd()) / "credentials.yml"
 
-try:
-    credentials = load_yaml(str(credentials_path))
-except yaml.YAMLError as exc:
-    credentials = {}
-except FileNotFoundError as exc:
-    credentials = {}
 
-try:
-    API_NAKALA_KEY_TEST = credentials["API_NAKALA_KEY_TEST"]
-    API_NAKALA_KEY_PROD = credentials["API_NAKALA_KEY_PROD"]
-except KeyError as exc:
-    API_NAKALA_KEY_TEST = ""
-    API_NAKALA_KEY_PROD = ""
+@lru_cache(maxsize=None)
+def get_credentials() -> dict:
+    """Read credentials.yml, once and only when a Nakala API key is needed
+    (e.g. not for `nakalator --help` or `nakalator init`).
+
+    :return: the content of credentials.yml (empty if the file is missing or invalid)
+    :rtype: dict
+    """
+    try:
+        return load_yaml(str(credentials_path)) or {}
+    except (yaml.YAMLError, FileNotFoundError):
+        return {}
+
+
+def get_api_key(env: str) -> str:
+    """Get the Nakala API key of an environment.
+
+    :param env: the environment ("test" or "production")
+    :type env: str
+    :return: the API key (empty if not set in credentials.yml)
+    :rtype: str
+    """
+    name = "API_NAKALA_KEY_PROD" if env == "production" else "API_NAKALA_KEY_TEST"
+    return get_credentials().get(name, "")
+
+
+def __getattr__(name: str):
+    # API_NAKALA_KEY_TEST / API_NAKALA_KEY_PROD are read from credentials.yml on first access
+    if name == "API_NAKALA_KEY_TEST":
+        return get_api_key("test")
+    if name == "API_NAKALA_KEY_PROD":
+        return get_api_key("production")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 NAKALA_ROUTES = {
     "production": {
@@ -50,33 +73,123 @@ NAKALA_ROUTES = {
     },
 }
 
-METADATA_AUTO = [
-    {
-        "value": "",
-        "lang":"fr",
-        "typeUri": "http://www.w3.org/2001/XMLSchema#string",
-        "propertyUri": "http://nakala.fr/terms#creator"
-    },
-    {
-        "value": datetime.now().strftime("%Y-%m-%d"),
-        "typeUri": "http://www.w3.org/2001/XMLSchema#string",
-        "propertyUri": "http://nakala.fr/terms#created"
-    },
-    {
-        "value": "CC-BY-4.0",
-        "typeUri": "http://www.w3.org/2001/XMLSchema#string",
-        "propertyUri": "http://nakala.fr/terms#license"
-    },
-    {
-        "value": "http://purl.org/coar/resource_type/c_c513",
-        "lang": "",
-        "typeUri": "http://www.w3.org/2001/XMLSchema#anyURI",
-        "propertyUri": "http://nakala.fr/terms#type"
-    },
-    {
-        "value": "École nationale des chartes - PSL",
-        "lang": "fr",
-        "typeUri": "http://www.w3.org/2001/XMLSchema#string",
-        "propertyUri": "http://purl.org/dc/terms/publisher"
-    },
-]
+# Upload engines settings
+UPLOAD_ENGINE_DEFAULT = "go"
+UPLOAD_MAX_WORKERS = 20  # initial number of concurrent uploads (adapted during the run)
+UPLOAD_MIN_WORKERS = 1  # lower bound of the adaptive number of concurrent uploads
+UPLOAD_WORKERS_LIMIT = 100  # upper bound of the adaptive number of concurrent uploads
+UPLOAD_MAX_RETRIES = 10  # number of retries in case of failure
+
+# Files discovery: system files never sent (hidden files starting with "." are ignored too)
+IGNORED_FILES = ("Thumbs.db", "desktop.ini", "Desktop.ini")
+# Extensions accepted for each `data.type` of the metadata files (other types: the type itself)
+EXTENSION_ALIASES = {
+    "jpg": ("jpg", "jpeg"),
+    "jpeg": ("jpg", "jpeg"),
+    "tif": ("tif", "tiff"),
+    "tiff": ("tif", "tiff"),
+}
+
+# Batch pipeline: number of data waiting between two steps (upload, creation, report/tests)
+PIPELINE_QUEUE_SIZE = 2
+
+# Client-side rate limits of the Nakala API per endpoint class: (requests per second, burst)
+API_RATE_LIMITS = {
+    "uploads": (20, 20),
+    "datas": (1, 2),
+    "collections": (1, 1),
+}
+RETRY_AFTER_STATUSES = (429, 503)  # responses whose Retry-After header pauses the endpoint class
+RETRY_AFTER_MAX = 300  # upper bound (in seconds) of a pause asked by Nakala
+
+# Retry policy of the Nakala API calls (decorrelated jitter) and circuit breaker
+RETRY_MAX_TRIES = 8  # maximum number of attempts of a request
+RETRY_BASE_DELAY = 1  # minimum delay (in seconds) between two attempts
+RETRY_MAX_DELAY = 60  # maximum delay (in seconds) between two attempts
+RETRYABLE_STATUSES = (408, 425, 429, 500, 502, 503, 504)  # other error statuses are fatal
+CIRCUIT_BREAKER_THRESHOLD = 5  # consecutive failures (5xx, network errors) pausing every request
+CIRCUIT_BREAKER_COOLDOWN = 30  # pause (in seconds) of every request when Nakala is unavailable
+
+# Verification phase at the end of a batch: the data created are polled until they are consistent
+VERIFY_WORKERS = 4  # number of data polled at the same time
+VERIFY_DEADLINE = 300  # maximum duration (in seconds) of the verification phase
+VERIFY_BASE_DELAY = 2  # delay (in seconds) before polling a data again, doubled at each poll
+VERIFY_MAX_DELAY = 30  # maximum delay (in seconds) between two polls of a data
+
+# Collections checked on Nakala (cached in the upload journal)
+COLLECTION_CACHE_TTL = 24 * 3600  # time (in seconds) during which a collection checked is not checked again
+COLLECTION_CHECK_WORKERS = 4  # number of collections checked at the same time
+
+# Watch mode (`nakalator watch`): batches of metadatas/ marked as ready are processed as they come
+WATCH_READY_FILE = ".ready"  # file created in metadatas/<batch>/ when the batch is complete
+WATCH_INTERVAL = 10  # time (in seconds) between two scans of metadatas/
+WATCH_MAX_BATCHES = 1  # number of batches processed at the same time
+WATCH_STATUS_DIR = "watch"  # directory of the status of each batch (in output/)
+
+# Shard mode (`nakalator shard` / `nakalator reduce`): the files of a batch are uploaded by several workers
+SHARDS_DIR = "shards"  # directory of the results of the shards (in output/, must be shared by the workers)
+SHARD_LOCK_TIMEOUT = 3600  # age (in seconds) from which the lock of a data not created is considered as stale
+
+# Number of processes used to compute the SHA-1 of the files locally
+HASH_WORKERS = os.cpu_count() or 1
+
+# Parsing of the metadata files (cached in the upload journal by path, size and mtime)
+METADATA_WORKERS = os.cpu_count() or 1  # number of processes parsing the metadata files
+METADATA_PARALLEL_MIN = 200  # number of metadata files to parse from which processes are used
+
+# Upload journal (SQLite database in output/) used to resume interrupted runs
+JOURNAL_FILENAME = "upload_journal.sqlite"
+
+# Mapping reports (output/<name>/), appended as the data are created
+REPORT_FORMAT_DEFAULT = "csv"
+REPORT_FORMATS = ("csv", "jsonl", "parquet")  # parquet requires pyarrow
+
+# Metrics of the runs (output/metrics/): Prometheus textfile, optional /metrics endpoint and JSON summaries
+METRICS_DIR = "metrics"  # directory of the metrics (in output/), e.g. for the textfile collector of node_exporter
+METRICS_INTERVAL = 15  # time (in seconds) between two writes of the Prometheus textfile
+
+# HTTP connections settings (shared by all the Nakala API calls)
+HTTP_POOL_SIZE = 20  # number of connections kept open per host
+HTTP_KEEP_ALIVE = 90  # idle time (in seconds) before closing a kept-alive connection
+HTTP_CONNECT_TIMEOUT = 10  # maximum time (in seconds) to open a connection to the API
+HTTP_READ_TIMEOUT = 120  # maximum time (in seconds) without receiving any byte of a response
+HTTP_IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")  # requests always safe to send again
+
+def get_metadata_auto() -> list:
+    """Get the metadata added to each data when the metadata file does not set them.
+    A new list is built for each payload: the creation date is the day of the payload
+    (not of the start of a long-running `nakalator watch`) and a payload can change it.
+
+    :return: the automatic metadata
+    :rtype: list
+    """
+    return [
+        {
+            "value": "",
+            "lang":"fr",
+            "typeUri": "http://www.w3.org/2001/XMLSchema#string",
+            "propertyUri": "http://nakala.fr/terms#creator"
+        },
+        {
+            "value": datetime.now().strftime("%Y-%m-%d"),
+            "typeUri": "http://www.w3.org/2001/XMLSchema#string",
+            "propertyUri": "http://nakala.fr/terms#created"
+        },
+        {
+            "value": "CC-BY-4.0",
+            "typeUri": "http://www.w3.org/2001/XMLSchema#string",
+            "propertyUri": "http://nakala.fr/terms#license"
+        },
+        {
+            "value": "http://purl.org/coar/resource_type/c_c513",
+            "lang": "",
+            "typeUri": "http://www.w3.org/2001/XMLSchema#anyURI",
+            "propertyUri": "http://nakala.fr/terms#type"
+        },
+        {
+            "value": "École nationale des chartes - PSL",
+            "lang": "fr",
+            "typeUri": "http://www.w3.org/2001/XMLSchema#string",
+            "propertyUri": "http://purl.org/dc/terms/publisher"
+        },
+    ]
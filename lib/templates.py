@@ -23,7 +23,9 @@ name: "BELLELAY" # Nom du projet nakalator (de préférence le préfixe utilisé
 
 data:
   path: "/Users/user/Documents/dev/nakalator_workspace/data/mon_projet_1/mon_projet_1_1/" # Chemin absolu (!) vers le répertoire des données dans nakalator_workspace/data/mon_dossier_contenant_les_images/ par exemple le dossier contenant l'image ou les images 
-  type: "tif" # Format des images (jpeg, tif, png, etc.)
+  type: "tif" # Format des images (jpeg, tif, png, etc.) : seuls les fichiers avec cette extension sont envoyés (tif/tiff et jpg/jpeg sont équivalents). Les fichiers cachés et système (.DS_Store, Thumbs.db, etc.) sont toujours ignorés.
+  # include: ["*_r.tif", "*_v.tif"] # Optionnel : n'envoyer que les fichiers dont le nom correspond à l'un de ces motifs
+  # exclude: ["*_brouillon.tif"] # Optionnel : ne pas envoyer les fichiers dont le nom correspond à l'un de ces motifs
   status: "pending" # "pending" ou "published". Il est conseillé de laisser "pending" par défaut et de changer le status dans Nakala une fois le dépôt validé manuellement.
 
 ################################################################################################
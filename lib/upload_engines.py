@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+
+"""upload_engines.py
+
+This module contains the upload engines (backends) used to send files to
+the Nakala `/datas/uploads` endpoint. Every engine returns the same
+`[{name, sha1}]` structure so that they can be swapped in `Nakalator.run_data`,
+and can stream each file as soon as it is done with a result
+`{index, path, name, sha1, bytes, duration, attempts}` (`UploadEngine.stream`).
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+from lib.constants import (
+    UPLOAD_MAX_WORKERS,
+    UPLOAD_MIN_WORKERS,
+    UPLOAD_WORKERS_LIMIT,
+    UPLOAD_MAX_RETRIES,
+    HTTP_POOL_SIZE,
+    HTTP_KEEP_ALIVE,
+    RETRY_BASE_DELAY,
+    RETRY_MAX_DELAY,
+    CIRCUIT_BREAKER_THRESHOLD,
+    CIRCUIT_BREAKER_COOLDOWN
+)
+from lib.utils.cli_utils import UploadProgress
+from lib.utils.concurrency_utils import AIMDController
+from lib.utils.metrics_utils import get_metrics
+from lib.utils.rate_utils import (RateLimiter,
+                                  get_rate_limiter)
+from lib.utils.retry_utils import (RetryableStatus,
+                                   get_circuit_breaker,
+                                   is_retryable_status,
+                                   retry_policy)
+
+
+class UploadEngine:
+    """Base class for the upload engines.
+    The number of concurrent uploads starts at `max_workers` and is adapted during
+    the run between `min_workers` and `workers_limit` (AIMD).
+
+    :param max_workers: the initial number of concurrent uploads
+    :type max_workers: int, optional
+    :param min_workers: the lower bound of the number of concurrent uploads
+    :type min_workers: int, optional
+    :param workers_limit: the upper bound of the number of concurrent uploads
+    :type workers_limit: int, optional
+    :param max_retries: the maximum number of attempts per file
+    :type max_retries: int, optional
+    :param pool_size: the number of connections kept open with Nakala
+    :type pool_size: int, optional
+    :param keep_alive: the idle time (in seconds) before closing a connection
+    :type keep_alive: int, optional
+    :param rate_limiter: the rate limiter of the Nakala API (default: the shared one)
+    :type rate_limiter: RateLimiter, optional
+    """
+    name = None
+    # whether one engine can upload the files of several batches at the same time (threads)
+    shared = False
+
+    def __init__(self,
+                 max_workers: int = UPLOAD_MAX_WORKERS,
+                 min_workers: int = UPLOAD_MIN_WORKERS,
+                 workers_limit: int = UPLOAD_WORKERS_LIMIT,
+                 max_retries: int = UPLOAD_MAX_RETRIES,
+                 pool_size: int = HTTP_POOL_SIZE,
+                 keep_alive: int = HTTP_KEEP_ALIVE,
+                 rate_limiter: RateLimiter = None) -> None:
+        self.max_workers = max_workers
+        self.min_workers = min_workers
+        self.workers_limit = max(workers_limit, max_workers)
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.rate_limiter = rate_limiter if rate_limiter is not None else get_rate_limiter()
+        self.circuit_breaker = get_circuit_breaker()
+
+    def upload(self, url: str, api_key: str, file_paths: list, on_result=None) -> list:
+        """Upload files to Nakala and display the progress (bytes/sec and ETA).
+
+        :param url: the url of the Nakala upload endpoint
+        :type url: str
+        :param api_key: the api key to use the Nakala API
+        :type api_key: str
+        :param file_paths: the paths to the files to upload
+        :type file_paths: list
+        :param on_result: function called with the result of each file as soon as it is done (optional)
+        :type on_result: callable, optional
+        :return: the uploaded files as a list of {name, sha1}
+        :rtype: list
+        """
+        results = [None] * len(file_paths)
+
+        def collect(result: dict) -> None:
+            results[result["index"]] = {"name": result["name"], "sha1": result["sha1"]}
+            if on_result is not None:
+                on_result(result)
+
+        self.stream(url, api_key, file_paths, collect)
+        return results
+
+    def stream(self, url: str, api_key: str, file_paths: list, on_result, sizes: dict = None) -> None:
+        """Upload files to Nakala and hand each result to `on_result` as soon as the file
+        is done, without keeping the results (memory does not grow with the number of files).
+
+        :param url: the url of the Nakala upload endpoint
+        :type url: str
+        :param api_key: the api key to use the Nakala API
+        :type api_key: str
+        :param file_paths: the paths to the files to upload
+        :type file_paths: list
+        :param on_result: function called with the result of each file
+        :type on_result: callable
+        :param sizes: the size of the files when already known (path -> size)
+        :type sizes: dict, optional
+        :return: None
+        :rtype: None
+        """
+        if sizes is None:
+            sizes = {}
+        total_bytes = sum(sizes[path] if path in sizes else os.path.getsize(path)
+                          for path in file_paths if path in sizes or os.path.isfile(path))
+        metrics = get_metrics()
+        with UploadProgress(total_bytes, len(file_paths)) as progress:
+            def callback(result: dict) -> None:
+                progress.update(result)
+                # the metrics of the files are recorded here for every engine
+                metrics.inc("nakalator_upload_files_total", result="uploaded" if result["sha1"] else "failed")
+                if result["sha1"]:
+                    metrics.inc("nakalator_upload_bytes_total", result["bytes"])
+                metrics.inc("nakalator_upload_retries_total", max(0, result["attempts"] - 1))
+                metrics.observe("nakalator_upload_duration_seconds", result["duration"])
+                on_result(result)
+
+            self._upload(url, api_key, file_paths, callback)
+
+    def _upload(self, url: str, api_key: str, file_paths: list, callback) -> None:
+        """Upload files to Nakala and call `callback` with the result of each file as soon as it is done."""
+        raise NotImplementedError
+
+    def concurrency_report(self) -> dict:
+        """Get the current number of concurrent uploads and its history.
+
+        :return: the concurrency report ({current, history})
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+
+class GoUploadEngine(UploadEngine):
+    """Upload engine based on the Go library (goroutines).
+    The limiter, the rate limit, the transport and the retry policy of the Go library are
+    global to the process: they are configured once, by the first engine that uploads,
+    and shared by all the engines and the concurrent uploads.
+    """
+    name = "go"
+    shared = True
+
+    _configured = False
+    _configure_lock = threading.Lock()
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        # the go library is loaded when this engine is selected, not when the CLI starts
+        from lib.bridge.nkl_gotils import init_lib
+        try:
+            init_lib()
+        except OSError as e:
+            raise RuntimeError(f"The go library cannot be loaded ({e}), "
+                               f"use the Python upload engine: nakalator main --engine asyncio") from e
+
+    def _upload(self, url: str, api_key: str, file_paths: list, callback) -> None:
+        from lib.bridge.nkl_gotils import (iter_nkl_files_with_go,
+                                           configure_go_transport,
+                                           configure_go_concurrency,
+                                           configure_go_rate_limit,
+                                           configure_go_retry_policy)
+        # reconfiguring the go library would replace the limiter of the uploads in progress
+        with GoUploadEngine._configure_lock:
+            if not GoUploadEngine._configured:
+                configure_go_transport(max(self.pool_size, self.max_workers), self.keep_alive)
+                configure_go_concurrency(self.max_workers, self.min_workers, self.workers_limit)
+                # the go library paces the uploads with its own bucket, configured with the same limits
+                configure_go_rate_limit(*self.rate_limiter.limits.get("uploads", (0, 0)))
+                configure_go_retry_policy(self.max_retries, RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+                                          CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_COOLDOWN)
+                GoUploadEngine._configured = True
+        for result in iter_nkl_files_with_go(url=url, api_key=api_key, file_paths=file_paths):
+            callback(result)
+
+    def concurrency_report(self) -> dict:
+        if not self._configured:
+            return {"current": self.max_workers, "history": []}
+        from lib.bridge.nkl_gotils import go_concurrency_report
+        return go_concurrency_report()
+
+
+class AsyncioUploadEngine(UploadEngine):
+    """Pure-Python upload engine based on asyncio and aiohttp.
+    Files are streamed from disk by chunks, they are never fully loaded in memory.
+    """
+    name = "asyncio"
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.controller = AIMDController(self.max_workers, self.min_workers, self.workers_limit)
+
+    async def _upload_file(self, session, url: str, api_key: str, index: int, file_path: str, callback) -> None:
+        """Upload one file with the retry policy (retryable statuses and transport errors).
+        The result holds the status of the last response (0 when there is none)."""
+        import aiohttp
+
+        name = os.path.basename(file_path)
+        begin = time.monotonic()
+        size, attempts = 0, 0
+
+        @retry_policy((aiohttp.ClientError, asyncio.TimeoutError), max_tries=self.max_retries)
+        async def attempt() -> tuple:
+            nonlocal attempts
+            attempts += 1
+            await self.circuit_breaker.wait_async()
+            await self.rate_limiter.acquire_async("uploads")
+            await self.controller.acquire()
+            status, error = 0, None
+            start = time.monotonic()
+            try:
+                with open(file_path, "rb") as file:
+                    form = aiohttp.FormData()
+                    form.add_field("file", file, filename=name)
+                    async with session.post(url,
+                                            data=form,
+                                            headers={"X-API-KEY": api_key,
+                                                     "accept": "application/json"}) as response:
+                        status = response.status
+                        retry_after = self.rate_limiter.backoff("uploads", status,
+                                                                response.headers.get("Retry-After"))
+                        if is_retryable_status(status):
+                            raise RetryableStatus(response, status, retry_after)
+                        if status >= 400:
+                            # fatal status (e.g. 401, 413): not retried
+                            return status, {}
+                        try:
+                            return status, await response.json(content_type=None)
+                        except ValueError:
+                            # the file may be stored already: a malformed body is a failure, not retried
+                            return status, {}
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                error = exc
+                raise
+            finally:
+                self.circuit_breaker.record(status, error)
+                get_metrics().inc("nakalator_http_responses_total", endpoint="uploads", status=status or "error")
+                await self.controller.release(time.monotonic() - start, size, status, error)
+
+        status, result = 0, {}
+        try:
+            size = os.path.getsize(file_path)
+            status, result = await attempt()
+        except RetryableStatus as failure:
+            # all the attempts failed
+            status = failure.status
+        except (OSError, aiohttp.ClientError, asyncio.TimeoutError):
+            # the file cannot be read or all the attempts failed
+            pass
+        if not isinstance(result, dict):
+            result = {}
+        callback({
+            "index": index,
+            "path": file_path,
+            "name": name,
+            "sha1": result.get("sha1", ""),
+            "status": status,
+            "bytes": size,
+            "duration": time.monotonic() - begin,
+            "attempts": attempts
+        })
+
+    async def _upload_all(self, url: str, api_key: str, file_paths: list, callback) -> None:
+        import aiohttp
+
+        connector = aiohttp.TCPConnector(limit=max(self.pool_size, self.workers_limit),
+                                         keepalive_timeout=self.keep_alive)
+        # a fixed number of tasks take the files in turn, so that memory does not grow
+        # with the number of files (the concurrent uploads are limited by the controller)
+        files = iter(enumerate(file_paths))
+
+        async def worker(session) -> None:
+            for index, file_path in files:
+                await self._upload_file(session, url, api_key, index, file_path, callback)
+
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await asyncio.gather(*[worker(session) for _ in range(min(self.workers_limit, len(file_paths)))])
+
+    def _upload(self, url: str, api_key: str, file_paths: list, callback) -> None:
+        asyncio.run(self._upload_all(url, api_key, file_paths, callback))
+
+    def concurrency_report(self) -> dict:
+        return self.controller.report()
+
+
+UPLOAD_ENGINES = {
+    GoUploadEngine.name: GoUploadEngine,
+    AsyncioUploadEngine.name: AsyncioUploadEngine,
+}
+
+
+def get_upload_engine(name: str = "go", **kwargs) -> UploadEngine:
+    """Get an upload engine instance by its name.
+
+    :param name: the name of the engine ("go" or "asyncio")
+    :type name: str, optional
+    :return: the upload engine
+    :rtype: UploadEngine
+    """
+    try:
+        return UPLOAD_ENGINES[name](**kwargs)
+    except KeyError:
+        raise ValueError(f"Unknown upload engine: '{name}', "
+                         f"available engines are: {', '.join(UPLOAD_ENGINES)}")
@@ -6,10 +6,11 @@ This module contains the functions to interact with the user in the CLI.
 """
 
 from typer import echo
-from pyfiglet import Figlet
-from InquirerPy import inquirer
 from wasabi import Printer
 
+# pyfiglet, InquirerPy and tqdm are imported by the functions using them:
+# they are not needed by `nakalator --help` (see benchmarks/import_time.py)
+
 # Create a printer object to display messages in the CLI with wasabi
 msg = Printer()
 
@@ -33,11 +34,61 @@ def cli_log(message: str, type_message: str="info") -> None:
     echo(message)
 
 
+def format_size(size: float) -> str:
+    """Format a size in bytes for humans (e.g. 1.5 GB)
+    :param size: the size in bytes
+    :type size: float
+    :return: the formatted size
+    :rtype: str
+    """
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(size) < 1024 or unit == "TB":
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}" if unit != "B" else f"{int(size)} B"
+
+
+class UploadProgress:
+    """Progress of the uploads in the CLI (files, bytes/sec and ETA).
+
+    :param total_bytes: the total size of the files to upload
+    :type total_bytes: int
+    :param total_files: the number of files to upload
+    :type total_files: int
+    """
+    def __init__(self, total_bytes: int, total_files: int) -> None:
+        self.total_files = total_files
+        self.files = 0
+        from tqdm import tqdm
+        self._bar = tqdm(total=total_bytes,
+                         unit="B",
+                         unit_scale=True,
+                         unit_divisor=1024,
+                         desc="Uploading files to Nakala...",
+                         leave=False)
+
+    def update(self, result: dict) -> None:
+        """Account for a file uploaded.
+        :param result: the upload result of the file (with its size in 'bytes')
+        :type result: dict
+        """
+        self.files += 1
+        self._bar.set_postfix_str(f"{self.files}/{self.total_files} files", refresh=False)
+        self._bar.update(result.get("bytes", 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._bar.close()
+
+
 def banner() -> None:
     """Display the banner of the CLI
     :return: None
     :rtype: None
     """
+    from pyfiglet import Figlet
     f = Figlet(font='digital')
     print(f"{f.renderText('Nakalator')}")
     print("""This CLI allows you to send images to Nakala.\n© 2024 - ENC / Mission projets numériques\n""")
@@ -54,6 +105,7 @@ def prompt_select(message: str, choices: list, default: str) -> str:
     :return: the selected choice
     :rtype: str
     """
+    from InquirerPy import inquirer
     return inquirer.select(
         message=message,
         choices=sorted(choices),
@@ -62,6 +114,7 @@ def prompt_select(message: str, choices: list, default: str) -> str:
 
 
 def prompt_confirm(message: str, default: bool = False):
+    from InquirerPy import inquirer
     return inquirer.confirm(
         message=message,
         default=default,
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""collection_utils.py
+
+This module contains the registry of the collections of a run, indexed by
+title and by DOI. The collections checked on Nakala are cached in the upload
+journal for a while (TTL), the others are checked concurrently.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.constants import (
+    COLLECTION_CACHE_TTL,
+    COLLECTION_CHECK_WORKERS
+)
+
+
+class CollectionRegistry:
+    """Registry of the collections created or checked during a run.
+
+    :param env: the Nakala environment ("test" or "production")
+    :type env: str
+    :param journal: the upload journal used as persistent cache (optional)
+    :type journal: UploadJournal, optional
+    :param ttl: the time (in seconds) during which a collection checked is not checked again
+    :type ttl: float, optional
+    :param workers: the number of collections checked at the same time
+    :type workers: int, optional
+    """
+    def __init__(self,
+                 env: str,
+                 journal=None,
+                 ttl: float = COLLECTION_CACHE_TTL,
+                 workers: int = COLLECTION_CHECK_WORKERS) -> None:
+        self.env = env
+        self.journal = journal
+        self.ttl = ttl
+        self.workers = workers
+        # collections of the run: title -> DOI and DOI -> title
+        self._by_title = {}
+        self._by_id = {}
+        # collections known to exist on Nakala (checked, cached or created): DOI -> title
+        self._checked = {}
+
+    def add(self, title: str, collection_id: str) -> None:
+        """Register a collection of the run.
+
+        :param title: the title of the collection
+        :type title: str
+        :param collection_id: the DOI of the collection
+        :type collection_id: str
+        :return: None
+        :rtype: None
+        """
+        self._by_title.setdefault(title, collection_id)
+        self._by_id[collection_id] = title
+
+    def add_created(self, title: str, collection_id: str) -> None:
+        """Register a collection created on Nakala during the run.
+
+        :param title: the title of the collection
+        :type title: str
+        :param collection_id: the DOI of the collection
+        :type collection_id: str
+        :return: None
+        :rtype: None
+        """
+        self.add(title, collection_id)
+        self._checked[collection_id] = title
+        if self.journal is not None:
+            self.journal.record_collections(self.env, {collection_id: title})
+
+    def get_id(self, title: str):
+        """Get the DOI of a collection of the run by its title.
+
+        :param title: the title of the collection
+        :type title: str
+        :return: the DOI, None if no collection of the run has this title
+        :rtype: str
+        """
+        return self._by_title.get(title)
+
+    def get_title(self, collection_id: str):
+        """Get the title of a collection known to exist on Nakala.
+
+        :param collection_id: the DOI of the collection
+        :type collection_id: str
+        :return: the title, None if the collection is not checked
+        :rtype: str
+        """
+        return self._checked.get(collection_id)
+
+    def is_registered(self, collection_id: str) -> bool:
+        """Whether a collection is already registered in the run.
+
+        :param collection_id: the DOI of the collection
+        :type collection_id: str
+        :return: True if the collection is registered
+        :rtype: bool
+        """
+        return collection_id in self._by_id
+
+    def check(self, collection_ids: list, fetch_title) -> dict:
+        """Check that collections exist on Nakala. The collections checked less than
+        `ttl` seconds ago are read from the journal, the others are fetched concurrently.
+
+        :param collection_ids: the DOI of the collections
+        :type collection_ids: list
+        :param fetch_title: function returning (title, None) or (None, error) for a DOI
+        :type fetch_title: callable
+        :return: the error of each collection not found
+        :rtype: dict
+        """
+        to_check = [collection_id for collection_id in dict.fromkeys(collection_ids)
+                    if collection_id not in self._checked]
+        if self.journal is not None and len(to_check) > 0:
+            self._checked.update(self.journal.get_collections(self.env, to_check, self.ttl))
+            to_check = [collection_id for collection_id in to_check if collection_id not in self._checked]
+        if len(to_check) == 0:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(to_check)))) as executor:
+            results = dict(zip(to_check, executor.map(fetch_title, to_check)))
+        found = {collection_id: title for collection_id, (title, error) in results.items() if error is None}
+        self._checked.update(found)
+        if self.journal is not None and len(found) > 0:
+            self.journal.record_collections(self.env, found)
+        return {collection_id: error for collection_id, (_, error) in results.items() if error is not None}
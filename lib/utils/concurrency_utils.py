@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""concurrency_utils.py
+
+This module contains the adaptive concurrency controller (AIMD) used by the
+Python upload engine. It mirrors the limiter of the Go library (lib/bridge/concurrency.go).
+It also contains the process pools used to hash and parse the files.
+"""
+
+import asyncio
+import datetime
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# a request is "slow" when its cost is above tolerance x baseline
+LATENCY_TOLERANCE = 2.0
+# the baseline slowly drifts up so that it can recover after a fast period
+BASELINE_DRIFT = 1.01
+
+
+class AIMDController:
+    """Adaptive limit of concurrent requests (additive increase, multiplicative decrease).
+    The limit grows by one after a full window of healthy requests and is halved on
+    timeouts, 5xx or 429 responses (at most once per request duration).
+
+    :param initial: the initial number of concurrent requests
+    :type initial: int
+    :param minimum: the lower bound of the limit
+    :type minimum: int
+    :param maximum: the upper bound of the limit
+    :type maximum: int
+    """
+    def __init__(self, initial: int, minimum: int, maximum: int) -> None:
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.in_flight = 0
+        self._successes = 0
+        self._baseline = 0.0
+        self._decreased = 0.0
+        self._condition = None
+        self._loop = None
+        self.history = []
+        self._record("start")
+
+    def _record(self, reason: str) -> None:
+        self.history.append({
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "limit": self.limit,
+            "reason": reason
+        })
+
+    async def acquire(self) -> None:
+        """Wait until a new request can start."""
+        # each upload call runs in its own event loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self, latency: float, size: int, status: int = 0, error: Exception = None) -> None:
+        """End a request and adapt the limit from its outcome.
+
+        :param latency: the duration of the request (in seconds)
+        :type latency: float
+        :param size: the size of the file sent (in bytes)
+        :type size: int
+        :param status: the HTTP status code of the response (0 if none)
+        :type status: int, optional
+        :param error: the transport error if any
+        :type error: Exception, optional
+        """
+        async with self._condition:
+            self.in_flight -= 1
+            self.observe(latency, size, status, error)
+            self._condition.notify_all()
+
+    def observe(self, latency: float, size: int, status: int = 0, error: Exception = None) -> None:
+        """Adapt the limit from the outcome of a request.
+        The latency is normalized by the size of the file (with a floor of 1 MiB)
+        so that big files are not mistaken for a slow server."""
+        if error is not None or status == 429 or status >= 500:
+            self._successes = 0
+            if self.limit > self.minimum and time.monotonic() - self._decreased > latency:
+                self._decreased = time.monotonic()
+                self.limit = max(self.minimum, self.limit // 2)
+                if error is not None:
+                    reason = f"error: {error!r}"
+                elif status == 429:
+                    reason = "429 too many requests"
+                else:
+                    reason = f"server error {status}"
+                self._record(reason)
+            return
+
+        cost = latency / max(1.0, size / (1 << 20))
+        if self._baseline == 0 or cost < self._baseline:
+            self._baseline = cost
+        else:
+            self._baseline *= BASELINE_DRIFT
+        if cost > self._baseline * LATENCY_TOLERANCE:
+            self._successes = 0
+            return
+        self._successes += 1
+        if self._successes >= self.limit and self.limit < self.maximum:
+            self.limit += 1
+            self._successes = 0
+            self._record("healthy")
+
+    def report(self) -> dict:
+        """Return the current limit and its history.
+
+        :return: the concurrency report
+        :rtype: dict
+        """
+        return {"current": self.limit, "history": list(self.history)}
+
+
+def process_pool(workers: int) -> ProcessPoolExecutor:
+    """Get a pool of processes that can be created while threads are running
+    (e.g. the stages of the pipeline, the batches of `nakalator watch`).
+    Forking a multi-threaded process may copy a lock held by another thread and
+    deadlock the child: the workers are forked from a fork server instead, a
+    single-threaded process (or spawned when fork servers are not available).
+
+    :param workers: the number of processes
+    :type workers: int
+    :return: the pool of processes
+    :rtype: ProcessPoolExecutor
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""dedup_utils.py
+
+This module contains the content-addressed deduplication of the files sent
+to Nakala during a run: each distinct content (local SHA-1) is uploaded once
+and the SHA-1 returned by Nakala is reused by every data that references it.
+"""
+
+import os
+
+
+class BlobDeduplicator:
+    """Registry of the contents uploaded during a run.
+
+    :attr saved_files: the number of files not uploaded thanks to deduplication
+    :type saved_files: int
+    :attr saved_bytes: the number of bytes not uploaded thanks to deduplication
+    :type saved_bytes: int
+    """
+    def __init__(self) -> None:
+        self._blobs = {}
+        self.saved_files = 0
+        self.saved_bytes = 0
+
+    def plan(self, file_paths: list, local_sha1s: dict) -> tuple:
+        """Split the files to send between the files to upload and the duplicates.
+
+        :param file_paths: the paths to the files to send
+        :type file_paths: list
+        :param local_sha1s: the SHA-1 computed locally for each file
+        :type local_sha1s: dict
+        :return: the files to upload, the files already uploaded during the run
+                 (path -> Nakala sha1) and the duplicates in file_paths (path -> path uploaded)
+        :rtype: tuple
+        """
+        to_upload, reused, duplicates = [], {}, {}
+        representatives = {}
+        for path in file_paths:
+            sha1 = local_sha1s.get(path)
+            if sha1 is None:
+                to_upload.append(path)
+            elif sha1 in self._blobs:
+                reused[path] = self._blobs[sha1]
+                self._count(path)
+            elif sha1 in representatives:
+                duplicates[path] = representatives[sha1]
+            else:
+                representatives[sha1] = path
+                to_upload.append(path)
+        return to_upload, reused, duplicates
+
+    def register(self, local_sha1: str, nakala_sha1: str) -> None:
+        """Register a content uploaded on Nakala.
+
+        :param local_sha1: the SHA-1 computed locally
+        :type local_sha1: str
+        :param nakala_sha1: the SHA-1 returned by Nakala
+        :type nakala_sha1: str
+        :return: None
+        :rtype: None
+        """
+        self._blobs[local_sha1] = nakala_sha1
+
+    def resolve(self, path: str, uploaded: dict) -> dict:
+        """Build the result of a duplicate from the result of the file uploaded.
+
+        :param path: the path to the duplicate
+        :type path: str
+        :param uploaded: the result of the upload ({name, sha1})
+        :type uploaded: dict
+        :return: the result of the duplicate ({name, sha1})
+        :rtype: dict
+        """
+        if uploaded.get("sha1"):
+            self._count(path)
+        return {"name": os.path.basename(path), "sha1": uploaded.get("sha1", "")}
+
+    def _count(self, path: str) -> None:
+        self.saved_files += 1
+        self.saved_bytes += os.path.getsize(path)
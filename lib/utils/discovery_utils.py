@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""discovery_utils.py
+
+This module contains the discovery of the files of a data: the data directory
+is read in a single `os.scandir` pass which gives the size and mtime of each
+file, hidden and system files are ignored and the files are filtered by
+extension (`data.type`) and include/exclude patterns.
+"""
+
+import os
+from dataclasses import dataclass
+from fnmatch import fnmatch
+from typing import Union
+
+from lib.constants import (
+    IGNORED_FILES,
+    EXTENSION_ALIASES
+)
+
+
+@dataclass(frozen=True)
+class DataFile:
+    """Dataclass to store a file of a data found in the data directory."""
+    path: str
+    name: str
+    size: int
+    mtime_ns: int
+
+
+def _as_patterns(patterns: Union[str, list, None]) -> list:
+    if patterns in ("", None):
+        return []
+    if isinstance(patterns, str):
+        return [patterns]
+    return [str(pattern) for pattern in patterns]
+
+
+def extensions_for_type(data_type: Union[str, None]) -> tuple:
+    """Get the file extensions accepted for a `data.type` ("tif" -> (".tif", ".tiff")).
+
+    :param data_type: the type of the files (e.g. "tif", "jpeg"), empty to accept every file
+    :type data_type: str, optional
+    :return: the extensions in lower case, empty to accept every file
+    :rtype: tuple
+    """
+    if data_type in ("", None):
+        return ()
+    data_type = str(data_type).lower().lstrip(".")
+    return tuple(f".{extension}" for extension in EXTENSION_ALIASES.get(data_type, (data_type,)))
+
+
+def is_ignored(name: str) -> bool:
+    """Whether a file is hidden or a system file (e.g. .DS_Store, Thumbs.db).
+
+    :param name: the name of the file
+    :type name: str
+    :return: True if the file must not be sent
+    :rtype: bool
+    """
+    return name.startswith(".") or name in IGNORED_FILES
+
+
+def discover_files(directory: str,
+                   data_type: str = None,
+                   include: Union[str, list] = None,
+                   exclude: Union[str, list] = None) -> list:
+    """Find the files of a data in a single pass over the data directory.
+
+    :param directory: the path to the data directory
+    :type directory: str
+    :param data_type: the type of the files (`data.type`), empty to accept every extension
+    :type data_type: str, optional
+    :param include: glob pattern(s) the file names must match (e.g. "*_r.tif")
+    :type include: str or list, optional
+    :param exclude: glob pattern(s) of the file names to leave out
+    :type exclude: str or list, optional
+    :return: the files sorted by name
+    :rtype: list
+    """
+    extensions = extensions_for_type(data_type)
+    include, exclude = _as_patterns(include), _as_patterns(exclude)
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            name = entry.name
+            if is_ignored(name) or not entry.is_file():
+                continue
+            if extensions and not name.lower().endswith(extensions):
+                continue
+            if include and not any(fnmatch(name, pattern) for pattern in include):
+                continue
+            if any(fnmatch(name, pattern) for pattern in exclude):
+                continue
+            stat = entry.stat()
+            files.append(DataFile(path=entry.path,
+                                  name=name,
+                                  size=stat.st_size,
+                                  mtime_ns=stat.st_mtime_ns))
+    # the sort key is the name, computed once here and reused by the upload, report and tests
+    files.sort(key=lambda file: file.name)
+    return files
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""hash_utils.py
+
+This module contains the functions to compute the SHA-1 of the files locally,
+before they are sent to Nakala (Nakala identifies the files by their SHA-1).
+"""
+
+import hashlib
+import mmap
+import os
+
+from lib.constants import HASH_WORKERS
+from lib.utils.concurrency_utils import process_pool
+
+
+def sha1_file(file_path: str) -> str:
+    """Compute the SHA-1 of a file from a memory-mapped read
+    (the content is hashed from the page cache without Python-level copies).
+
+    :param file_path: the path to the file
+    :type file_path: str
+    :return: the SHA-1 of the file
+    :rtype: str
+    """
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        # empty files cannot be memory-mapped
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                sha1.update(mm)
+    return sha1.hexdigest()
+
+
+def compute_sha1s(file_paths: list, journal=None, workers: int = HASH_WORKERS) -> dict:
+    """Compute the SHA-1 of the files with a pool of processes.
+    The results are cached in the upload journal by (path, size, mtime) so that
+    unchanged files are never hashed twice.
+
+    :param file_paths: the paths to the files
+    :type file_paths: list
+    :param journal: the upload journal used as cache (optional)
+    :type journal: UploadJournal, optional
+    :param workers: the number of processes (default: number of CPUs)
+    :type workers: int, optional
+    :return: the SHA-1 of each file (files that cannot be read are missing)
+    :rtype: dict
+    """
+    sha1s = journal.get_hashes(file_paths) if journal is not None else {}
+    to_hash = [path for path in file_paths if path not in sha1s and os.path.isfile(path)]
+    if len(to_hash) == 0:
+        return sha1s
+
+    computed = {}
+    if workers <= 1 or len(to_hash) == 1:
+        computed = {path: sha1_file(path) for path in to_hash}
+    else:
+        with process_pool(min(workers, len(to_hash))) as executor:
+            # group small files in chunks to limit inter-process overhead
+            chunksize = max(1, len(to_hash) // (workers * 4))
+            computed = dict(zip(to_hash, executor.map(sha1_file, to_hash, chunksize=chunksize)))
+
+    if journal is not None:
+        journal.record_hashes(computed)
+    sha1s.update(computed)
+    return sha1s
@@ -4,13 +4,16 @@
 This module contains I/O utilities functions.
 """
 import os
-from dataclasses import (dataclass,
-                         asdict)
-from typing import Union
+import tempfile
+from dataclasses import dataclass
+from typing import (TYPE_CHECKING,
+                    Union)
 
-import pandas as pd
 import yaml
 
+if TYPE_CHECKING:
+    import pandas as pd
+
 # Custom sort function for files
 custom_sort = lambda file: (0, file) if 'prev' in file.lower() else (2, file) if 'next' in file.lower() else (1, file)
 
@@ -18,7 +21,7 @@ class DoubleQuotedStr(str):
     pass
 
 def double_quoted_str_representer(dumper, data):
-    return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='"')
+    return dumper.represent_scalar('tag:yaml.org,2002:str', str(data), style='"')
 
 yaml.add_representer(DoubleQuotedStr, double_quoted_str_representer)
 
@@ -30,14 +33,12 @@ class NakalaItem:
     data_doi: Union[str, None] = None
     sha1: Union[str, None] = None
 
-    @classmethod
-    def to_csv(cls, name, items, output_dir):
-        pd.DataFrame([asdict(item) for item in items]).to_csv(
-            os.path.join(output_dir, name),
-            encoding="utf-8",
-            index=True,
-            sep=";")
-        return
+
+# libyaml loader and dumper (C) when PyYAML is built with it, pure-Python ones otherwise
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+yaml.add_representer(DoubleQuotedStr, double_quoted_str_representer, Dumper=YAML_DUMPER)
+
 
 def load_yaml(file: str) -> dict:
     """Load a YAML file and return its content as a dictionary.
@@ -47,7 +48,8 @@ def load_yaml(file: str) -> dict:
     :return: content of the YAML file
     :rtype: dict
     """
-    return yaml.load(open(file, "r"), Loader=yaml.FullLoader)
+    with open(file, "r", encoding="utf-8") as f:
+        return yaml.load(f, Loader=YAML_LOADER)
 
 
 def write_yaml(yml_path: str,
@@ -67,6 +69,9 @@ def write_yaml(yml_path: str,
 def rewrite_metadata_config_with_collection_ids(metadata_config: dict,
                                                 metadata_path: str) -> None:
     """Rewrite the metadata configuration with the collection DOI.
+    The file is replaced atomically: the YAML is written to a temporary file
+    in the same directory, then renamed over the metadata file.
+
     :param metadata_config: the metadata configuration
     :type metadata_config: dict
     :param metadata_path: the path to the metadata file
@@ -87,10 +92,23 @@ def rewrite_metadata_config_with_collection_ids(metadata_config: dict,
 
     metadata_config = convert_to_double_quoted(metadata_config)
 
-    with open(metadata_path, 'w', encoding='utf-8') as file:
-        yaml.dump(metadata_config, file, allow_unicode=True, default_flow_style=False, sort_keys=False)
-
-def load_csv(file: str) -> pd.DataFrame:
+    directory, name = os.path.split(os.path.abspath(metadata_path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            yaml.dump(metadata_config, file, Dumper=YAML_DUMPER,
+                      allow_unicode=True, default_flow_style=False, sort_keys=False)
+            file.flush()
+            os.fsync(file.fileno())
+        # keep the permissions of the metadata file (mkstemp creates the file with 0600)
+        os.chmod(tmp_path, os.stat(metadata_path).st_mode & 0o777)
+        os.replace(tmp_path, metadata_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def load_csv(file: str) -> "pd.DataFrame":
     """Load a CSV file and return its content as a DataFrame.
 
     :param file: path to the CSV file
@@ -98,27 +116,6 @@ def load_csv(file: str) -> pd.DataFrame:
     :return: content of the CSV file
     :rtype: pd.DataFrame
     """
+    # pandas is only needed by the checks of the reports, it is slow to import
+    import pandas as pd
     return pd.read_csv(file, sep=";")
-
-def merge_df_reports(sorted_reports: list, collection_doi: str, output_dir: str, remove: bool = False) -> None:
-    """Merge the reports into a single CSV file.
-    :param sorted_reports: a list of reports to merge
-    :type sorted_reports: list
-    :param collection_doi: the DOI of the collection
-    :type collection_doi: str
-    :param output_dir: the output directory to save the merged CSV file
-    :type output_dir: str
-    :return: None
-    :rtype: None
-    """
-    df = None
-    for report in sorted_reports:
-        if report == sorted_reports[0]:
-            df = load_csv(os.path.join(output_dir, report))
-        else:
-            df = pd.concat([df, pd.read_csv(os.path.join(output_dir, report), sep=";")])
-        if remove:
-            os.remove(os.path.join(output_dir, report))
-    df.to_csv(os.path.join(output_dir, f"merge_{collection_doi}_mapping_ids_all.csv"), sep="\t", index=False)
-
-
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+
+"""journal_utils.py
+
+This module contains the upload journal, an SQLite database stored in the
+workspace `output/` directory that records each file uploaded on Nakala and
+each data created, so that an interrupted run can be resumed. It also caches
+the SHA-1 computed locally for each file, the parsed metadata files and the
+collections checked on Nakala.
+"""
+
+import datetime
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+
+class UploadJournal:
+    """Persistent journal of the uploads and data creations.
+    Uploaded files are keyed by (env, path, size, mtime) so that a modified file is uploaded again,
+    and the uploads and data of a Nakala environment are never reused on another one.
+
+    :param journal_path: the path to the SQLite database
+    :type journal_path: str
+    :param env: the Nakala environment of the uploads and data recorded or looked up ("test" or "production")
+    :type env: str, optional
+    """
+    def __init__(self, journal_path: str, env: str = "test") -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(journal_path)), exist_ok=True)
+        self.journal_path = journal_path
+        self.env = env
+        self._lock = threading.Lock()
+        # size and mtime of the files found by the discovery (no stat per lookup)
+        self._stats = {}
+        self._connection = sqlite3.connect(journal_path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS uploads (
+                    env TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    sha1 TEXT NOT NULL,
+                    data_doi TEXT,
+                    uploaded_at TEXT NOT NULL,
+                    PRIMARY KEY (env, path, size, mtime_ns)
+                )""")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS datas (
+                    env TEXT NOT NULL,
+                    metadata_path TEXT NOT NULL,
+                    data_doi TEXT NOT NULL,
+                    collection_doi TEXT,
+                    created_at TEXT NOT NULL,
+                    PRIMARY KEY (env, metadata_path)
+                )""")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS failures (
+                    env TEXT NOT NULL,
+                    metadata_path TEXT NOT NULL,
+                    error TEXT NOT NULL,
+                    failed_at TEXT NOT NULL,
+                    PRIMARY KEY (env, metadata_path)
+                )""")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS hashes (
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    sha1 TEXT NOT NULL,
+                    PRIMARY KEY (path, size, mtime_ns)
+                )""")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS metadatas (
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    metadata BLOB NOT NULL,
+                    PRIMARY KEY (path, size, mtime_ns)
+                )""")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS collections (
+                    env TEXT NOT NULL,
+                    collection_doi TEXT NOT NULL,
+                    title TEXT,
+                    checked_at REAL NOT NULL,
+                    PRIMARY KEY (env, collection_doi)
+                )""")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS uploads_sha1 ON uploads (env, sha1)")
+
+    def remember_files(self, files: list) -> None:
+        """Remember the size and mtime of files already read from their directory.
+
+        :param files: the files found by the discovery
+        :type files: list of DataFile
+        :return: None
+        :rtype: None
+        """
+        for file in files:
+            self._stats[file.path] = (file.size, file.mtime_ns)
+
+    def file_key(self, file_path: str) -> tuple:
+        """Build the journal key of a file.
+
+        :param file_path: the path to the file
+        :type file_path: str
+        :return: the key (absolute path, size, mtime in ns)
+        :rtype: tuple
+        """
+        if file_path in self._stats:
+            return (os.path.abspath(file_path), *self._stats[file_path])
+        stat = os.stat(file_path)
+        return os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def _now() -> str:
+        return datetime.datetime.now().isoformat(timespec="seconds")
+
+    def _select_by_file_key(self, table: str, file_paths: list, column: str = "sha1", env: str = None) -> dict:
+        found = {}
+        # the uploads are scoped by environment, the local caches (hashes, metadatas) are not
+        condition = "env = ? AND " if env is not None else ""
+        with self._lock:
+            for file_path in file_paths:
+                try:
+                    key = self.file_key(file_path)
+                except OSError:
+                    continue
+                row = self._connection.execute(
+                    f"SELECT {column} FROM {table} WHERE {condition}path = ? AND size = ? AND mtime_ns = ?",
+                    (env, *key) if env is not None else key).fetchone()
+                if row is not None:
+                    found[file_path] = row[0]
+        return found
+
+    def get_uploads(self, file_paths: list) -> dict:
+        """Get the files already uploaded on the Nakala environment of the journal.
+
+        :param file_paths: the paths to the files
+        :type file_paths: list
+        :return: the sha1 returned by Nakala for each file already uploaded
+        :rtype: dict
+        """
+        return self._select_by_file_key("uploads", file_paths, env=self.env)
+
+    def get_uploaded_sha1s(self, sha1s: list) -> set:
+        """Get the contents (SHA-1) already uploaded on the Nakala environment of the journal, whatever their path.
+
+        :param sha1s: the SHA-1 to look for
+        :type sha1s: list
+        :return: the SHA-1 already uploaded
+        :rtype: set
+        """
+        sha1s = list(set(sha1s))
+        found = set()
+        with self._lock:
+            # stay under the SQLite limit of host parameters per query
+            for i in range(0, len(sha1s), 500):
+                chunk = sha1s[i:i + 500]
+                rows = self._connection.execute(
+                    f"SELECT DISTINCT sha1 FROM uploads WHERE env = ? AND sha1 IN ({', '.join('?' * len(chunk))})",
+                    (self.env, *chunk)).fetchall()
+                found.update(row[0] for row in rows)
+        return found
+
+    def get_hashes(self, file_paths: list) -> dict:
+        """Get the SHA-1 already computed locally for the files.
+
+        :param file_paths: the paths to the files
+        :type file_paths: list
+        :return: the SHA-1 of each file already hashed
+        :rtype: dict
+        """
+        return self._select_by_file_key("hashes", file_paths)
+
+    def record_hashes(self, sha1s: dict) -> None:
+        """Record the SHA-1 computed locally for the files.
+
+        :param sha1s: the SHA-1 of each file
+        :type sha1s: dict
+        :return: None
+        :rtype: None
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO hashes (path, size, mtime_ns, sha1) VALUES (?, ?, ?, ?)",
+                [(*self.file_key(path), sha1) for path, sha1 in sha1s.items()])
+
+    def get_metadatas(self, metadata_paths: list) -> dict:
+        """Get the metadata files already parsed (and not modified since).
+
+        :param metadata_paths: the paths to the metadata files
+        :type metadata_paths: list
+        :return: the parsed content of each metadata file found
+        :rtype: dict
+        """
+        return {path: pickle.loads(blob)
+                for path, blob in self._select_by_file_key("metadatas", metadata_paths, "metadata").items()}
+
+    def record_metadatas(self, metadatas: dict) -> None:
+        """Record the parsed content of metadata files.
+
+        :param metadatas: the parsed content of each metadata file
+        :type metadatas: dict
+        :return: None
+        :rtype: None
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO metadatas (path, size, mtime_ns, metadata) VALUES (?, ?, ?, ?)",
+                [(*self.file_key(path), pickle.dumps(metadata, protocol=pickle.HIGHEST_PROTOCOL))
+                 for path, metadata in metadatas.items()])
+
+    def get_collections(self, env: str, collection_dois: list, max_age: float) -> dict:
+        """Get the collections checked on Nakala less than `max_age` seconds ago.
+
+        :param env: the Nakala environment ("test" or "production")
+        :type env: str
+        :param collection_dois: the DOI of the collections
+        :type collection_dois: list
+        :param max_age: the maximum age (in seconds) of a check
+        :type max_age: float
+        :return: the title of each collection found
+        :rtype: dict
+        """
+        collection_dois = list(set(collection_dois))
+        found = {}
+        with self._lock:
+            for i in range(0, len(collection_dois), 500):
+                chunk = collection_dois[i:i + 500]
+                rows = self._connection.execute(
+                    f"SELECT collection_doi, title FROM collections WHERE env = ? AND checked_at >= ? "
+                    f"AND collection_doi IN ({', '.join('?' * len(chunk))})",
+                    (env, time.time() - max_age, *chunk)).fetchall()
+                found.update(rows)
+        return found
+
+    def record_collections(self, env: str, collections: dict) -> None:
+        """Record collections checked (or created) on Nakala.
+
+        :param env: the Nakala environment ("test" or "production")
+        :type env: str
+        :param collections: the title of each collection, by DOI
+        :type collections: dict
+        :return: None
+        :rtype: None
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO collections (env, collection_doi, title, checked_at) VALUES (?, ?, ?, ?)",
+                [(env, collection_doi, title, now) for collection_doi, title in collections.items()])
+
+    def record_upload(self, file_path: str, name: str, sha1: str) -> None:
+        """Record a file successfully uploaded on the Nakala environment of the journal.
+
+        :param file_path: the path to the file
+        :type file_path: str
+        :param name: the name of the file on Nakala
+        :type name: str
+        :param sha1: the sha1 returned by Nakala
+        :type sha1: str
+        :return: None
+        :rtype: None
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO uploads (env, path, size, mtime_ns, name, sha1, uploaded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.env, *self.file_key(file_path), name, sha1, self._now()))
+
+    def get_data(self, metadata_path: str) -> dict:
+        """Get the data already created on the Nakala environment of the journal for a metadata file.
+
+        :param metadata_path: the path to the metadata file
+        :type metadata_path: str
+        :return: the data DOI and collection DOI, None if the data is not created yet
+        :rtype: dict
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT data_doi, collection_doi FROM datas WHERE env = ? AND metadata_path = ?",
+                (self.env, os.path.abspath(metadata_path))).fetchone()
+        if row is None:
+            return None
+        return {"data_doi": row[0], "collection_doi": row[1]}
+
+    def record_data(self, metadata_path: str, data_doi: str, collection_doi: str, file_paths: list) -> None:
+        """Record a data created on the Nakala environment of the journal and attach its DOI to its uploaded files.
+
+        :param metadata_path: the path to the metadata file
+        :type metadata_path: str
+        :param data_doi: the DOI of the data
+        :type data_doi: str
+        :param collection_doi: the DOI of the collection (if any)
+        :type collection_doi: str
+        :param file_paths: the paths to the files of the data
+        :type file_paths: list
+        :return: None
+        :rtype: None
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO datas (env, metadata_path, data_doi, collection_doi, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (self.env, os.path.abspath(metadata_path), data_doi, collection_doi, self._now()))
+            self._connection.executemany(
+                "UPDATE uploads SET data_doi = ? WHERE env = ? AND path = ? AND size = ? AND mtime_ns = ?",
+                [(data_doi, self.env, *self.file_key(file_path)) for file_path in file_paths
+                 if os.path.exists(file_path)])
+            self._connection.execute("DELETE FROM failures WHERE env = ? AND metadata_path = ?",
+                                     (self.env, os.path.abspath(metadata_path)))
+
+    def get_failures(self) -> dict:
+        """Get the data whose creation failed on the Nakala environment of the journal (not created since).
+
+        :return: the error of each data (metadata path -> error)
+        :rtype: dict
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT metadata_path, error FROM failures WHERE env = ?",
+                                            (self.env,)).fetchall()
+        return dict(rows)
+
+    def record_failure(self, metadata_path: str, error: str) -> None:
+        """Record a data not created on the Nakala environment of the journal. The data is not
+        marked as created: a resumed run creates it (and uploads its failed files) again.
+
+        :param metadata_path: the path to the metadata file
+        :type metadata_path: str
+        :param error: the reason why the data is not created
+        :type error: str
+        :return: None
+        :rtype: None
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO failures (env, metadata_path, error, failed_at) VALUES (?, ?, ?, ?)",
+                (self.env, os.path.abspath(metadata_path), error, self._now()))
+
+    def close(self) -> None:
+        """Close the journal."""
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""metadata_utils.py
+
+This module contains the loading of the metadata files of a batch: the files
+already parsed are read from the upload journal (keyed by path, size and
+mtime), the others are parsed with the libyaml loader, in a pool of processes
+for large batches.
+"""
+
+from lib.constants import (
+    METADATA_WORKERS,
+    METADATA_PARALLEL_MIN
+)
+from lib.utils.concurrency_utils import process_pool
+from lib.utils.io_utils import load_yaml
+
+
+def load_metadata_files(metadata_paths: list,
+                        journal=None,
+                        workers: int = METADATA_WORKERS,
+                        parallel_min: int = METADATA_PARALLEL_MIN) -> dict:
+    """Load the metadata files, parsing only the files new or modified since the last run.
+
+    :param metadata_paths: the paths to the metadata files
+    :type metadata_paths: list
+    :param journal: the upload journal used as cache (optional)
+    :type journal: UploadJournal, optional
+    :param workers: the number of processes (default: number of CPUs)
+    :type workers: int, optional
+    :param parallel_min: the number of files to parse from which processes are used
+    :type parallel_min: int, optional
+    :return: the content of each metadata file
+    :rtype: dict
+    """
+    metadatas = journal.get_metadatas(metadata_paths) if journal is not None else {}
+    to_parse = [path for path in metadata_paths if path not in metadatas]
+    if len(to_parse) == 0:
+        return metadatas
+
+    if workers <= 1 or len(to_parse) < parallel_min:
+        parsed = {path: load_yaml(path) for path in to_parse}
+    else:
+        with process_pool(min(workers, len(to_parse))) as executor:
+            chunksize = max(1, len(to_parse) // (workers * 4))
+            parsed = dict(zip(to_parse, executor.map(load_yaml, to_parse, chunksize=chunksize)))
+
+    if journal is not None:
+        journal.record_metadatas(parsed)
+    metadatas.update(parsed)
+    return metadatas
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+
+"""metrics_utils.py
+
+This module contains the metrics of the runs (counters, gauges and histograms)
+recorded by the upload engines, the API calls, the pipeline and the
+verification. They are exported in the Prometheus text format, as a textfile
+rewritten at regular intervals in output/metrics/ (for the textfile collector
+of node_exporter) and optionally on a `/metrics` endpoint, and summarized as
+JSON at the end of each run.
+"""
+
+import bisect
+import copy
+import datetime
+import json
+import math
+import os
+import tempfile
+import threading
+from http.server import (BaseHTTPRequestHandler,
+                         ThreadingHTTPServer)
+
+from lib.constants import METRICS_INTERVAL
+
+# buckets (in seconds) of the durations
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# metrics recorded: name -> (type, help, buckets of the histograms)
+METRICS = {
+    "nakalator_upload_files_total": ("counter", "Files sent to /datas/uploads by result (uploaded, failed).", None),
+    "nakalator_upload_bytes_total": ("counter", "Bytes of the files uploaded.", None),
+    "nakalator_upload_retries_total": ("counter", "Attempts of the uploads beyond the first one.", None),
+    "nakalator_upload_duration_seconds": ("histogram", "Time to upload a file, retries included.", DURATION_BUCKETS),
+    "nakalator_http_responses_total": ("counter", "Responses of the Nakala API by endpoint class and status "
+                                                  "('error' for a transport error).", None),
+    "nakalator_rate_limit_wait_seconds_total": ("counter", "Time waited by the client-side rate limiter "
+                                                           "by endpoint class.", None),
+    "nakalator_circuit_breaker_opened_total": ("counter", "Pauses of every request while Nakala is unavailable.", None),
+    "nakalator_pipeline_queue_depth": ("gauge", "Data waiting before a stage of the pipeline.", None),
+    "nakalator_data_created_total": ("counter", "Data created on Nakala.", None),
+    "nakalator_data_creation_duration_seconds": ("histogram", "Time to create a data on Nakala.", DURATION_BUCKETS),
+    "nakalator_data_verified_total": ("counter", "Data verified by status (verified, inconsistent, unavailable).", None),
+    "nakalator_verification_duration_seconds": ("histogram", "Time to verify a data, polls included.",
+                                                DURATION_BUCKETS),
+}
+
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(key: tuple) -> str:
+    if len(key) == 0:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in key)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class MetricsRegistry:
+    """Thread-safe registry of the metrics of the process (see METRICS).
+    The counters and histograms only grow: the summary of a run is the
+    difference with a snapshot taken when the run starts.
+
+    :param definitions: the metrics recorded as {name: (type, help, buckets)}
+    :type definitions: dict, optional
+    """
+    def __init__(self, definitions: dict = None) -> None:
+        self.definitions = definitions if definitions is not None else METRICS
+        # name -> labels -> value ({value, max} for the gauges, {buckets, sum, count} for the histograms)
+        self._values = {name: {} for name in self.definitions}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Increase a counter.
+
+        :param name: the name of the counter
+        :type name: str
+        :param value: the increment (default: 1)
+        :type value: float, optional
+        :return: None
+        :rtype: None
+        """
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        """Set a gauge (its maximum is kept too).
+
+        :param name: the name of the gauge
+        :type name: str
+        :param value: the value
+        :type value: float
+        :return: None
+        :rtype: None
+        """
+        key = _labels_key(labels)
+        with self._lock:
+            gauge = self._values[name].setdefault(key, {"value": value, "max": value})
+            gauge["value"] = value
+            gauge["max"] = max(gauge["max"], value)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Record a value in a histogram.
+
+        :param name: the name of the histogram
+        :type name: str
+        :param value: the value (e.g. a duration in seconds)
+        :type value: float
+        :return: None
+        :rtype: None
+        """
+        bounds = self.definitions[name][2]
+        key = _labels_key(labels)
+        with self._lock:
+            histogram = self._values[name].get(key)
+            if histogram is None:
+                histogram = self._values[name][key] = {"buckets": [0] * (len(bounds) + 1), "sum": 0.0, "count": 0}
+            histogram["buckets"][bisect.bisect_left(bounds, value)] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def snapshot(self) -> dict:
+        """Copy the values of the metrics (e.g. when a run starts, see `summary`).
+
+        :return: the values of the metrics
+        :rtype: dict
+        """
+        with self._lock:
+            return copy.deepcopy(self._values)
+
+    def to_prometheus(self, labels: dict = None) -> str:
+        """Render the metrics in the Prometheus text format (version 0.0.4).
+
+        :param labels: labels added to every series (e.g. {"command": "watch"})
+        :type labels: dict, optional
+        :return: the metrics
+        :rtype: str
+        """
+        values = self.snapshot()
+        lines = []
+        for name, (kind, description, bounds) in self.definitions.items():
+            if len(values[name]) == 0:
+                continue
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(values[name].items()):
+                key = _labels_key({**dict(key), **(labels or {})})
+                if kind == "counter":
+                    lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+                elif kind == "gauge":
+                    lines.append(f"{name}{_format_labels(key)} {_format_value(value['value'])}")
+                else:
+                    cumulative = 0
+                    for bound, count in zip((*bounds, math.inf), value["buckets"]):
+                        cumulative += count
+                        bucket_key = _labels_key({**dict(key), "le": _format_value(bound)})
+                        lines.append(f"{name}_bucket{_format_labels(bucket_key)} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {_format_value(value['sum'])}")
+                    lines.append(f"{name}_count{_format_labels(key)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, since: dict = None) -> dict:
+        """Summarize the metrics recorded since a snapshot: the counters, the gauges
+        (last value and maximum of the process) and for each histogram the count,
+        sum, mean and quantiles (estimated from the buckets, as Prometheus does).
+
+        :param since: the snapshot taken when the run started (default: the start of the process)
+        :type since: dict, optional
+        :return: the summary as {counters, gauges, histograms}, by name and labels
+        :rtype: dict
+        """
+        values = self.snapshot()
+        since = since or {}
+        summary = {"counters": {}, "gauges": {}, "histograms": {}}
+        for name, (kind, _, bounds) in self.definitions.items():
+            before = since.get(name, {})
+            for key, value in values[name].items():
+                label = ",".join(f"{k}={v}" for k, v in key) or "all"
+                if kind == "counter":
+                    delta = value - before.get(key, 0)
+                    if delta:
+                        summary["counters"].setdefault(name, {})[label] = round(delta, 6)
+                elif kind == "gauge":
+                    summary["gauges"].setdefault(name, {})[label] = dict(value)
+                else:
+                    previous = before.get(key, {"buckets": [0] * len(value["buckets"]), "sum": 0.0, "count": 0})
+                    count = value["count"] - previous["count"]
+                    if count == 0:
+                        continue
+                    buckets = [now - then for now, then in zip(value["buckets"], previous["buckets"])]
+                    total = value["sum"] - previous["sum"]
+                    summary["histograms"].setdefault(name, {})[label] = {
+                        "count": count,
+                        "sum": round(total, 6),
+                        "mean": round(total / count, 6),
+                        **{f"p{int(q * 100)}": _quantile(q, bounds, buckets) for q in (0.5, 0.95, 0.99)},
+                    }
+        return summary
+
+    def save_summary(self, output_dir: str, name: str = None, since: dict = None, **extra) -> str:
+        """Save the summary of a run as JSON.
+
+        :param output_dir: the directory of the summary
+        :type output_dir: str
+        :param name: the name of the run in the name of the file (e.g. the batch)
+        :type name: str, optional
+        :param since: the snapshot taken when the run started
+        :type since: dict, optional
+        :param extra: other fields of the summary (e.g. the duration of the run)
+        :return: the path to the summary
+        :rtype: str
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir,
+                            f"metrics_summary_{name + '_' if name else ''}"
+                            f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        content = {"date": datetime.datetime.now().isoformat(timespec="seconds"), **extra, **self.summary(since)}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(content, f, ensure_ascii=False, indent=2)
+        return path
+
+
+def _quantile(q: float, bounds: tuple, buckets: list) -> float:
+    """Estimate a quantile from the buckets of a histogram (linear interpolation in the bucket)."""
+    rank = q * sum(buckets)
+    cumulative = 0
+    for index, count in enumerate(buckets):
+        if count > 0 and cumulative + count >= rank:
+            if index == len(bounds):
+                # beyond the last bucket: its lower bound
+                return bounds[-1]
+            lower = bounds[index - 1] if index > 0 else 0.0
+            return round(lower + (bounds[index] - lower) * (rank - cumulative) / count, 6)
+        cumulative += count
+    return 0.0
+
+
+class MetricsExporter:
+    """Export the metrics while a command runs: the Prometheus textfile is rewritten
+    atomically every `interval` seconds (and when the exporter stops), and a
+    `/metrics` endpoint is served if a port is given.
+
+    :param registry: the metrics
+    :type registry: MetricsRegistry
+    :param textfile: the path to the Prometheus textfile (optional)
+    :type textfile: str, optional
+    :param port: the port of the `/metrics` endpoint (optional)
+    :type port: int, optional
+    :param labels: labels added to every series (e.g. {"command": "watch"})
+    :type labels: dict, optional
+    :param interval: the time (in seconds) between two writes of the textfile
+    :type interval: float, optional
+    """
+    def __init__(self,
+                 registry: MetricsRegistry,
+                 textfile: str = None,
+                 port: int = None,
+                 labels: dict = None,
+                 interval: float = METRICS_INTERVAL) -> None:
+        self.registry = registry
+        self.textfile = textfile
+        self.port = port
+        self.labels = labels or {}
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._httpd = None
+
+    def write_textfile(self) -> None:
+        """Write the textfile (atomically, the collector never reads a partial file)."""
+        directory = os.path.dirname(self.textfile) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=directory)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(self.registry.to_prometheus(self.labels))
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.textfile)
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.write_textfile()
+
+    def _serve(self) -> None:
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.registry.to_prometheus(exporter.labels).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        self._httpd = ThreadingHTTPServer(("0.0.0.0", self.port), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, name="metrics-http", daemon=True).start()
+
+    def start(self) -> "MetricsExporter":
+        """Start writing the textfile and serving the endpoint.
+
+        :return: the exporter
+        :rtype: MetricsExporter
+        """
+        if self.port:
+            self._serve()
+        if self.textfile is not None:
+            self.write_textfile()
+            self._thread = threading.Thread(target=self._loop, name="metrics-textfile", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop the exporter, after a last write of the textfile."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self.write_textfile()
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+
+    def __enter__(self) -> "MetricsExporter":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+# One registry shared by all the components of the process
+_METRICS = None
+
+
+def get_metrics() -> MetricsRegistry:
+    """Get the metrics registry shared by all the components of the process.
+
+    :return: the metrics registry
+    :rtype: MetricsRegistry
+    """
+    global _METRICS
+    if _METRICS is None:
+        _METRICS = MetricsRegistry()
+    return _METRICS
@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+
+"""mock_utils.py
+
+This module contains a local stand-in of the Nakala API, limited to the
+endpoints used by Nakalator (`/datas/uploads`, `/datas`, `/datas/{id}`,
+`/collections`, `/collections/{id}`), to run batches and benchmarks without
+apitest.nakala.fr. The conditions of the network and of the API can be
+simulated: latency, bandwidth, error rate, bursts of 429 and indexing delay.
+The uploads are streamed and hashed chunk by chunk, so the server can take
+large files and many concurrent connections.
+"""
+
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import (asdict,
+                         dataclass)
+from http.server import (BaseHTTPRequestHandler,
+                         ThreadingHTTPServer)
+from typing import Union
+from urllib.parse import unquote
+
+from lib.constants import NAKALA_ROUTES
+
+# size of the chunks read from the uploads
+_CHUNK_SIZE = 64 * 1024
+# prefix of the DOIs attributed by the server
+_DOI_PREFIX = "10.34847/nkl."
+
+
+@dataclass
+class MockNakalaConfig:
+    """Dataclass to store the conditions simulated by the mock server.
+
+    :attr latency: the time (in seconds) added to each response
+    :type latency: float
+    :attr jitter: the random time (in seconds, up to) added to the latency
+    :type jitter: float
+    :attr bandwidth: the bytes per second read from each upload (0: unlimited)
+    :type bandwidth: float
+    :attr error_rate: the probability of a request to fail with 502 or 503
+    :type error_rate: float
+    :attr burst_interval: the time (in seconds) between two bursts of 429 (0: no burst)
+    :type burst_interval: float
+    :attr burst_duration: the duration (in seconds) of a burst of 429
+    :type burst_duration: float
+    :attr retry_after: the `Retry-After` (in seconds) of the 429 and 503 responses
+    :type retry_after: float
+    :attr index_delay: the time (in seconds) before a data created can be read
+    :type index_delay: float
+    :attr seed: the seed of the random errors (optional)
+    :type seed: int
+    """
+    latency: float = 0.0
+    jitter: float = 0.0
+    bandwidth: float = 0.0
+    error_rate: float = 0.0
+    burst_interval: float = 0.0
+    burst_duration: float = 1.0
+    retry_after: float = 1.0
+    index_delay: float = 0.0
+    seed: Union[int, None] = None
+
+
+class _MockState:
+    """Content of the mock server (uploads, data, collections) and its counters."""
+    def __init__(self, config: MockNakalaConfig) -> None:
+        self.config = config
+        self.started = time.monotonic()
+        self.uploads = {}
+        self.datas = {}
+        self.collections = {}
+        self.counters = {"requests": {}, "statuses": {}, "bytes_received": 0}
+        self._ids = itertools.count(1)
+        self._random = random.Random(config.seed)
+        self._lock = threading.Lock()
+
+    def new_id(self) -> str:
+        with self._lock:
+            return f"{_DOI_PREFIX}{next(self._ids):08x}"
+
+    def draw(self) -> float:
+        with self._lock:
+            return self._random.random()
+
+    def in_burst(self) -> bool:
+        interval = self.config.burst_interval
+        if interval <= 0:
+            return False
+        # the burst ends each interval, the first one comes after a full interval without error
+        return (time.monotonic() - self.started) % interval >= interval - self.config.burst_duration
+
+    def count(self, route: str, status: int, size: int) -> None:
+        with self._lock:
+            self.counters["requests"][route] = self.counters["requests"].get(route, 0) + 1
+            self.counters["statuses"][str(status)] = self.counters["statuses"].get(str(status), 0) + 1
+            self.counters["bytes_received"] += size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": dict(self.counters["requests"]),
+                "statuses": dict(self.counters["statuses"]),
+                "bytes_received": self.counters["bytes_received"],
+                "uploads": len(self.uploads),
+                "datas": len(self.datas),
+                "collections": len(self.collections),
+            }
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    """Request handler of the mock server (HTTP/1.1, connections kept alive)."""
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def state(self) -> _MockState:
+        return self.server.state
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def _iter_body(self, bandwidth: float = 0.0):
+        """Read the body of the request by chunks (Content-Length or chunked transfer encoding)."""
+        start = time.monotonic()
+        received = 0
+
+        def pace(size: int) -> None:
+            nonlocal received
+            received += size
+            if bandwidth > 0:
+                delay = received / bandwidth - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    # trailers, up to the empty line
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    return
+                while size > 0:
+                    chunk = self.rfile.read(min(size, _CHUNK_SIZE))
+                    if not chunk:
+                        return
+                    size -= len(chunk)
+                    pace(len(chunk))
+                    yield chunk
+                self.rfile.readline()
+        else:
+            remaining = int(self.headers.get("Content-Length") or 0)
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, _CHUNK_SIZE))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                pace(len(chunk))
+                yield chunk
+
+    def _read_json(self) -> tuple:
+        body = b"".join(self._iter_body())
+        try:
+            return json.loads(body or b"{}"), len(body)
+        except ValueError:
+            return None, len(body)
+
+    def _read_upload(self) -> tuple:
+        """Read a multipart upload and hash the file part as it comes.
+
+        :return: the name of the file (None if no file part), its SHA-1, its size and the bytes read
+        :rtype: tuple
+        """
+        match = re.search(r'boundary="?([^";]+)"?', self.headers.get("Content-Type", ""))
+        chunks = self._iter_body(self.state.config.bandwidth)
+        if match is None:
+            return None, None, 0, sum(len(chunk) for chunk in chunks)
+        delimiter = b"\r\n--" + match.group(1).encode("latin-1")
+        # the first delimiter is not preceded by a line break
+        buffer = b"\r\n"
+        name, digest, size, received = None, None, 0, 0
+        state = "delimiter"
+        hasher = None
+        done = False
+        for chunk in chunks:
+            received += len(chunk)
+            if done:
+                continue
+            buffer += chunk
+            while True:
+                if state == "delimiter":
+                    index = buffer.find(delimiter)
+                    if index < 0 or len(buffer) < index + len(delimiter) + 2:
+                        break
+                    after = buffer[index + len(delimiter):index + len(delimiter) + 2]
+                    buffer = buffer[index + len(delimiter) + 2:]
+                    if after == b"--":
+                        done = True
+                        break
+                    state = "headers"
+                elif state == "headers":
+                    index = buffer.find(b"\r\n\r\n")
+                    if index < 0:
+                        break
+                    headers = buffer[:index].decode("utf-8", "replace")
+                    buffer = buffer[index + 4:]
+                    filename = re.search(r"filename\*=(?:utf-8|UTF-8)''([^;\r\n]+)", headers) \
+                        or re.search(r'filename="([^"]*)"', headers)
+                    hasher = None
+                    if filename is not None and name is None:
+                        name = unquote(filename.group(1))
+                        hasher = hashlib.sha1()
+                    state = "content"
+                else:
+                    index = buffer.find(delimiter)
+                    end = index if index >= 0 else max(0, len(buffer) - len(delimiter))
+                    if hasher is not None:
+                        hasher.update(buffer[:end])
+                        size += end
+                    if index < 0:
+                        buffer = buffer[end:]
+                        break
+                    # the delimiter is handled by the "delimiter" state
+                    buffer = buffer[index:]
+                    if hasher is not None:
+                        digest = hasher.hexdigest()
+                        hasher = None
+                    state = "delimiter"
+        return name, digest, size, received
+
+    def _send(self, status: int, content: dict, route: str, received: int, headers: dict = None) -> None:
+        config = self.state.config
+        if config.latency > 0 or config.jitter > 0:
+            time.sleep(config.latency + config.jitter * self.state.draw())
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.state.count(route, status, received)
+
+    def _failure(self) -> Union[tuple, None]:
+        """Draw the simulated failure of a request (burst of 429, 502 or 503), None if it succeeds."""
+        config = self.state.config
+        retry_after = {"Retry-After": f"{config.retry_after:g}"}
+        if self.state.in_burst():
+            return 429, {"code": 429, "message": "Too Many Requests"}, retry_after
+        if config.error_rate > 0 and self.state.draw() < config.error_rate:
+            if self.state.draw() < 0.5:
+                return 502, {"code": 502, "message": "Bad Gateway"}, {}
+            return 503, {"code": 503, "message": "Service Unavailable"}, retry_after
+        return None
+
+    def _route(self) -> tuple:
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts[:2] == ["datas", "uploads"]:
+            return "uploads", None
+        if parts[0] in ("datas", "collections"):
+            # the identifiers are DOIs (10.34847/nkl.xxx)
+            return parts[0], unquote("/".join(parts[1:])) or None
+        if parts == ["_stats"]:
+            return "stats", None
+        return "unknown", None
+
+    def do_POST(self) -> None:
+        route, _ = self._route()
+        if route == "uploads":
+            name, sha1, size, received = self._read_upload()
+        else:
+            content, received = self._read_json()
+        # the body is always read, the connection is reused by the client
+        if not self.headers.get("X-API-KEY"):
+            return self._send(401, {"code": 401, "message": "Missing API key"}, route, received)
+        if route not in ("uploads", "datas", "collections"):
+            return self._send(404, {"code": 404, "message": "Not Found"}, route, received)
+        failure = self._failure()
+        if failure is not None:
+            return self._send(failure[0], failure[1], route, received, failure[2])
+
+        state = self.state
+        if route == "uploads":
+            if name is None or sha1 is None:
+                return self._send(400, {"code": 400, "message": "No file sent"}, route, received)
+            state.uploads[sha1] = {"name": name, "sha1": sha1, "size": size}
+            return self._send(201, {"name": name, "sha1": sha1}, route, received)
+        if not isinstance(content, dict):
+            return self._send(400, {"code": 400, "message": "Invalid JSON"}, route, received)
+        if route == "datas":
+            files = content.get("files") or []
+            unknown = [file.get("sha1") for file in files if file.get("sha1") not in state.uploads]
+            if len(files) == 0 or unknown:
+                return self._send(422, {"code": 422, "message": f"Files not uploaded: {unknown}"},
+                                  route, received)
+            data_id = state.new_id()
+            state.datas[data_id] = {
+                "created": time.monotonic(),
+                "identifier": data_id,
+                "status": content.get("status"),
+                "files": [{"name": file.get("name", state.uploads[file["sha1"]]["name"]),
+                           "sha1": file["sha1"],
+                           "size": state.uploads[file["sha1"]]["size"]} for file in files],
+                "metas": content.get("metas", []),
+                "collectionsIds": content.get("collectionsIds", []),
+            }
+            return self._send(201, {"code": 201, "message": "Data created", "payload": {"id": data_id}},
+                              route, received)
+        collection_id = state.new_id()
+        state.collections[collection_id] = {
+            "identifier": collection_id,
+            "status": content.get("status"),
+            "metas": content.get("metas", []),
+        }
+        return self._send(201, {"code": 201, "message": "Collection created", "payload": {"id": collection_id}},
+                          route, received)
+
+    def do_GET(self) -> None:
+        route, identifier = self._route()
+        if route == "stats":
+            return self._send(200, self.state.stats(), route, 0)
+        if not self.headers.get("X-API-KEY"):
+            return self._send(401, {"code": 401, "message": "Missing API key"}, route, 0)
+        if route not in ("datas", "collections") or identifier is None:
+            return self._send(404, {"code": 404, "message": "Not Found"}, route, 0)
+        failure = self._failure()
+        if failure is not None:
+            return self._send(failure[0], failure[1], route, 0, failure[2])
+        if route == "datas":
+            data = self.state.datas.get(identifier)
+            # Nakala indexes the data a while after its creation
+            if data is None or time.monotonic() - data["created"] < self.state.config.index_delay:
+                return self._send(404, {"code": 404, "message": "Data not found"}, route, 0)
+            return self._send(200, {key: value for key, value in data.items() if key != "created"}, route, 0)
+        collection = self.state.collections.get(identifier)
+        if collection is None:
+            return self._send(404, {"code": 404, "message": "Collection not found"}, route, 0)
+        return self._send(200, collection, route, 0)
+
+
+class _MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # many concurrent uploads open their connection at the same time
+    request_queue_size = 256
+
+
+class MockNakalaServer:
+    """Local stand-in of the Nakala API (one thread per connection).
+    The server accepts any API key and keeps everything in memory.
+
+    :param config: the conditions simulated by the server (default: none)
+    :type config: MockNakalaConfig, optional
+    :param host: the address of the server (default: "127.0.0.1")
+    :type host: str, optional
+    :param port: the port of the server (default: 0, a free port)
+    :type port: int, optional
+    """
+    def __init__(self, config: MockNakalaConfig = None, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.config = config if config is not None else MockNakalaConfig()
+        self._httpd = _MockHTTPServer((host, port), _MockHandler)
+        self._httpd.state = _MockState(self.config)
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """The URL of the API (to use as `api_url` of a Nakala environment)."""
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def stats(self) -> dict:
+        """Get the counters of the server (requests per endpoint, statuses, bytes received)
+        and the number of uploads, data and collections stored. They are also served on `/_stats`.
+
+        :return: the counters
+        :rtype: dict
+        """
+        return {**self._httpd.state.stats(), "config": asdict(self.config)}
+
+    def serve_forever(self) -> None:
+        """Serve the requests in the calling thread until `stop` is called."""
+        self._httpd.serve_forever(poll_interval=0.1)
+
+    def start(self) -> "MockNakalaServer":
+        """Serve the requests in a background thread.
+
+        :return: the server
+        :rtype: MockNakalaServer
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name="mock-nakala", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop the server and close its socket."""
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+
+    def __enter__(self) -> "MockNakalaServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+@contextmanager
+def use_mock_server(url: str, env: str = "test"):
+    """Send the Nakala API calls of an environment to a mock server, e.g.:
+
+        with MockNakalaServer() as server, use_mock_server(server.url):
+            Nakalator(env="test", ...).run_data()
+
+    The requests builders must be created inside the block.
+
+    :param url: the URL of the mock server
+    :type url: str
+    :param env: the environment redirected (default: "test")
+    :type env: str, optional
+    """
+    api_url = NAKALA_ROUTES[env]["api_url"]
+    NAKALA_ROUTES[env]["api_url"] = url
+    try:
+        yield url
+    finally:
+        NAKALA_ROUTES[env]["api_url"] = api_url
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""pipeline_utils.py
+
+This module contains a small staged pipeline used to overlap the steps of a
+batch run (upload, data creation and report): each stage runs
+in its own thread and the stages are connected by bounded queues.
+"""
+
+import queue
+import threading
+from dataclasses import (dataclass,
+                         field)
+from typing import Union
+
+from lib.utils.metrics_utils import get_metrics
+
+# end of stream marker
+_STOP = object()
+
+
+@dataclass
+class DataJob:
+    """Dataclass to store the state of a data through the pipeline."""
+    order: int
+    metadata_path: str
+    metadata: dict
+    files: list = field(default_factory=list)
+    files_to_send: list = field(default_factory=list)
+    local_sha1s: dict = field(default_factory=dict)
+    sha1s: list = field(default_factory=list)
+    data_doi: Union[str, None] = None
+    collection_doi: Union[str, None] = None
+    verification: Union[object, None] = None
+    error: Union[str, None] = None
+
+
+class Pipeline:
+    """Staged pipeline: the items produced by a source (in the calling thread)
+    go through each stage (one thread per stage) in order.
+    A stage returns the item for the next stage, or None to drop it.
+    If a stage fails, the source and the stages up to the failing one stop, the
+    following stages finish the items they already received, then the error is
+    raised by `run`.
+
+    :param stages: the stages as a list of (name, function)
+    :type stages: list
+    :param queue_size: the maximum number of items waiting before each stage
+    :type queue_size: int, optional
+    """
+    def __init__(self, stages: list, queue_size: int = 2) -> None:
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.error = None
+        # index of the failing stage (-1 for the source), None while everything is fine
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+    def _fail(self, index: int, exc: BaseException) -> None:
+        with self._lock:
+            if self.error is None:
+                self.error = exc
+            if self._failed_at is None or index > self._failed_at:
+                self._failed_at = index
+
+    def _stopped(self, index: int) -> bool:
+        """Whether the stage (or the source for -1) must stop processing items."""
+        failed_at = self._failed_at
+        return failed_at is not None and index <= failed_at
+
+    def _put(self, index: int, item) -> None:
+        """Put an item before a stage, without blocking forever if that stage is stopped."""
+        while True:
+            try:
+                self.queues[index].put(item, timeout=0.1)
+                self._record_depth(index)
+                return
+            except queue.Full:
+                if self._stopped(index) and item is not _STOP:
+                    return
+
+    def _record_depth(self, index: int) -> None:
+        get_metrics().set("nakalator_pipeline_queue_depth", self.queues[index].qsize(), stage=self.stages[index][0])
+
+    def _worker(self, index: int) -> None:
+        _, func = self.stages[index]
+        is_last = index == len(self.stages) - 1
+        while True:
+            item = self.queues[index].get()
+            self._record_depth(index)
+            if item is _STOP:
+                if not is_last:
+                    self._put(index + 1, _STOP)
+                return
+            if self._stopped(index):
+                # drain the queue
+                continue
+            try:
+                result = func(item)
+            except BaseException as exc:
+                # including SystemExit raised by sys.exit() in a stage
+                self._fail(index, exc)
+                continue
+            if not is_last and result is not None:
+                self._put(index + 1, result)
+
+    def run(self, source) -> None:
+        """Run the pipeline until the source is exhausted and every item went through all the stages.
+
+        :param source: an iterable producing the items
+        :type source: iterable
+        :return: None
+        :rtype: None
+        """
+        threads = [threading.Thread(target=self._worker, args=(index,), name=name, daemon=True)
+                   for index, (name, _) in enumerate(self.stages)]
+        for thread in threads:
+            thread.start()
+        try:
+            for item in source:
+                if self._stopped(-1):
+                    break
+                self._put(0, item)
+        except BaseException as exc:
+            self._fail(-1, exc)
+        finally:
+            self._put(0, _STOP)
+            for thread in threads:
+                thread.join()
+        if self.error is not None:
+            raise self.error
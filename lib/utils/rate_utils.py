@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+"""rate_utils.py
+
+This module contains the client-side rate limiter used to pace the calls
+to the Nakala API instead of fixed sleeps: one token bucket per endpoint
+class (uploads, datas, collections), paused when Nakala answers 429/503
+with a `Retry-After` header. The Go library mirrors it (lib/bridge/rate.go).
+"""
+
+import asyncio
+import datetime
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from lib.constants import (
+    API_RATE_LIMITS,
+    RETRY_AFTER_STATUSES,
+    RETRY_AFTER_MAX
+)
+from lib.utils.metrics_utils import get_metrics
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` calls per second on average,
+    with bursts of up to `capacity` calls.
+
+    :param rate: the number of tokens added per second
+    :type rate: float
+    :param capacity: the maximum number of tokens (burst size)
+    :type capacity: float, optional
+    """
+    def __init__(self, rate: float, capacity: float = 1) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take(self) -> float:
+        """Take a token if one is available.
+
+        :return: 0 if a token was taken, the delay to wait before retrying otherwise
+        :rtype: float
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self) -> float:
+        """Wait until a call is allowed.
+
+        :return: the time waited (in seconds)
+        :rtype: float
+        """
+        waited = 0.0
+        while (delay := self._take()) > 0:
+            time.sleep(delay)
+            waited += delay
+        return waited
+
+    async def acquire_async(self) -> float:
+        """Wait until a call is allowed, without blocking the event loop.
+
+        :return: the time waited (in seconds)
+        :rtype: float
+        """
+        waited = 0.0
+        while (delay := self._take()) > 0:
+            await asyncio.sleep(delay)
+            waited += delay
+        return waited
+
+    def pause(self, seconds: float) -> None:
+        """Stop delivering tokens for `seconds` (e.g. after a `Retry-After`).
+
+        :param seconds: the duration of the pause
+        :type seconds: float
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            # no burst when the pause ends
+            self._tokens = 0
+            self._updated = max(self._updated, self._paused_until)
+
+
+def parse_retry_after(value: str):
+    """Parse a `Retry-After` header (delay in seconds or HTTP date).
+
+    :param value: the value of the header
+    :type value: str
+    :return: the delay in seconds (bounded by RETRY_AFTER_MAX), None if the header is missing or invalid
+    :rtype: float or None
+    """
+    if value in ("", None):
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        delay = (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    return min(max(delay, 0.0), RETRY_AFTER_MAX)
+
+
+class RateLimiter:
+    """Token buckets of the Nakala API, one per endpoint class.
+
+    :param limits: the limits per endpoint class as {class: (rate, burst)}
+    :type limits: dict, optional
+    """
+    def __init__(self, limits: dict = None) -> None:
+        if limits is None:
+            limits = API_RATE_LIMITS
+        self.limits = dict(limits)
+        self.buckets = {endpoint_class: TokenBucket(rate, burst)
+                        for endpoint_class, (rate, burst) in self.limits.items()}
+
+    @staticmethod
+    def endpoint_class(endpoint: str) -> str:
+        """Get the class of an endpoint ("datas/uploads" -> "uploads", "datas/<id>" -> "datas").
+
+        :param endpoint: the endpoint (relative to the API url)
+        :type endpoint: str
+        :return: the class of the endpoint
+        :rtype: str
+        """
+        parts = endpoint.strip("/").split("/")
+        if parts[:2] == ["datas", "uploads"]:
+            return "uploads"
+        return parts[0]
+
+    def bucket(self, endpoint: str):
+        """Get the token bucket of an endpoint.
+
+        :param endpoint: the endpoint or the endpoint class
+        :type endpoint: str
+        :return: the token bucket, None if the endpoint class is not limited
+        :rtype: TokenBucket or None
+        """
+        if endpoint in self.buckets:
+            return self.buckets[endpoint]
+        return self.buckets.get(self.endpoint_class(endpoint))
+
+    def acquire(self, endpoint: str) -> float:
+        """Wait until a call to the endpoint is allowed.
+
+        :param endpoint: the endpoint or the endpoint class
+        :type endpoint: str
+        :return: the time waited (in seconds)
+        :rtype: float
+        """
+        bucket = self.bucket(endpoint)
+        waited = bucket.acquire() if bucket is not None else 0.0
+        if waited > 0:
+            get_metrics().inc("nakalator_rate_limit_wait_seconds_total", waited,
+                              endpoint=self.endpoint_class(endpoint))
+        return waited
+
+    async def acquire_async(self, endpoint: str) -> float:
+        """Wait until a call to the endpoint is allowed, without blocking the event loop.
+
+        :param endpoint: the endpoint or the endpoint class
+        :type endpoint: str
+        :return: the time waited (in seconds)
+        :rtype: float
+        """
+        bucket = self.bucket(endpoint)
+        waited = await bucket.acquire_async() if bucket is not None else 0.0
+        if waited > 0:
+            get_metrics().inc("nakalator_rate_limit_wait_seconds_total", waited,
+                              endpoint=self.endpoint_class(endpoint))
+        return waited
+
+    def backoff(self, endpoint: str, status: int, retry_after: str = None):
+        """Pause the endpoint class when Nakala asks to slow down (429/503 with `Retry-After`).
+
+        :param endpoint: the endpoint or the endpoint class
+        :type endpoint: str
+        :param status: the status code of the response
+        :type status: int
+        :param retry_after: the `Retry-After` header of the response
+        :type retry_after: str, optional
+        :return: the pause in seconds, None if the response does not ask to slow down
+        :rtype: float or None
+        """
+        if status not in RETRY_AFTER_STATUSES:
+            return None
+        delay = parse_retry_after(retry_after)
+        bucket = self.bucket(endpoint)
+        if delay is not None and bucket is not None:
+            bucket.pause(delay)
+        return delay
+
+
+# One rate limiter shared by all the Nakala API calls of the process
+_RATE_LIMITER = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Get the rate limiter shared by all the Nakala API calls.
+
+    :return: the rate limiter
+    :rtype: RateLimiter
+    """
+    global _RATE_LIMITER
+    if _RATE_LIMITER is None:
+        _RATE_LIMITER = RateLimiter()
+    return _RATE_LIMITER
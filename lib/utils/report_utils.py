@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+"""report_utils.py
+
+This module contains the writers of the mapping reports (original file name,
+collection DOI, data DOI, SHA-1). The rows are appended to the report as the
+data are created, without building a DataFrame: CSV (`;` separator) and JSONL
+with the standard library, Parquet with `pyarrow` (optional dependency).
+"""
+
+import csv
+import json
+import os
+import threading
+from dataclasses import (asdict,
+                         fields,
+                         is_dataclass)
+
+from lib.constants import REPORT_FORMATS
+
+
+class ReportWriter:
+    """Append-only writer of a report. The file is created on the first rows,
+    the rows written are flushed to the disk at each call of `write`.
+
+    :param path: the path to the report (with its extension)
+    :type path: str
+    :param columns: the names of the columns of the report
+    :type columns: list
+    """
+    extension = ""
+
+    def __init__(self, path: str, columns: list) -> None:
+        self.path = path
+        self.columns = list(columns)
+        self.rows = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _open(self) -> None:
+        self._file = open(self.path, "a", encoding="utf-8", newline="")
+
+    def _write(self, rows: list) -> None:
+        raise NotImplementedError
+
+    def _flush(self) -> None:
+        self._file.flush()
+
+    def write(self, rows: list) -> None:
+        """Append rows to the report.
+
+        :param rows: the rows (dataclass instances or dictionaries)
+        :type rows: list
+        :return: None
+        :rtype: None
+        """
+        rows = [asdict(row) if is_dataclass(row) else row for row in rows]
+        if len(rows) == 0:
+            return
+        with self._lock:
+            if self._file is None:
+                self._open()
+            self._write([{column: row.get(column) for column in self.columns} for row in rows])
+            self._flush()
+            self.rows += len(rows)
+
+    def close(self) -> None:
+        """Close the report.
+
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class CSVReportWriter(ReportWriter):
+    """Writer of a CSV report (`;` separator, header on the first line)."""
+    extension = ".csv"
+
+    def _open(self) -> None:
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        super()._open()
+        self._writer = csv.DictWriter(self._file, fieldnames=self.columns, delimiter=";")
+        if new_file:
+            self._writer.writeheader()
+
+    def _write(self, rows: list) -> None:
+        self._writer.writerows(rows)
+
+
+class JSONLReportWriter(ReportWriter):
+    """Writer of a JSON Lines report (one JSON object per row)."""
+    extension = ".jsonl"
+
+    def _write(self, rows: list) -> None:
+        self._file.writelines(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+
+
+class ParquetReportWriter(ReportWriter):
+    """Writer of a Parquet report: each call of `write` adds a row group,
+    the file is complete (footer written) when the writer is closed. A Parquet
+    file cannot be appended to, the rows of an existing report (resume) are
+    read and rewritten at the head of the new file."""
+    extension = ".parquet"
+
+    def __init__(self, path: str, columns: list) -> None:
+        check_report_format("parquet")
+        import pyarrow
+        import pyarrow.parquet
+        super().__init__(path, columns)
+        self._pa = pyarrow
+        self._schema = pyarrow.schema([(column, pyarrow.string()) for column in self.columns])
+
+    def _open(self) -> None:
+        previous = None
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            previous = self._pa.parquet.read_table(self.path).select(self.columns).cast(self._schema)
+        self._file = self._pa.parquet.ParquetWriter(self.path, self._schema)
+        if previous is not None:
+            self._file.write_table(previous)
+
+    def _write(self, rows: list) -> None:
+        self._file.write_table(self._pa.Table.from_pylist(rows, schema=self._schema))
+
+    def _flush(self) -> None:
+        # the row groups are written to the disk as they come
+        pass
+
+
+REPORT_WRITERS = {
+    "csv": CSVReportWriter,
+    "jsonl": JSONLReportWriter,
+    "parquet": ParquetReportWriter,
+}
+
+
+def check_report_format(report_format: str) -> None:
+    """Check that the reports can be written in a format.
+
+    :param report_format: the format of the reports ("csv", "jsonl" or "parquet")
+    :type report_format: str
+    :raises ValueError: if the format is unknown
+    :raises ImportError: if the format requires a package not installed
+    :return: None
+    :rtype: None
+    """
+    if report_format not in REPORT_FORMATS:
+        raise ValueError(f"Unknown report format: '{report_format}', "
+                         f"available formats are: {', '.join(REPORT_FORMATS)}")
+    if report_format == "parquet":
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            raise ImportError("The Parquet reports require pyarrow: pip install pyarrow") from None
+
+
+def get_report_writer(path: str, report_format: str = "csv", columns: list = None) -> ReportWriter:
+    """Get a report writer by the format of the report.
+
+    :param path: the path to the report, without extension
+    :type path: str
+    :param report_format: the format of the report ("csv", "jsonl" or "parquet")
+    :type report_format: str, optional
+    :param columns: the names of the columns (default: the fields of NakalaItem)
+    :type columns: list, optional
+    :return: the report writer
+    :rtype: ReportWriter
+    """
+    check_report_format(report_format)
+    if columns is None:
+        from lib.utils.io_utils import NakalaItem
+        columns = [field.name for field in fields(NakalaItem)]
+    writer_class = REPORT_WRITERS[report_format]
+    return writer_class(path + writer_class.extension, columns)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+"""retry_utils.py
+
+This module contains the retry policy shared by all the Nakala API calls:
+responses are classified as retryable or fatal, retries are spaced with
+decorrelated jitter (`backoff` package) and a circuit breaker pauses every
+call while Nakala is unavailable. The Go library mirrors it (lib/bridge/retry.go).
+"""
+
+import asyncio
+import random
+import threading
+import time
+
+import backoff
+
+from lib.constants import (
+    RETRY_MAX_TRIES,
+    RETRY_BASE_DELAY,
+    RETRY_MAX_DELAY,
+    RETRYABLE_STATUSES,
+    CIRCUIT_BREAKER_THRESHOLD,
+    CIRCUIT_BREAKER_COOLDOWN
+)
+from lib.utils.cli_utils import cli_log
+from lib.utils.metrics_utils import get_metrics
+
+
+class RetryableStatus(Exception):
+    """Raised when Nakala answers with a retryable status (e.g. 502, 503, 429).
+
+    :param response: the response
+    :type response: object
+    :param status: the status code of the response
+    :type status: int
+    :param retry_after: the pause asked by Nakala (in seconds), if any
+    :type retry_after: float, optional
+    """
+    def __init__(self, response, status: int, retry_after: float = None) -> None:
+        super().__init__(f"Nakala answered {status}")
+        self.response = response
+        self.status = status
+        self.retry_after = retry_after
+
+
+def is_retryable_status(status: int) -> bool:
+    """Whether a response status is worth retrying (overload or temporary failure).
+    Other statuses are either a success or fatal (e.g. 400, 401, 403, 404).
+
+    :param status: the status code of the response
+    :type status: int
+    :return: True if the request must be sent again
+    :rtype: bool
+    """
+    return status in RETRYABLE_STATUSES
+
+
+def is_outage(status: int = 0, error: Exception = None) -> bool:
+    """Whether a failure means that Nakala is unavailable (counted by the circuit breaker).
+    A throttled request (429) is not an outage: it is handled by the rate limiter.
+
+    :param status: the status code of the response (0 when there is no response)
+    :type status: int, optional
+    :param error: the transport error, if any
+    :type error: Exception, optional
+    :return: True if the failure is an outage
+    :rtype: bool
+    """
+    return error is not None or status >= 500
+
+
+def decorrelated_jitter(base: float = RETRY_BASE_DELAY, cap: float = RETRY_MAX_DELAY):
+    """Wait generator for `backoff` with decorrelated jitter:
+    each delay is drawn between `base` and 3 times the previous delay (bounded by `cap`).
+    The pause asked by Nakala (`Retry-After`) is a lower bound of the delay.
+
+    :param base: the minimum delay (in seconds)
+    :type base: float, optional
+    :param cap: the maximum delay (in seconds)
+    :type cap: float, optional
+    :return: the delays
+    :rtype: generator
+    """
+    delay = base
+    # backoff primes the generator with an empty send, then sends the exception or value
+    failure = yield
+    while True:
+        delay = min(cap, random.uniform(base, delay * 3))
+        retry_after = getattr(failure, "retry_after", None)
+        failure = yield max(delay, retry_after or 0)
+
+
+class CircuitBreaker:
+    """Circuit breaker shared by all the Nakala API calls.
+    After `threshold` consecutive outage failures, the circuit opens and every
+    call waits `cooldown` seconds; then a call is let through (half-open): a
+    success closes the circuit, a failure opens it again.
+
+    :param threshold: the number of consecutive failures opening the circuit
+    :type threshold: int, optional
+    :param cooldown: the pause (in seconds) while the circuit is open
+    :type cooldown: float, optional
+    """
+    def __init__(self,
+                 threshold: int = CIRCUIT_BREAKER_THRESHOLD,
+                 cooldown: float = CIRCUIT_BREAKER_COOLDOWN) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def _delay(self) -> float:
+        with self._lock:
+            return max(0.0, self._open_until - time.monotonic())
+
+    def wait(self) -> float:
+        """Wait while the circuit is open.
+
+        :return: the time waited (in seconds)
+        :rtype: float
+        """
+        waited = 0.0
+        while (delay := self._delay()) > 0:
+            time.sleep(delay)
+            waited += delay
+        return waited
+
+    async def wait_async(self) -> float:
+        """Wait while the circuit is open, without blocking the event loop.
+
+        :return: the time waited (in seconds)
+        :rtype: float
+        """
+        waited = 0.0
+        while (delay := self._delay()) > 0:
+            await asyncio.sleep(delay)
+            waited += delay
+        return waited
+
+    def record(self, status: int = 0, error: Exception = None) -> None:
+        """Record the outcome of a call.
+
+        :param status: the status code of the response (0 when there is no response)
+        :type status: int, optional
+        :param error: the transport error, if any
+        :type error: Exception, optional
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            if not is_outage(status, error):
+                self.failures = 0
+                return
+            self.failures += 1
+            now = time.monotonic()
+            if self.failures < self.threshold or now < self._open_until:
+                return
+            self._open_until = now + self.cooldown
+            self.opened += 1
+            self.failures = 0
+        get_metrics().inc("nakalator_circuit_breaker_opened_total")
+        cli_log(f"Nakala seems unavailable ({status or error}), all the requests are paused "
+                f"for {self.cooldown:.0f} seconds.", "warning")
+
+
+# One circuit breaker shared by all the Nakala API calls of the process
+_CIRCUIT_BREAKER = None
+
+
+def get_circuit_breaker() -> CircuitBreaker:
+    """Get the circuit breaker shared by all the Nakala API calls.
+
+    :return: the circuit breaker
+    :rtype: CircuitBreaker
+    """
+    global _CIRCUIT_BREAKER
+    if _CIRCUIT_BREAKER is None:
+        _CIRCUIT_BREAKER = CircuitBreaker()
+    return _CIRCUIT_BREAKER
+
+
+def retry_policy(exceptions: tuple, max_tries: int = RETRY_MAX_TRIES, on_backoff=None, giveup=None):
+    """Decorator applying the retry policy to a function (or a coroutine function)
+    sending one request. The function raises RetryableStatus or one of `exceptions`
+    when the request must be sent again.
+
+    :param exceptions: the transport errors to retry
+    :type exceptions: tuple
+    :param max_tries: the maximum number of attempts
+    :type max_tries: int, optional
+    :param on_backoff: function called with the `backoff` details before each retry
+    :type on_backoff: callable, optional
+    :param giveup: function called with the failure, returning True if it must not be retried
+    :type giveup: callable, optional
+    :return: the decorator
+    :rtype: callable
+    """
+    return backoff.on_exception(decorrelated_jitter,
+                                (RetryableStatus, *exceptions),
+                                max_tries=max_tries,
+                                jitter=None,
+                                on_backoff=on_backoff,
+                                giveup=giveup if giveup is not None else lambda failure: False,
+                                logger=None)
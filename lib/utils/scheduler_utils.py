@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""scheduler_utils.py
+
+This module contains the batch-wide upload scheduler: the files of every data
+of a batch are uploaded in a single worker pool and each data is released
+as soon as all of its files have landed on Nakala.
+"""
+
+import queue
+import threading
+
+
+class BatchScheduler:
+    """Track which data each uploaded file belongs to.
+
+    A data is put in `ready` when the last file it waits for has landed
+    (immediately if it waits for no file).
+
+    :attr ready: the data ready to be created on Nakala
+    :type ready: queue.Queue
+    """
+    def __init__(self) -> None:
+        self.ready = queue.Queue()
+        self._jobs = {}
+        self._pending = {}
+        self._waiting = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, job, paths: list) -> None:
+        """Register a data and the files it waits for.
+
+        :param key: the unique key of the data
+        :type key: hashable
+        :param job: the data
+        :type job: object
+        :param paths: the paths to the files to upload for this data
+        :type paths: list
+        :return: None
+        :rtype: None
+        """
+        paths = set(paths)
+        if len(paths) == 0:
+            self.ready.put(job)
+            return
+        with self._lock:
+            self._jobs[key] = job
+            self._pending[key] = len(paths)
+            for path in paths:
+                self._waiting.setdefault(path, []).append(key)
+
+    def landed(self, path: str) -> list:
+        """Mark a file as uploaded (successfully or not) and release the data complete.
+
+        :param path: the path to the file uploaded
+        :type path: str
+        :return: the data released by this file
+        :rtype: list
+        """
+        released = []
+        with self._lock:
+            for key in self._waiting.pop(path, []):
+                self._pending[key] -= 1
+                if self._pending[key] == 0:
+                    del self._pending[key]
+                    released.append(self._jobs.pop(key))
+        for job in released:
+            self.ready.put(job)
+        return released
+
+    @property
+    def waiting(self) -> int:
+        """The number of data still waiting for files."""
+        with self._lock:
+            return len(self._pending)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""shard_utils.py
+
+This module contains the coordination of the shard mode: the files of each
+data of a batch are partitioned between N workers (`nakalator shard`) by a
+stable hash of their name. Each worker uploads its part and writes the results
+in a directory shared by the workers (one JSON file per data and per shard),
+then a reducer (`nakalator reduce`) creates each data once all of its shards
+are uploaded. The directory is the only coordination: every file is written
+atomically and the creation of a data is guarded by a lock directory
+(`os.mkdir` is atomic, on network filesystems too).
+"""
+
+import json
+import os
+import socket
+import tempfile
+import time
+import zlib
+
+from lib.constants import SHARD_LOCK_TIMEOUT
+
+
+def parse_shard(spec: str) -> tuple:
+    """Parse a shard specification ("i/N", the shards are numbered from 0).
+
+    :param spec: the specification (e.g. "0/4")
+    :type spec: str
+    :raises ValueError: if the specification is not valid
+    :return: the index of the shard and the number of shards
+    :rtype: tuple
+    """
+    try:
+        index, count = (int(part) for part in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard: '{spec}', expected 'i/N' (e.g. 0/4)") from None
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard: '{spec}', the index must be between 0 and {max(count, 1) - 1}")
+    return index, count
+
+
+def shard_of(name: str, count: int) -> int:
+    """Get the shard of a file: the same on every worker and every run.
+
+    :param name: the name of the file
+    :type name: str
+    :param count: the number of shards
+    :type count: int
+    :return: the index of the shard
+    :rtype: int
+    """
+    return zlib.crc32(name.encode("utf-8")) % count
+
+
+def _write_json(path: str, content) -> None:
+    fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(path))
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(content, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: str):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class ShardStore:
+    """Shared directory of the results of the shards of a batch.
+
+    :param root: the directory of the batch (e.g. output/shards/<batch>)
+    :type root: str
+    """
+    def __init__(self, root: str) -> None:
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def data_dir(self, metadata_path: str) -> str:
+        """Get the directory of a data (named after its metadata file).
+
+        :param metadata_path: the path to the metadata file
+        :type metadata_path: str
+        :return: the directory of the data
+        :rtype: str
+        """
+        path = os.path.join(self.root, os.path.splitext(os.path.basename(metadata_path))[0])
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def save_results(self, metadata_path: str, shard: tuple, results: list) -> None:
+        """Save the results of a shard for a data.
+
+        :param metadata_path: the path to the metadata file
+        :type metadata_path: str
+        :param shard: the index of the shard and the number of shards
+        :type shard: tuple
+        :param results: the files of the shard ({path, name, sha1, local_sha1})
+        :type results: list
+        :return: None
+        :rtype: None
+        """
+        index, count = shard
+        _write_json(os.path.join(self.data_dir(metadata_path), f"shard-{index}-of-{count}.json"),
+                    {"host": socket.gethostname(), "pid": os.getpid(), "files": results})
+
+    def load_results(self, metadata_path: str, count: int) -> tuple:
+        """Load the results of all the shards of a data.
+
+        :param metadata_path: the path to the metadata file
+        :type metadata_path: str
+        :param count: the number of shards
+        :type count: int
+        :return: the files uploaded by the shards (path -> {path, name, sha1, local_sha1})
+                 and the indexes of the shards not finished yet
+        :rtype: tuple
+        """
+        files, missing = {}, []
+        data_dir = self.data_dir(metadata_path)
+        for index in range(count):
+            content = _read_json(os.path.join(data_dir, f"shard-{index}-of-{count}.json"))
+            if content is None:
+                missing.append(index)
+                continue
+            files.update((file["path"], file) for file in content["files"])
+        return files, missing
+
+    def get_data(self, metadata_path: str):
+        """Get the data created by a reducer.
+
+        :param metadata_path: the path to the metadata file
+        :type metadata_path: str
+        :return: the data DOI and collection DOI, None if the data is not created yet
+        :rtype: dict
+        """
+        return _read_json(os.path.join(self.data_dir(metadata_path), "data.json"))
+
+    def record_data(self, metadata_path: str, data_doi: str, collection_doi: str) -> None:
+        """Record a data created by a reducer.
+
+        :param metadata_path: the path to the metadata file
+        :type metadata_path: str
+        :param data_doi: the DOI of the data
+        :type data_doi: str
+        :param collection_doi: the DOI of the collection (if any)
+        :type collection_doi: str
+        :return: None
+        :rtype: None
+        """
+        _write_json(os.path.join(self.data_dir(metadata_path), "data.json"),
+                    {"data_doi": data_doi, "collection_doi": collection_doi})
+
+    def acquire(self, metadata_path: str, timeout: float = SHARD_LOCK_TIMEOUT) -> bool:
+        """Take the lock of the creation of a data (one reducer creates it).
+        A lock older than `timeout` seconds without the data created is taken over.
+
+        :param metadata_path: the path to the metadata file
+        :type metadata_path: str
+        :param timeout: the age (in seconds) from which a lock is stale
+        :type timeout: float, optional
+        :return: True if the lock is taken
+        :rtype: bool
+        """
+        lock = os.path.join(self.data_dir(metadata_path), "create.lock")
+        try:
+            os.mkdir(lock)
+            return True
+        except FileExistsError:
+            try:
+                stale = time.time() - os.stat(lock).st_mtime > timeout
+            except FileNotFoundError:
+                stale = True
+            if stale and self.get_data(metadata_path) is None:
+                # refresh the lock: the reducers seeing it stale at the same time race on the rename
+                owned = f"{lock}.{socket.gethostname()}.{os.getpid()}"
+                try:
+                    os.rename(lock, owned)
+                    os.rmdir(owned)
+                    os.mkdir(lock)
+                    return True
+                except OSError:
+                    return False
+            return False
@@ -4,83 +4,141 @@
     - data integrity
     - data order
     - sha1 consistency
+    - sha1 consistency with the local files
+
+The checks run in linear time on hash indexes (`verify_files`) and return
+a structured diff instead of stopping on the first difference.
 """
 
+from dataclasses import (dataclass,
+                         field)
+
 from lib.utils.cli_utils import cli_log
-from lib.utils.io_utils import load_csv
 
-def check_total_files(files_received: list,
-                       total_org_files: int) -> None:
-    """Check if the total number of files received is equal to the total number of original files
 
-    :param files_received: the files received from Nakala
-    :type files_received: list
-    :param total_org_images: the total number of original files
-    :type total_org_images: int
-    :return: None
-    :rtype: None
+@dataclass
+class VerificationReport:
+    """Dataclass to store the differences between the files sent and the files on Nakala.
+
+    :attr expected: the number of files sent
+    :type expected: int
+    :attr received: the number of files on Nakala
+    :type received: int
+    :attr missing: the names of the files sent but not on Nakala
+    :type missing: list
+    :attr extra: the names of the files on Nakala but not sent (or present twice)
+    :type extra: list
+    :attr mismatched: the files with a different SHA-1 ({name, expected, received})
+    :type mismatched: list
+    :attr reordered: the files at a different position ({name, expected, received})
+    :type reordered: list
     """
-    assert len(files_received) == total_org_files, cli_log("Missing files on Nakala", "error")
-    cli_log("Check total files on Nakala OK", "success")
+    expected: int = 0
+    received: int = 0
+    missing: list = field(default_factory=list)
+    extra: list = field(default_factory=list)
+    mismatched: list = field(default_factory=list)
+    reordered: list = field(default_factory=list)
 
-def check_order_files(files_received: list,
-                       sorted_org_files: list) -> None:
-    """Check if the order of the files received is the same as the order of the original files
+    @property
+    def ok(self) -> bool:
+        """Whether the files on Nakala are exactly the files sent, in the same order."""
+        return not (self.missing or self.extra or self.mismatched or self.reordered) \
+            and self.expected == self.received
+
+    def to_dict(self) -> dict:
+        """Get the report as a dictionary (e.g. to be saved as JSON).
+
+        :return: the report
+        :rtype: dict
+        """
+        return {
+            "ok": self.ok,
+            "expected": self.expected,
+            "received": self.received,
+            "missing": self.missing,
+            "extra": self.extra,
+            "mismatched": self.mismatched,
+            "reordered": self.reordered,
+        }
 
-    :param files_received: the files received from Nakala
-    :type files_received: list
-    :param sorted_org_images: the sorted original files
-    :type sorted_org_images: list
-    :return: None
-    :rtype: None
-    """
-    try:
-        for file_received, file_org in zip(files_received, sorted_org_files):
-            assert file_received['name'] == file_org, cli_log("Order files are not the same. "
-                                                        "Don't worry, this happens when you use method "
-                                                        "'hard' or you have retried requests."
-                                                        "You can always reorder them in Nakala frontend", "warning")
-        cli_log("Check files order on Nakala OK", "success")
-    except AssertionError:
-        cli_log("Cannot check the order of the files", "error")
-    except KeyError:
-        cli_log("Cannot check the order of the files", "error")
 
-def check_sha1_consistency(csv_path: str, api_files: list) -> None:
-    """Check if the SHA1 in the CSV are the same as the SHA1 in the API response
+def verify_files(expected_files: list, api_files: list, local_sha1s: dict = None) -> VerificationReport:
+    """Compare the files sent with the files on Nakala in one pass over hash indexes:
+    count, names, order and SHA-1 (upload result and, if given, local SHA-1).
 
-    :param csv_path: the path to the CSV file
-    :type csv_path: str
-    :param api_files: the files received from the API
+    :param expected_files: the files sent, in order ({name, sha1})
+    :type expected_files: list
+    :param api_files: the files received from the API, in order ({name, sha1})
     :type api_files: list
-    :return: None
-    :rtype: None
+    :param local_sha1s: the SHA-1 computed locally for each file name (optional)
+    :type local_sha1s: dict, optional
+    :return: the differences
+    :rtype: VerificationReport
     """
-    df = load_csv(csv_path)
-
-    # check if the CSV has a column named 'sha1' and if it values are not null
-    assert not df['sha1'].isnull().any(), cli_log("SHA1 is missing in the CSV", "error")
-
-    # compare original_name and sha1 in the CSV with the API response
-    for index, row in df.iterrows():
-        original_name = row['original_name']
-        sha1_csv = row['sha1']
-        api_file = next(
-            (file for file in api_files if file['name'] == original_name),
-            None)
-        assert api_file is not None, cli_log(f"File {original_name} not found in the API response", "error")
-        assert api_file['sha1'] == sha1_csv, cli_log(
-            f"SHA1 for file {original_name} is different in the API response", "error")
-
-    # check if the number of files in the CSV is the same as the number of files in the API response
-    # (same as __check_total_images())
-    assert len(df) == len(api_files), cli_log("Some files are missing in the API response", "error")
-
-    # check if all the files in the CSV are in the API response (not less, not more)
-    df_copy = df.copy()
+    if local_sha1s is None:
+        local_sha1s = {}
+    report = VerificationReport(expected=len(expected_files), received=len(api_files))
+
+    # index of the files on Nakala: name -> sha1
+    received = {}
     for file in api_files:
-        api_file = file
-        df_copy = df_copy[df_copy['original_name'] != api_file['name']]
-    assert len(df_copy) == 0, cli_log("Some files are missing in the CSV", "error")
+        name = file.get("name")
+        if name in received:
+            report.extra.append(name)
+        else:
+            received[name] = file.get("sha1")
+
+    expected_names = set()
+    common = []
+    for file in expected_files:
+        name = file["name"]
+        expected_names.add(name)
+        if name not in received:
+            report.missing.append(name)
+            continue
+        common.append(name)
+        sha1 = received[name]
+        expected_sha1 = local_sha1s.get(name) or file.get("sha1")
+        if not sha1 or sha1 != expected_sha1 or (file.get("sha1") and sha1 != file["sha1"]):
+            report.mismatched.append({"name": name, "expected": expected_sha1, "received": sha1})
+    report.extra.extend(name for name in received if name not in expected_names)
+
+    # order of the files present on both sides
+    received_order = [name for name in received if name in expected_names]
+    received_position = {name: position for position, name in enumerate(received_order)}
+    for position, name in enumerate(common):
+        if received_order[position] != name:
+            report.reordered.append({"name": name, "expected": position, "received": received_position[name]})
+    return report
+
 
-    cli_log("check files with SHA1 on Nakala OK", "success")
\ No newline at end of file
+def log_verification(report: VerificationReport) -> None:
+    """Display the results of the verification of a data.
+
+    :param report: the differences found by `verify_files`
+    :type report: VerificationReport
+    :return: None
+    :rtype: None
+    """
+    if report.expected == report.received and not report.missing and not report.extra:
+        cli_log("Check total files on Nakala OK", "success")
+    else:
+        cli_log(f"Missing files on Nakala: {report.received}/{report.expected} files "
+                f"({len(report.missing)} missing, {len(report.extra)} extra)", "error")
+        for name in report.missing[:10]:
+            cli_log(f"  missing: {name}", "error")
+        for name in report.extra[:10]:
+            cli_log(f"  extra: {name}", "error")
+    if not report.reordered:
+        cli_log("Check files order on Nakala OK", "success")
+    else:
+        cli_log(f"Order files are not the same for {len(report.reordered)} files (first: "
+                f"{report.reordered[0]['name']}). Don't worry, this happens when you have retried requests. "
+                f"You can always reorder them in Nakala frontend", "warning")
+    if not report.mismatched:
+        cli_log("check files with SHA1 on Nakala OK", "success")
+    else:
+        cli_log(f"SHA1 on Nakala differs from the files sent for: "
+                f"{', '.join(file['name'] for file in report.mismatched[:10])}"
+                f"{'...' if len(report.mismatched) > 10 else ''}", "error")
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""verification_utils.py
+
+This module contains the verification phase of a batch: the data created
+during the run are polled concurrently on Nakala (with exponential backoff,
+until they are consistent or a deadline passes) and the results are gathered
+in one consolidated report.
+"""
+
+import datetime
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.constants import (
+    VERIFY_WORKERS,
+    VERIFY_DEADLINE,
+    VERIFY_BASE_DELAY,
+    VERIFY_MAX_DELAY
+)
+from lib.utils.metrics_utils import get_metrics
+from lib.utils.tests_utils import verify_files
+
+
+class BatchVerifier:
+    """Verify the data created during a run, out of the critical path of the uploads.
+
+    :param fetch_files: function returning the files of a data on Nakala (empty if not available yet)
+    :type fetch_files: callable
+    :param workers: the number of data polled at the same time
+    :type workers: int, optional
+    :param deadline: the maximum duration (in seconds) of the verification phase
+    :type deadline: float, optional
+    :param base_delay: the delay (in seconds) before polling a data again, doubled at each attempt
+    :type base_delay: float, optional
+    :param max_delay: the maximum delay (in seconds) between two polls of a data
+    :type max_delay: float, optional
+    """
+    def __init__(self,
+                 fetch_files,
+                 workers: int = VERIFY_WORKERS,
+                 deadline: float = VERIFY_DEADLINE,
+                 base_delay: float = VERIFY_BASE_DELAY,
+                 max_delay: float = VERIFY_MAX_DELAY) -> None:
+        self.fetch_files = fetch_files
+        self.workers = workers
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def _verify_one(self, job, end: float) -> dict:
+        """Poll one data until its files on Nakala are the files sent or the deadline passes."""
+        local_sha1s = {os.path.basename(path): sha1 for path, sha1 in job.local_sha1s.items()}
+        start = time.monotonic()
+        delay = self.base_delay
+        attempts = 0
+        report = None
+        while True:
+            attempts += 1
+            files = self.fetch_files(job.data_doi)
+            if len(files) > 0:
+                report = verify_files(job.sha1s, files, local_sha1s)
+                if report.ok:
+                    break
+            # Nakala may not have finished indexing the data
+            if time.monotonic() + delay > end:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_delay)
+        job.verification = report
+        if report is None:
+            status = "unavailable"
+        else:
+            status = "verified" if report.ok else "inconsistent"
+        metrics = get_metrics()
+        metrics.observe("nakalator_verification_duration_seconds", time.monotonic() - start)
+        metrics.inc("nakalator_data_verified_total", status=status)
+        return {
+            "metadata_file": os.path.basename(job.metadata_path),
+            "data_doi": job.data_doi,
+            "collection_doi": job.collection_doi,
+            "status": status,
+            "attempts": attempts,
+            "report": report.to_dict() if report is not None else None,
+        }
+
+    def verify(self, jobs: list) -> dict:
+        """Verify the data concurrently.
+
+        :param jobs: the data created on Nakala
+        :type jobs: list of DataJob
+        :return: the consolidated report ({summary, datas})
+        :rtype: dict
+        """
+        start = time.monotonic()
+        end = start + self.deadline
+        results = []
+        if len(jobs) > 0:
+            with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(jobs)))) as executor:
+                results = list(executor.map(lambda job: self._verify_one(job, end), jobs))
+        summary = {status: sum(1 for result in results if result["status"] == status)
+                   for status in ("verified", "inconsistent", "unavailable")}
+        summary["total"] = len(results)
+        summary["duration"] = round(time.monotonic() - start, 2)
+        return {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "summary": summary,
+            "datas": results,
+        }
+
+    @staticmethod
+    def save(report: dict, output_dir: str) -> str:
+        """Save the consolidated report as JSON.
+
+        :param report: the consolidated report
+        :type report: dict
+        :param output_dir: the directory of the report
+        :type output_dir: str
+        :return: the path to the report
+        :rtype: str
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir,
+                            f"verification_report_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        return path
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+"""watch_utils.py
+
+This module contains the watcher of `nakalator watch`: the batch directories
+of metadatas/ are scanned at regular intervals, the batches marked as ready
+(ready-file) are queued and processed with a bounded number of batches at the
+same time, and the status of each batch is written as JSON in output/.
+"""
+
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import (asdict,
+                         dataclass,
+                         field)
+from typing import Union
+
+from lib.constants import (
+    WATCH_READY_FILE,
+    WATCH_INTERVAL,
+    WATCH_MAX_BATCHES
+)
+from lib.utils.cli_utils import cli_log
+
+
+@dataclass
+class BatchStatus:
+    """Dataclass to store the status of a batch processed by the watcher.
+
+    :attr batch: the name of the batch directory in metadatas/
+    :type batch: str
+    :attr status: "queued", "running", "done" or "failed"
+    :type status: str
+    :attr ready_mtime_ns: the mtime of the ready-file of the batch processed
+    :type ready_mtime_ns: int
+    :attr queued_at: the date the batch was queued
+    :type queued_at: str
+    :attr started_at: the date the processing started
+    :type started_at: str
+    :attr finished_at: the date the processing ended
+    :type finished_at: str
+    :attr error: the error of a failed batch
+    :type error: str
+    :attr summary: the summary of the run (see Nakalator.run_data)
+    :type summary: dict
+    """
+    batch: str
+    status: str = "queued"
+    ready_mtime_ns: int = 0
+    queued_at: Union[str, None] = None
+    started_at: Union[str, None] = None
+    finished_at: Union[str, None] = None
+    error: Union[str, None] = None
+    summary: dict = field(default_factory=dict)
+
+
+def _now() -> str:
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+class BatchWatcher:
+    """Watch metadatas/ and process the batches marked as ready.
+    A batch is processed again only if its ready-file is touched again
+    (e.g. to retry a failed batch once the metadata are fixed).
+
+    :param metadatas_dir: the directory of the batches
+    :type metadatas_dir: str
+    :param status_dir: the directory of the status files
+    :type status_dir: str
+    :param process: function processing a batch (name of the batch -> summary)
+    :type process: callable
+    :param ready_file: the name of the file marking a batch as ready
+    :type ready_file: str, optional
+    :param interval: the time (in seconds) between two scans
+    :type interval: float, optional
+    :param max_batches: the number of batches processed at the same time
+    :type max_batches: int, optional
+    """
+    def __init__(self,
+                 metadatas_dir: str,
+                 status_dir: str,
+                 process,
+                 ready_file: str = WATCH_READY_FILE,
+                 interval: float = WATCH_INTERVAL,
+                 max_batches: int = WATCH_MAX_BATCHES) -> None:
+        self.metadatas_dir = metadatas_dir
+        self.status_dir = status_dir
+        self.process = process
+        self.ready_file = ready_file
+        self.interval = interval
+        self.max_batches = max(1, max_batches)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_batches, thread_name_prefix="batch")
+        # batches queued or running in this process
+        self._active = set()
+        self._lock = threading.Lock()
+        os.makedirs(self.status_dir, exist_ok=True)
+
+    def status_path(self, batch: str) -> str:
+        """Get the path to the status file of a batch.
+
+        :param batch: the name of the batch
+        :type batch: str
+        :return: the path to the status file
+        :rtype: str
+        """
+        return os.path.join(self.status_dir, f"{batch}.json")
+
+    def load_status(self, batch: str) -> Union[BatchStatus, None]:
+        """Load the status of a batch.
+
+        :param batch: the name of the batch
+        :type batch: str
+        :return: the status, None if the batch was never processed
+        :rtype: BatchStatus
+        """
+        try:
+            with open(self.status_path(batch), encoding="utf-8") as f:
+                return BatchStatus(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def save_status(self, status: BatchStatus) -> None:
+        """Save the status of a batch (atomically, the status can be read at any time).
+
+        :param status: the status of the batch
+        :type status: BatchStatus
+        :return: None
+        :rtype: None
+        """
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{status.batch}.", suffix=".tmp", dir=self.status_dir)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(asdict(status), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.status_path(status.batch))
+
+    def find_ready_batches(self) -> list:
+        """Find the batches marked as ready and not processed yet.
+
+        :return: the batches as (name, mtime of the ready-file), sorted by name
+        :rtype: list
+        """
+        ready = []
+        with os.scandir(self.metadatas_dir) as entries:
+            for entry in entries:
+                if not entry.is_dir() or entry.name in self._active:
+                    continue
+                try:
+                    ready_mtime_ns = os.stat(os.path.join(entry.path, self.ready_file)).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                status = self.load_status(entry.name)
+                if status is not None and status.status in ("done", "failed") \
+                        and status.ready_mtime_ns == ready_mtime_ns:
+                    continue
+                ready.append((entry.name, ready_mtime_ns))
+        return sorted(ready)
+
+    def _run(self, status: BatchStatus) -> None:
+        status.status = "running"
+        status.started_at = _now()
+        self.save_status(status)
+        cli_log(f"Batch {status.batch}: processing...", "info")
+        try:
+            status.summary = self.process(status.batch) or {}
+            status.status = "done"
+            if len(status.summary.get("failed", [])) > 0:
+                status.status = "failed"
+                status.error = f"{len(status.summary['failed'])} data not created, touch the ready-file to retry"
+        except SystemExit as e:
+            # fatal errors of the run end with sys.exit(1)
+            status.status = "done" if e.code in (0, None) else "failed"
+            if status.status == "failed":
+                status.error = f"the run stopped (exit code {e.code}), see the log"
+        except Exception as e:
+            status.status = "failed"
+            status.error = f"{type(e).__name__}: {e}"
+        status.finished_at = _now()
+        self.save_status(status)
+        with self._lock:
+            self._active.discard(status.batch)
+        cli_log(f"Batch {status.batch}: {status.status}"
+                f"{f' ({status.error})' if status.error else ''}.",
+                "success" if status.status == "done" else "error")
+
+    def poll(self) -> int:
+        """Queue the batches marked as ready.
+
+        :return: the number of batches queued
+        :rtype: int
+        """
+        batches = self.find_ready_batches()
+        for batch, ready_mtime_ns in batches:
+            status = BatchStatus(batch=batch, ready_mtime_ns=ready_mtime_ns, queued_at=_now())
+            with self._lock:
+                self._active.add(batch)
+            self.save_status(status)
+            cli_log(f"Batch {batch}: queued.", "info")
+            self._executor.submit(self._run, status)
+        return len(batches)
+
+    @property
+    def busy(self) -> bool:
+        """Whether batches are queued or running."""
+        with self._lock:
+            return len(self._active) > 0
+
+    def serve(self, once: bool = False, stop: threading.Event = None) -> None:
+        """Scan metadatas/ every `interval` seconds and process the ready batches.
+
+        :param once: if the watcher stops when the ready batches are processed (default: False)
+        :type once: bool, optional
+        :param stop: event stopping the watcher (optional)
+        :type stop: threading.Event, optional
+        :return: None
+        :rtype: None
+        """
+        stop = stop if stop is not None else threading.Event()
+        try:
+            while not stop.is_set():
+                self.poll()
+                if once:
+                    while self.busy:
+                        time.sleep(0.1)
+                    break
+                stop.wait(self.interval)
+        except KeyboardInterrupt:
+            cli_log("Stopping: the batches running are finished first (Ctrl+C again to kill).", "warning")
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
@@ -7,14 +7,15 @@ Main entry point. Launcher for the Nakalator CLI.
 """
 
 import os
+import queue
 import shutil
 import subprocess
 import sys
+import time
 
-from typer import Typer
+from typer import Typer, Argument, Option
 from typer import main as t_main
 
-from lib.Nakalator import Nakalator
 from lib.utils.cli_utils import (banner,
                                  prompt_select,
                                  prompt_confirm,
@@ -27,10 +28,52 @@ from lib.constants import (base_dir_create,
                            data_dir_create,
                            metadatas_dir_create,
                            output_dir_create,
-                           metadatas_dir)
+                           metadatas_dir,
+                           output_dir,
+                           UPLOAD_ENGINE_DEFAULT,
+                           UPLOAD_MAX_WORKERS,
+                           UPLOAD_WORKERS_LIMIT,
+                           HTTP_POOL_SIZE,
+                           REPORT_FORMAT_DEFAULT,
+                           WATCH_READY_FILE,
+                           WATCH_INTERVAL,
+                           WATCH_MAX_BATCHES,
+                           WATCH_STATUS_DIR,
+                           SHARDS_DIR,
+                           METRICS_DIR)
 
 app = Typer()
 
+
+def check_workspace() -> None:
+    """Exit if the command is not launched from the nakalator_workspace/ directory."""
+    if not os.getcwd().endswith("nakalator_workspace"):
+        cli_log(
+                "You are not in the nakalator_workspace/ directory. cd into it or create "
+                "it with 'nakalator init' if not exist before restart.", "info")
+        sys.exit(1)
+
+
+def metrics_exporter(command: str, port: int = 0, **labels):
+    """Get the exporter of the metrics of a command: a Prometheus textfile in
+    output/metrics/ (rewritten during the run) and a /metrics endpoint if a port is given.
+
+    :param command: the name of the command (in the name of the textfile and as label)
+    :type command: str
+    :param port: the port of the /metrics endpoint (0: no endpoint)
+    :type port: int, optional
+    :param labels: other labels of the series (e.g. the shard)
+    :return: the exporter, to use as a context manager
+    :rtype: MetricsExporter
+    """
+    from lib.utils.metrics_utils import (MetricsExporter,
+                                         get_metrics)
+    name = "_".join(["nakalator", command, *labels.values()])
+    return MetricsExporter(get_metrics(),
+                           textfile=os.path.join(output_dir, METRICS_DIR, f"{name}.prom"),
+                           port=port,
+                           labels={"command": command, **labels})
+
 @app.command()
 def init() -> None:
     """Initialize the project file structure.
@@ -61,16 +104,27 @@ def init() -> None:
 
 
 @app.command()
-def main() -> None:
+def main(engine: str = Option(UPLOAD_ENGINE_DEFAULT,
+                              help="Upload engine used to send files: 'go' or 'asyncio'."),
+         workers: int = Option(UPLOAD_MAX_WORKERS,
+                               help="Initial number of concurrent uploads (adapted during the run)."),
+         workers_limit: int = Option(UPLOAD_WORKERS_LIMIT,
+                                     help="Maximum number of concurrent uploads."),
+         pool_size: int = Option(HTTP_POOL_SIZE,
+                                 help="Number of connections kept open with Nakala."),
+         resume: bool = Option(True,
+                               help="Skip files and data already sent (recorded in output/upload_journal.sqlite)."),
+         hash_files: bool = Option(True,
+                                   help="Compute the SHA-1 of the files locally before sending them."),
+         report_format: str = Option(REPORT_FORMAT_DEFAULT,
+                                     help="Format of the reports in output/: 'csv', 'jsonl' or 'parquet' (requires pyarrow)."),
+         metrics_port: int = Option(0,
+                                    help=f"Port of a Prometheus /metrics endpoint during the run (0: only output/{METRICS_DIR}/).")) -> None:
     """Main function for the Nakalator CLI."""
     banner()
 
     # Test if the project structure exists and if the user is in the right directory
-    if not os.getcwd().endswith("nakalator_workspace"):
-        cli_log(
-                "You are not in the nakalator_workspace/ directory. cd into it or create "
-                "it with 'nakalator init' if not exist before restart.", "info")
-        sys.exit(1)
+    check_workspace()
 
     # Select Nkl env where data are send? (prod / test)
     environment_opt_selected = prompt_select("Which Nakala environment do you want to use to send your data?",
@@ -103,18 +157,212 @@ def main() -> None:
         same_batch_collection = False
 
     if prompt_confirm("Are you ready to send to Nakala?", default=False):
+        # imported here: the upload machinery is not needed by `nakalator init` or `--help`
+        from lib.Nakalator import Nakalator
         nklor = Nakalator(
             env=environment_opt_selected,
             batch=multiple_data_opt_selected,
             metadata_loc=metadata_opt_selected,
             collection_confirm=collection_attached_opt_selected,
-            same_collection_batch=same_batch_collection
+            same_collection_batch=same_batch_collection,
+            upload_engine=engine,
+            max_workers=workers,
+            workers_limit=workers_limit,
+            pool_size=pool_size,
+            resume=resume,
+            precompute_sha1=hash_files,
+            report_format=report_format
+        )
+        with metrics_exporter("main", metrics_port):
+            summary = nklor.run_data()
+        # the data not created are retried by the next run
+        sys.exit(1 if len(summary["failed"]) > 0 else 0)
+
+    sys.exit(0)
+
+
+@app.command()
+def watch(env: str = Option("test",
+                            help="Nakala environment where the data are sent: 'test' or 'production'."),
+          collections: bool = Option(False,
+                                     help="Attach the data to the collections of the metadata files (created if needed)."),
+          same_collection: bool = Option(False,
+                                         help="Attach all the data of a batch to the same collection."),
+          interval: float = Option(WATCH_INTERVAL,
+                                   help="Time (in seconds) between two scans of metadatas/."),
+          batches: int = Option(WATCH_MAX_BATCHES,
+                                help="Number of batches processed at the same time."),
+          once: bool = Option(False,
+                              help="Process the batches ready now, then stop."),
+          engine: str = Option(UPLOAD_ENGINE_DEFAULT,
+                               help="Upload engine used to send files: 'go' or 'asyncio'."),
+          workers: int = Option(UPLOAD_MAX_WORKERS,
+                                help="Initial number of concurrent uploads (adapted during the run)."),
+          workers_limit: int = Option(UPLOAD_WORKERS_LIMIT,
+                                      help="Maximum number of concurrent uploads."),
+          pool_size: int = Option(HTTP_POOL_SIZE,
+                                  help="Number of connections kept open with Nakala."),
+          hash_files: bool = Option(True,
+                                    help="Compute the SHA-1 of the files locally before sending them."),
+          report_format: str = Option(REPORT_FORMAT_DEFAULT,
+                                      help="Format of the reports in output/: 'csv', 'jsonl' or 'parquet' (requires pyarrow)."),
+          metrics_port: int = Option(0,
+                                     help=f"Port of a Prometheus /metrics endpoint (0: only output/{METRICS_DIR}/).")) -> None:
+    """Watch metadatas/ and send each batch directory marked as ready (with a .ready file) without questions."""
+    check_workspace()
+    if env not in ("test", "production"):
+        cli_log(f"Unknown Nakala environment: '{env}', use 'test' or 'production'.", "error")
+        sys.exit(1)
+
+    # imported here: the upload machinery is not needed by `nakalator init` or `--help`
+    from lib.Nakalator import Nakalator
+    from lib.upload_engines import get_upload_engine
+    from lib.utils.watch_utils import BatchWatcher
+
+    # upload engines kept warm between the batches. An engine holding per-instance state (the
+    # concurrency controller and event loop of asyncio) runs one batch at a time: the batches
+    # processed at the same time take an idle one, or build their own. A shared engine (the go
+    # library, configured once per process) serves all the batches.
+    try:
+        uploader = get_upload_engine(engine, max_workers=workers, workers_limit=workers_limit, pool_size=pool_size)
+    except (ValueError, RuntimeError) as e:
+        cli_log(str(e), "error")
+        sys.exit(1)
+    idle_uploaders = queue.SimpleQueue()
+    idle_uploaders.put(uploader)
+
+    def process(batch: str) -> dict:
+        batch_uploader = uploader
+        if not uploader.shared:
+            try:
+                batch_uploader = idle_uploaders.get_nowait()
+            except queue.Empty:
+                batch_uploader = get_upload_engine(engine, max_workers=workers, workers_limit=workers_limit,
+                                                   pool_size=pool_size)
+        nklor = Nakalator(
+            env=env,
+            batch=True,
+            metadata_loc=batch,
+            collection_confirm=collections,
+            same_collection_batch=same_collection,
+            pool_size=pool_size,
+            resume=True,
+            precompute_sha1=hash_files,
+            report_format=report_format,
+            uploader=batch_uploader,
+            interactive=False
         )
-        nklor.run_data()
+        try:
+            return nklor.run_data()
+        finally:
+            nklor.journal.close()
+            if not uploader.shared:
+                idle_uploaders.put(batch_uploader)
 
+    watcher = BatchWatcher(metadatas_dir=str(metadatas_dir),
+                           status_dir=os.path.join(output_dir, WATCH_STATUS_DIR),
+                           process=process,
+                           interval=interval,
+                           max_batches=batches)
+    cli_log(f"Watching {metadatas_dir} for batches marked with '{WATCH_READY_FILE}' "
+            f"(environment: {env}, status in output/{WATCH_STATUS_DIR}/). Ctrl+C to stop.", "info")
+    with metrics_exporter("watch", metrics_port):
+        watcher.serve(once=once)
     sys.exit(0)
 
 
+@app.command()
+def shard(batch: str = Argument(..., help="Batch directory in metadatas/."),
+          shard: str = Option(..., help="Shard uploaded by this worker: 'i/N' (from 0/N to N-1/N)."),
+          env: str = Option("test",
+                            help="Nakala environment where the files are sent: 'test' or 'production'."),
+          shard_dir: str = Option(None,
+                                  help=f"Directory shared by the workers and the reducer (default: output/{SHARDS_DIR})."),
+          engine: str = Option(UPLOAD_ENGINE_DEFAULT,
+                               help="Upload engine used to send files: 'go' or 'asyncio'."),
+          workers: int = Option(UPLOAD_MAX_WORKERS,
+                                help="Initial number of concurrent uploads (adapted during the run)."),
+          workers_limit: int = Option(UPLOAD_WORKERS_LIMIT,
+                                      help="Maximum number of concurrent uploads."),
+          pool_size: int = Option(HTTP_POOL_SIZE,
+                                  help="Number of connections kept open with Nakala."),
+          hash_files: bool = Option(True,
+                                    help="Compute the SHA-1 of the files locally before sending them."),
+          metrics_port: int = Option(0,
+                                     help=f"Port of a Prometheus /metrics endpoint during the run (0: only output/{METRICS_DIR}/).")) -> None:
+    """Upload one shard of the files of a batch (the data are created by 'nakalator reduce')."""
+    check_workspace()
+    from lib.Nakalator import Nakalator
+    from lib.utils.shard_utils import parse_shard
+    try:
+        shard_spec = parse_shard(shard)
+    except ValueError as e:
+        cli_log(str(e), "error")
+        sys.exit(1)
+    nklor = Nakalator(
+        env=env,
+        batch=True,
+        metadata_loc=batch,
+        upload_engine=engine,
+        max_workers=workers,
+        workers_limit=workers_limit,
+        pool_size=pool_size,
+        precompute_sha1=hash_files,
+        interactive=False,
+        shard=shard_spec,
+        shard_dir=shard_dir
+    )
+    with metrics_exporter("shard", metrics_port, shard=f"{shard_spec[0]}-of-{shard_spec[1]}"):
+        summary = nklor.run_shard()
+    sys.exit(1 if summary["failed"] > 0 else 0)
+
+
+@app.command()
+def reduce(batch: str = Argument(..., help="Batch directory in metadatas/."),
+           shards: int = Option(..., help="Number of shards of the batch (N)."),
+           env: str = Option("test",
+                             help="Nakala environment where the data are created: 'test' or 'production'."),
+           shard_dir: str = Option(None,
+                                   help=f"Directory shared by the workers and the reducer (default: output/{SHARDS_DIR})."),
+           collections: bool = Option(False,
+                                      help="Attach the data to the collections of the metadata files (created if needed)."),
+           same_collection: bool = Option(False,
+                                          help="Attach all the data of the batch to the same collection."),
+           wait: bool = Option(False,
+                               help="Wait for the shards not finished yet instead of leaving their data for a next run."),
+           interval: float = Option(WATCH_INTERVAL,
+                                    help="Time (in seconds) between two checks of the shards with --wait."),
+           report_format: str = Option(REPORT_FORMAT_DEFAULT,
+                                       help="Format of the reports in output/: 'csv', 'jsonl' or 'parquet' (requires pyarrow)."),
+           metrics_port: int = Option(0,
+                                      help=f"Port of a Prometheus /metrics endpoint during the run (0: only output/{METRICS_DIR}/).")) -> None:
+    """Create the data of a sharded batch once all of their shards are uploaded, and merge the reports."""
+    check_workspace()
+    from lib.Nakalator import Nakalator
+    if shards < 1:
+        cli_log("The number of shards must be at least 1.", "error")
+        sys.exit(1)
+    nklor = Nakalator(
+        env=env,
+        batch=True,
+        metadata_loc=batch,
+        collection_confirm=collections,
+        same_collection_batch=same_collection,
+        report_format=report_format,
+        interactive=False,
+        reduce_shards=shards,
+        shard_dir=shard_dir
+    )
+    with metrics_exporter("reduce", metrics_port):
+        while True:
+            summary = nklor.run_reduce()
+            if not wait or len(summary["waiting"]) == 0:
+                break
+            cli_log(f"{len(summary['waiting'])} data waiting for shards, next check in {interval:.0f} seconds.", "info")
+            time.sleep(interval)
+    sys.exit(1 if len(summary["waiting"]) > 0 else 0)
+
+
 if __name__ == "__main__":
     """Launch the CLI.
     `show_completion` and `install_completion` are hidden commands to show and install shell completions.
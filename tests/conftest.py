@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+"""conftest.py
+
+The tests import the modules of the repository (`lib`, `nakalator`) from its root.
+"""
+
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""test_imports.py
+
+The CLI starts without the heavy dependencies: `import nakalator` and
+`nakalator --help` do not load the go library, do not read credentials.yml and
+do not import pandas or aiohttp (each check runs in a new interpreter).
+"""
+
+import json
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT_DIR
+
+# modules that must not be imported when the CLI starts
+DEFERRED_MODULES = ("pandas", "aiohttp", "requests", "lib.Nakalator")
+
+_PROBE = """
+import json, sys
+sys.argv = ["nakalator.py"] + {argv!r}
+import nakalator
+if len(sys.argv) > 1:
+    try:
+        nakalator.app()
+    except SystemExit:
+        pass
+from lib.constants import get_credentials
+gotils = sys.modules.get("lib.bridge.nkl_gotils")
+with open("/proc/self/maps") as f:
+    mapped = "nakala_request" in f.read()
+print(json.dumps({{
+    "modules": sorted(sys.modules),
+    "credentials_read": get_credentials.cache_info().currsize > 0,
+    "go_lib_loaded": mapped or (gotils is not None and gotils.init_lib.cache_info().currsize > 0),
+}}))
+"""
+
+
+def probe(argv: list, cwd: str) -> dict:
+    """Import the CLI (and run it with `argv`) in a new interpreter and report what it loaded."""
+    process = subprocess.run([sys.executable, "-c", _PROBE.format(argv=argv)],
+                             cwd=cwd,
+                             env={"PYTHONPATH": ROOT_DIR, "PATH": ""},
+                             capture_output=True,
+                             text=True,
+                             check=True)
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="reads /proc/self/maps")
+@pytest.mark.parametrize("argv", [[], ["--help"]], ids=["import", "help"])
+def test_cli_starts_without_heavy_dependencies(tmp_path, argv):
+    # a workspace with credentials: they must not be read to display the help
+    (tmp_path / "credentials.yml").write_text('API_NAKALA_KEY_TEST: "key"\n', encoding="utf-8")
+    loaded = probe(argv, str(tmp_path))
+    assert [name for name in DEFERRED_MODULES if name in loaded["modules"]] == []
+    assert not loaded["credentials_read"]
+    assert not loaded["go_lib_loaded"]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""test_mock_utils.py
+
+A round trip against the local stand-in of the Nakala API: the files uploaded
+by the asyncio engine, the data created with them and read back.
+"""
+
+import hashlib
+
+import pytest
+
+from lib import constants
+from lib.utils.mock_utils import (MockNakalaServer,
+                                  use_mock_server)
+
+API_KEY = "test-key"
+
+
+@pytest.fixture
+def credentials(tmp_path, monkeypatch):
+    path = tmp_path / "credentials.yml"
+    path.write_text(f'API_NAKALA_KEY_TEST: "{API_KEY}"\n', encoding="utf-8")
+    monkeypatch.setattr(constants, "credentials_path", path)
+    constants.get_credentials.cache_clear()
+    yield path
+    constants.get_credentials.cache_clear()
+
+
+def test_round_trip(tmp_path, credentials):
+    pytest.importorskip("aiohttp")
+    from lib.NakalatorAPIRequest import NakalaAPIRequestBuilder
+    from lib.upload_engines import get_upload_engine
+
+    contents = {"a.txt": b"first file\n", "b é.bin": bytes(range(256)) * 1000}
+    paths = []
+    for name, content in contents.items():
+        (tmp_path / name).write_bytes(content)
+        paths.append(str(tmp_path / name))
+
+    with MockNakalaServer() as server, use_mock_server(server.url):
+        results = []
+        get_upload_engine("asyncio", max_workers=2).stream(f"{server.url}/datas/uploads", API_KEY, paths,
+                                                           results.append)
+        assert sorted((result["name"], result["status"], result["sha1"]) for result in results) == \
+            sorted((name, 201, hashlib.sha1(content).hexdigest()) for name, content in contents.items())
+
+        sender = NakalaAPIRequestBuilder(env="test")
+        sha1s = [{"name": result["name"], "sha1": result["sha1"]} for result in results]
+        metadata = {"data": {"status": "pending"}, "collectionIds": "", "metadata": {}}
+        data_doi = sender.initialize_nakala_data(sha1s, metadata)
+        response = sender.get_builder(f"datas/{data_doi}")
+        assert response.status_code == 200
+        assert sorted(file["sha1"] for file in response.json()["files"]) == \
+            sorted(hashlib.sha1(content).hexdigest() for content in contents.values())
+        assert server.stats()["statuses"] == {"201": 3, "200": 1}
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""test_shard_utils.py
+
+The coordination of the shard mode: the partition of the files, the results
+of the shards and the lock of the creation of a data, taken by concurrent
+reducers (processes).
+"""
+
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from lib.utils.shard_utils import (ShardStore,
+                                   parse_shard,
+                                   shard_of)
+
+METADATA_PATH = "metadatas/batch/data_1.yml"
+
+
+@pytest.mark.parametrize("spec, expected", [("0/1", (0, 1)), ("3/4", (3, 4)), (" 1 / 2 ", (1, 2))])
+def test_parse_shard(spec, expected):
+    assert parse_shard(spec) == expected
+
+
+@pytest.mark.parametrize("spec", ["", "1", "a/4", "1/2/3", "4/4", "-1/4", "0/0"])
+def test_parse_shard_invalid(spec):
+    with pytest.raises(ValueError, match="Invalid shard"):
+        parse_shard(spec)
+
+
+def test_shard_of_is_stable_and_partitions():
+    names = [f"file_{index:05d}.tif" for index in range(1000)]
+    shards = [shard_of(name, 4) for name in names]
+    # the same on every call (and every process: crc32, not the salted hash())
+    assert shards == [shard_of(name, 4) for name in names]
+    assert set(shards) == {0, 1, 2, 3}
+    assert all(shard_of(name, 1) == 0 for name in names)
+
+
+def test_load_results_with_missing_shards(tmp_path):
+    store = ShardStore(str(tmp_path))
+    store.save_results(METADATA_PATH, (0, 3), [{"path": "a", "name": "a", "sha1": "1", "local_sha1": "1"}])
+    store.save_results(METADATA_PATH, (2, 3), [{"path": "c", "name": "c", "sha1": "3", "local_sha1": "3"}])
+    files, missing = store.load_results(METADATA_PATH, 3)
+    assert sorted(files) == ["a", "c"]
+    assert files["c"]["sha1"] == "3"
+    assert missing == [1]
+    # the results of another number of shards are not mixed up
+    assert store.load_results(METADATA_PATH, 2) == ({}, [0, 1])
+
+
+def test_acquire_one_reducer_wins(tmp_path):
+    store = ShardStore(str(tmp_path))
+    with multiprocessing.Pool(8) as pool:
+        acquired = pool.map(store.acquire, [METADATA_PATH] * 32)
+    assert acquired.count(True) == 1
+
+
+def test_acquire_takes_over_a_stale_lock(tmp_path):
+    store = ShardStore(str(tmp_path))
+    assert store.acquire(METADATA_PATH)
+    lock = os.path.join(store.data_dir(METADATA_PATH), "create.lock")
+    # a reducer holding the lock for less than the timeout
+    assert not store.acquire(METADATA_PATH, timeout=60)
+    # a reducer died with the lock, the data is not created
+    past = time.time() - 120
+    os.utime(lock, (past, past))
+    assert store.acquire(METADATA_PATH, timeout=60)
+    assert time.time() - os.stat(lock).st_mtime < 60
+    assert not store.acquire(METADATA_PATH, timeout=60)
+
+
+def test_acquire_keeps_a_stale_lock_of_a_created_data(tmp_path):
+    store = ShardStore(str(tmp_path))
+    assert store.acquire(METADATA_PATH)
+    store.record_data(METADATA_PATH, "10.34847/nkl.0001", "")
+    lock = os.path.join(store.data_dir(METADATA_PATH), "create.lock")
+    past = time.time() - 120
+    os.utime(lock, (past, past))
+    assert not store.acquire(METADATA_PATH, timeout=60)
+    assert store.get_data(METADATA_PATH)["data_doi"] == "10.34847/nkl.0001"